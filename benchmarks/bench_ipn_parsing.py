@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Benchmark verifying and parsing IPN requests of all built-in providers.
+
+Builds a signed JVZoo POST request and an encrypted Clickbank notification
+and parses each of them repeatedly with its ``IIPNProvider``.
+
+    bin/py benchmarks/bench_ipn_parsing.py --iterations 20000
+"""
+
+from Crypto.Cipher import AES
+from pyramid import testing
+from pyramid_bimt.views.ipn import ClickbankProvider
+from pyramid_bimt.views.ipn import JVZooProvider
+
+import argparse
+import hashlib
+import json
+import time
+
+SECRET = 'secret'
+
+
+def jvzoo_request():
+    post = {
+        'ccustname': 'John Smith',
+        'ccustemail': 'John.Smith@email.com',
+        'cproditem': '1',
+        'ctransaction': 'SALE',
+        'ctransreceipt': '123',
+        'ctransaffiliate': 'affiliate@email.com',
+        'ctransamount': '4700',
+        'ctranstime': '1388400000',
+        'cvendthru': 'foo=bar',
+    }
+    values = [value for key, value in sorted(post.items())] + [SECRET]
+    post['cverify'] = hashlib.sha1(
+        '|'.join(values)).hexdigest()[:8].upper()
+    return testing.DummyRequest(post=post)
+
+
+def clickbank_request():
+    payload = json.dumps({
+        'receipt': '123',
+        'transactionType': 'SALE',
+        'affiliate': 'aff',
+        'lineItems': [
+            {'itemNo': '1', 'productTitle': 'A passed in title'},
+        ],
+        'customer': {
+            'billing': {
+                'fullName': 'John Smith',
+                'email': 'John.Smith@email.com',
+            },
+        },
+    })
+    padding = 16 - len(payload) % 16
+    payload += chr(padding) * padding
+    iv = '27CD0D0CA9379D32'
+    cipher = AES.new(
+        hashlib.sha1(SECRET).hexdigest()[:32], AES.MODE_CBC, iv)
+    request = testing.DummyRequest()
+    request.json_body = {
+        'iv': iv.encode('base64'),
+        'notification': cipher.encrypt(payload).encode('base64'),
+    }
+    return request
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='bin/py benchmarks/bench_ipn_parsing.py')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    testing.setUp(settings={
+        'bimt.jvzoo_secret_key': SECRET,
+        'bimt.clickbank_secret_key': SECRET,
+    })
+    for name, provider, request in (
+        ('jvzoo', JVZooProvider(), jvzoo_request()),
+        ('clickbank', ClickbankProvider(), clickbank_request()),
+    ):
+        params = provider.parse(request)
+        assert params.email == 'john.smith@email.com', params.email
+
+        start = time.time()
+        for i in xrange(args.iterations):
+            provider.parse(request)
+        duration = time.time() - start
+        print '{:>10}: {:.3f} s, {:8.1f} requests/s, {:.1f} us/request'.format(  # noqa
+            name,
+            duration,
+            args.iterations / duration,
+            duration / args.iterations * 1e6,
+        )
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Benchmark rendering a mailing for many recipients.
+
+Renders a mailing for synthetic users, first the way ``Mailing.send`` used
+to (body written to a temporary template and compiled for every recipient,
+then ``email.pt`` rendered around it), then with a ``MailingRenderer`` per
+recipient and finally with a single ``MailingRenderer`` shared by all
+recipients, as bulk sends do. The first two compile the body for every
+message, which is slow, so they only render the first ``--baseline-users``
+users; compare milliseconds per message.
+
+    bin/py benchmarks/bench_mailing_render.py --users 10000
+"""
+
+from pyramid import testing
+from pyramid.renderers import render
+from pyramid_bimt import add_routes_user
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import MailingRenderer
+from pyramid_bimt.models import User
+
+import argparse
+import tempfile
+import time
+
+BODY = u'''
+<p>Your account ${user.email} is valid until ${user.valid_to}.</p>
+<p>Visit <a href="${request.application_url}">${settings['bimt.app_title']}
+</a> to renew it.</p>
+'''
+
+
+def render_single_pass(mailing, request, user):
+    with tempfile.NamedTemporaryFile(suffix='.pt') as body_template:
+        body_template.write(mailing.body.encode('utf-8'))
+        body_template.seek(0)
+        params = {
+            'request': request,
+            'user': user,
+            'settings': request.registry.settings,
+            'password': None,
+            'unsubscribe_url': request.route_url('user_unsubscribe'),
+        }
+        params['body'] = render(body_template.name, params)
+        return (
+            mailing.subject.format(**params),
+            render('pyramid_bimt:templates/email.pt', params),
+        )
+
+
+def render_per_message(mailing, request, user):
+    return MailingRenderer(mailing, request)(user)
+
+
+def render_shared(mailing, request, users):
+    renderer = MailingRenderer(mailing, request)
+    for user in users:
+        renderer(user)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='bin/py benchmarks/bench_mailing_render.py')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--baseline-users', type=int, default=200)
+    args = parser.parse_args()
+
+    request = testing.DummyRequest()
+    config = testing.setUp(
+        request=request, settings={'bimt.app_title': 'BIMT'})
+    config.include('pyramid_chameleon')
+    add_routes_user(config)
+
+    mailing = Mailing(
+        name='bench',
+        subject=u'{user.fullname}, your account expires soon',
+        body=BODY,
+        exclude_groups=[Group(name='unsubscribed')],
+    )
+    users = [
+        User(email='user{}@bar.com'.format(i), fullname=u'Üser {}'.format(i))
+        for i in range(args.users)
+    ]
+
+    for name, count, run in (
+        ('single pass', args.baseline_users, lambda users: [
+            render_single_pass(mailing, request, u) for u in users]),
+        ('per message', args.baseline_users, lambda users: [
+            render_per_message(mailing, request, u) for u in users]),
+        ('shared', args.users, lambda users: render_shared(
+            mailing, request, users)),
+    ):
+        start = time.time()
+        run(users[:count])
+        duration = time.time() - start
+        print '{:>12}: {:6} messages, {:.3f} ms/message, {:8.1f} messages/s'.format(  # noqa
+            name, count, duration * 1000 / count, count / duration)
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
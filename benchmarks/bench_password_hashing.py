@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Benchmark password verification (logins per second) under concurrency.
+
+Simulates concurrent logins by verifying a password from several threads,
+first with hashing in the calling threads and then with hashing offloaded
+to a pool of worker processes.
+
+    bin/py benchmarks/bench_password_hashing.py --threads 8 --logins 200
+"""
+
+from pyramid_bimt.security import configure_hashing
+from pyramid_bimt.security import encrypt
+from pyramid_bimt.security import verify
+from threading import Thread
+
+import argparse
+import multiprocessing
+import time
+
+
+def logins_per_second(threads, logins, cyphertext):
+    """Verify ``logins`` passwords from ``threads`` threads."""
+    per_thread = logins // threads
+
+    def login():
+        for i in range(per_thread):
+            assert verify('secret', cyphertext)
+
+    workers = [Thread(target=login) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='bin/py benchmarks/bench_password_hashing.py')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument(
+        '--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--rounds', type=int, default=90000)
+    args = parser.parse_args()
+
+    for processes in (0, args.processes):
+        service = configure_hashing({
+            'bimt.password_rounds': args.rounds,
+            'bimt.password_hashing_processes': processes,
+        })
+        cyphertext = encrypt('secret')
+        rate = logins_per_second(args.threads, args.logins, cyphertext)
+        print '{:>2} processes: {:8.1f} logins/s'.format(processes, rate)  # noqa
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
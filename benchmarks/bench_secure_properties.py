@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Benchmark secure-property round-trips for bulk API-key rotation.
+
+Creates users with an encrypted ``api_key`` property in an in-memory SQLite
+DB and re-encrypts all keys with a new AES key, first user by user through
+``User.get_property``/``User.set_property`` and then in bulk with
+``decrypt_many``/``encrypt_many``.
+
+    bin/py benchmarks/bench_secure_properties.py --users 2000
+"""
+
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.models import User
+from pyramid_bimt.models import UserProperty
+from pyramid_bimt.security import get_symmetric_encryption
+from pyramid_bimt.testing import initTestingDB
+
+import argparse
+import time
+
+OLD_KEY = 'abcdabcdabcdabcd'
+NEW_KEY = 'dcbadcbadcbadcba'
+
+
+def populate(users):
+    enc = get_symmetric_encryption(OLD_KEY)
+    for i in range(users):
+        Session.add(User(
+            email='user{}@bar.com'.format(i),
+            properties=[UserProperty(
+                key='api_key',
+                value=unicode(enc.encrypt('1234-5678-{:04}'.format(i))),
+            )],
+        ))
+    Session.flush()
+
+
+def rotate_per_user(config):
+    users = User.query.all()
+    settings = config.registry.settings
+    for user in users:
+        settings['bimt.encryption_aes_16b_key'] = OLD_KEY
+        api_key = user.get_property('api_key', secure=True)
+        settings['bimt.encryption_aes_16b_key'] = NEW_KEY
+        user.set_property('api_key', api_key, secure=True)
+    Session.flush()
+
+
+def rotate_bulk():
+    props = UserProperty.query.filter_by(key='api_key').all()
+    values = get_symmetric_encryption(OLD_KEY).decrypt_many(
+        [p.value for p in props])
+    for prop, value in zip(
+            props, get_symmetric_encryption(NEW_KEY).encrypt_many(values)):
+        prop.value = unicode(value)
+    Session.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='bin/py benchmarks/bench_secure_properties.py')
+    parser.add_argument('--users', type=int, default=2000)
+    args = parser.parse_args()
+
+    config = testing.setUp(
+        settings={'bimt.encryption_aes_16b_key': OLD_KEY})
+    for name, rotate in (
+        ('per user', lambda: rotate_per_user(config)),
+        ('bulk', rotate_bulk),
+    ):
+        initTestingDB()
+        populate(args.users)
+        start = time.time()
+        rotate()
+        duration = time.time() - start
+        print '{:>10}: {:.3f} s, {:8.1f} keys/s'.format(  # noqa
+            name, duration, args.users / duration)
+        Session.remove()
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Benchmark app startup: importing pyramid_bimt, ``includeme`` and ``main``.
+
+Each run starts a fresh interpreter, so imports are not cached between runs,
+and reports the median of each phase. With ``--imports`` it also prints a
+``python -X importtime`` style report of the slowest imports of one run,
+with self and cumulative time per module.
+
+    bin/py benchmarks/bench_startup.py --runs 5 --imports 20
+"""
+
+import __builtin__
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+SETTINGS = {
+    'authtkt.secret': 'secret',
+    'bimt.app_name': 'bimt',
+    'bimt.app_title': 'BIMT',
+    'bimt.disabled_user_redirect_path': '/',
+    'bimt.encryption_aes_16b_key': 'abcdabcdabcdabcd',
+    'bimt.referral_url': '',
+    'bimt.affiliate_text': '',
+    'script_location': '',
+    'session.encrypt_key': 'secret',
+    'session.key': 'bimt',
+    'session.secret': 'secret',
+    'session.type': 'cookie',
+    'session.validate_key': 'secret',
+    'sqlalchemy.url': 'sqlite://',
+}
+
+
+class ImportTimer(object):
+    """Record self and cumulative time of each newly imported module."""
+
+    def __init__(self):
+        self.times = {}
+        self._stack = []
+        self._import = __builtin__.__import__
+
+    def __call__(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self._import(name, *args, **kwargs)
+        self._stack.append(0)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            cumulative = time.time() - start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += cumulative
+            if name in sys.modules and name not in self.times:
+                self.times[name] = (cumulative - children, cumulative)
+
+    def __enter__(self):
+        __builtin__.__import__ = self
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._import
+
+
+def child(imports):
+    """Measure startup phases in this (fresh) interpreter."""
+    timer = ImportTimer()
+    phases = {}
+    with timer:
+        start = time.time()
+        import pyramid_bimt
+        phases['import'] = time.time() - start
+
+        from pyramid.config import Configurator
+        start = time.time()
+        pyramid_bimt.includeme(Configurator(settings=dict(SETTINGS)))
+        phases['includeme'] = time.time() - start
+
+        start = time.time()
+        pyramid_bimt.main({}, **SETTINGS)
+        phases['main'] = time.time() - start
+
+    print json.dumps({  # noqa
+        'phases': phases,
+        'imports': sorted(
+            timer.times.items(), key=lambda i: i[1][1], reverse=True,
+        )[:imports],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='bin/py benchmarks/bench_startup.py')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument(
+        '--imports', type=int, default=0,
+        help='Print this many slowest imports.')
+    parser.add_argument('--child', action='store_true', help='internal')
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.imports)
+
+    results = [
+        json.loads(subprocess.check_output([
+            sys.executable, __file__, '--child',
+            '--imports', str(args.imports),
+        ]))
+        for i in range(args.runs)
+    ]
+    for phase in ('import', 'includeme', 'main'):
+        durations = sorted(r['phases'][phase] for r in results)
+        print '{:>10}: {:.3f} s median, {:.3f} s min'.format(  # noqa
+            phase, durations[len(durations) // 2], durations[0])
+
+    if args.imports:
+        print '\n{:>10} {:>10}  module'.format('self', 'cumulative')  # noqa
+        for name, (own, cumulative) in results[-1]['imports']:
+            print '{:>8.1f}ms {:>8.1f}ms  {}'.format(  # noqa
+                own * 1000, cumulative * 1000, name)
+
+
+if __name__ == '__main__':
+    main()
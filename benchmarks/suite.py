@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite of the hot paths, with baselines and regression checks.
+
+Fills a database with ``generate_data`` and calls each hot path many times,
+every call in its own transaction that is aborted afterwards, like a
+request. For every benchmark it reports latency percentiles, the number of
+SQL queries per call and the net number of objects a call allocates
+(GC-tracked objects that are still alive when it returns, Python 2 has no
+``tracemalloc``), medians of all calls.
+
+Save results as a baseline, then compare later runs against it; the suite
+exits with status 1 if the median latency or allocated objects of any
+benchmark grew by more than ``--threshold`` or if it makes more queries::
+
+    bin/py benchmarks/suite.py --save benchmarks/baseline.json
+    bin/py benchmarks/suite.py --compare benchmarks/baseline.json
+
+Baselines are only comparable on the same machine and with the same
+``--users``. Run a subset with e.g. ``--only datatables``.
+"""
+
+from Crypto.Cipher import AES
+from datetime import date
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt import configure
+from pyramid_bimt.acl import groupfinder
+from pyramid_bimt.hooks import get_authenticated_user
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import MailingRenderer
+from pyramid_bimt.models import Portlet
+from pyramid_bimt.models import PortletPositions
+from pyramid_bimt.models import User
+from pyramid_bimt.sanitycheck import run_all_checks
+from pyramid_bimt.scripts.expire_subscriptions import expire_subscriptions
+from pyramid_bimt.scripts.generate_data import generate_data
+from pyramid_bimt.security import encrypt
+from pyramid_bimt.security import verify
+from pyramid_bimt.testing import initTestingDB
+from pyramid_bimt.views.auditlog import AuditLogAJAX
+from pyramid_bimt.views.ipn import IPNView
+from pyramid_bimt.views.user import UserListAJAX
+from pyramid_mailer import get_mailer
+from sqlalchemy import event
+
+import argparse
+import gc
+import hashlib
+import json
+import math
+import re
+import sys
+import timeit
+import transaction
+
+SECRET = 'secret'
+
+SETTINGS = {
+    'bimt.app_title': 'BIMT',
+    'bimt.jvzoo_secret_key': SECRET,
+    'bimt.clickbank_secret_key': SECRET,
+    'bimt.encryption_aes_16b_key': 'abcdabcdabcdabcd',
+    'mail.default_sender': 'admin@bimt.com',
+}
+
+#: functions that take the suite's environment and yield ``Case``s
+SUITE = []
+
+
+def suite(setup):
+    """Register a function that sets up benchmarks."""
+    SUITE.append(setup)
+    return setup
+
+
+class Case(object):
+    """A benchmark: ``run(i)`` is timed, ``before(i)`` and ``after()`` are
+    called around it, untimed."""
+
+    def __init__(
+        self, name, run, iterations=200, warmup=3, before=None, after=None,
+    ):
+        self.name = name
+        self.run = run
+        self.iterations = iterations
+        self.warmup = warmup
+        self.before = before
+        self.after = after
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted ``values``."""
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+def measure(case, scale=1.0):
+    """Call a benchmark repeatedly, return its statistics."""
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    engine = Session.get_bind()
+    event.listen(engine, 'before_cursor_execute', record)
+
+    latencies = []
+    query_counts = []
+    objects = []
+    try:
+        for i in range(-case.warmup, max(int(case.iterations * scale), 1)):
+            if case.before:
+                case.before(i)
+            del queries[:]
+            gc.collect()
+            gc.disable()
+            allocated = gc.get_count()[0]
+            start = timeit.default_timer()
+            case.run(i)
+            duration = timeit.default_timer() - start
+            allocated = gc.get_count()[0] - allocated
+            gc.enable()
+
+            transaction.abort()
+            if case.after:
+                case.after()
+            if i >= 0:
+                latencies.append(duration * 1000)
+                query_counts.append(len(queries))
+                objects.append(allocated)
+    finally:
+        gc.enable()
+        event.remove(engine, 'before_cursor_execute', record)
+
+    latencies.sort()
+    return {
+        'iterations': len(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+        'queries': percentile(sorted(query_counts), 50),
+        'objects': percentile(sorted(objects), 50),
+    }
+
+
+def regressions(results, baseline, threshold):
+    """Compare results to a baseline, return descriptions of regressions."""
+    found = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            found.append('{}: {} queries, baseline {}'.format(
+                name, result['queries'], base['queries']))
+        for key, unit in (('p50', 'ms'), ('objects', 'objects')):
+            if result[key] > base[key] + abs(base[key]) * threshold:
+                found.append('{}: {:.3f} {} ({}), baseline {:.3f}'.format(
+                    name, result[key], unit, key, base[key]))
+    return found
+
+
+def _offsets(count):
+    return [offset for offset in (0, 100, 1000, 10000, 100000)
+            if offset < count]
+
+
+@suite
+def auth(env):
+    emails = env['emails']
+
+    def find_groups(i):
+        groupfinder(emails[i % len(emails)], env['request'])
+
+    yield Case('groupfinder', find_groups, 1000)
+
+    request = testing.DummyRequest()
+    yield Case(
+        'get_authenticated_user',
+        lambda i: get_authenticated_user(request),
+        1000,
+    )
+
+
+@suite
+def portlets(env):
+    emails = env['emails']
+
+    def by_user_and_position(i):
+        user = User.by_email(emails[i % len(emails)])
+        Portlet.by_user_and_position(user, PortletPositions.below_sidebar.name)
+
+    yield Case('portlet_by_user_and_position', by_user_and_position, 500)
+
+
+@suite
+def datatables(env):
+    for name, view, count in (
+        ('users', UserListAJAX, env['counts'].get('users', 0)),
+        ('audit_log', AuditLogAJAX,
+         env['counts'].get('audit_log_entries', 0)),
+    ):
+        for offset in _offsets(count):
+            def call(i, view=view, offset=offset):
+                request = testing.DummyRequest(params={
+                    'iDisplayStart': str(offset),
+                    'iDisplayLength': '10',
+                    'sEcho': '1',
+                })
+                request.user = User.by_id(1)
+                view(request)()
+
+            yield Case(
+                'datatables_{}_offset_{}'.format(name, offset), call, 100)
+
+
+def _jvzoo_request(i, email):
+    post = {
+        'ccustname': 'John Smith',
+        'ccustemail': email,
+        'cproditem': '1',
+        'ctransaction': 'SALE',
+        'ctransreceipt': 'jvzoo-{}'.format(i),
+        'ctransaffiliate': 'affiliate@email.com',
+        'ctransamount': '4700',
+        'ctranstime': '1388400000',
+        'cvendthru': '',
+    }
+    values = [value for key, value in sorted(post.items())] + [SECRET]
+    post['cverify'] = hashlib.sha1(
+        '|'.join(values)).hexdigest()[:8].upper()
+    return testing.DummyRequest(post=post)
+
+
+def _clickbank_request(i, email):
+    payload = json.dumps({
+        'receipt': 'clickbank-{}'.format(i),
+        'transactionType': 'SALE',
+        'affiliate': 'aff',
+        'lineItems': [{'itemNo': '1', 'productTitle': 'Monthly'}],
+        'customer': {'billing': {'fullName': 'John Smith', 'email': email}},
+    })
+    padding = 16 - len(payload) % 16
+    payload += chr(padding) * padding
+    iv = '27CD0D0CA9379D32'
+    cipher = AES.new(
+        hashlib.sha1(SECRET).hexdigest()[:32], AES.MODE_CBC, iv)
+    request = testing.DummyRequest()
+    request.json_body = {
+        'iv': iv.encode('base64'),
+        'notification': cipher.encrypt(payload).encode('base64'),
+    }
+    return request
+
+
+@suite
+def ipn(env):
+    """SALE notifications of existing users."""
+    emails = env['emails']
+    for name, make_request in (
+        ('jvzoo', _jvzoo_request),
+        ('clickbank', _clickbank_request),
+    ):
+        requests = []
+
+        def prepare(i, make_request=make_request):
+            request = make_request(i, emails[i % len(emails)])
+            request.registry = env['config'].registry
+            requests[:] = [request]
+
+        def call(i, name=name):
+            assert getattr(IPNView(requests[0]), name)() == 'Done.'
+
+        yield Case('ipn_{}'.format(name), call, 200, before=prepare)
+
+
+@suite
+def mailing(env):
+    with transaction.manager:
+        mailing_id = Mailing.by_name('welcome_email').id
+    emails = env['emails']
+    outbox = get_mailer(env['request']).outbox
+
+    def send(i):
+        mailing = Mailing.by_id(mailing_id)
+        mailing.send(User.by_email(emails[i % len(emails)]))
+
+    def clear_outbox():
+        del outbox[:]
+
+    yield Case('mailing_send', send, 200, after=clear_outbox)
+
+    renderers = {}
+
+    def send_shared(i):
+        mailing = Mailing.by_id(mailing_id)
+        if 'renderer' not in renderers:
+            renderers['renderer'] = MailingRenderer(mailing, env['request'])
+        mailing.send(
+            User.by_email(emails[i % len(emails)]),
+            renderer=renderers['renderer'],
+        )
+
+    yield Case(
+        'mailing_send_shared_renderer', send_shared, 1000, after=clear_outbox)
+
+
+@suite
+def scripts(env):
+    yield Case(
+        'expire_subscriptions', lambda i: expire_subscriptions(), 3, warmup=1)
+    yield Case(
+        'run_all_checks',
+        lambda i: run_all_checks(env['request']),
+        3,
+        warmup=1,
+    )
+
+
+@suite
+def security(env):
+    cyphertext = encrypt('secret')
+    yield Case('encrypt', lambda i: encrypt('secret'), 10, warmup=1)
+    yield Case(
+        'verify', lambda i: verify('secret', cyphertext), 10, warmup=1)
+
+
+def setup_environment(users, url):
+    request = testing.DummyRequest()
+    config = testing.setUp(request=request, settings=SETTINGS)
+    config.include('pyramid_mailer.testing')
+    configure(config, SETTINGS)
+    config.testing_securitypolicy(userid='admin@bar.com', permissive=True)
+
+    initTestingDB(
+        url=url, auditlog_types=True, groups=True, users=True,
+        mailings=True, portlets=True,
+    )
+    counts = generate_data(
+        users=users,
+        groups=max(users // 1000, 5),
+        properties=users * 2,
+        audit_entries=users * 10,
+        portlets=max(users // 1000, 5),
+        mailings=max(users // 1000, 5),
+        # users are (in)valid today, as in production
+        until=date.today(),
+        chunk_size=50000,
+    )
+    with transaction.manager:
+        Session.add(Group(
+            name='monthly', product_id='1', validity=31, trial_validity=7))
+        emails = [email for email, in Session.query(User.email).filter(
+            User.email.like('user%@example.com')).order_by(User.id)]
+    return {
+        'config': config,
+        'request': request,
+        'counts': counts,
+        # spread over all users, so popular and rare data is included
+        'emails': emails[::max(len(emails) // 1000, 1)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(usage='bin/py benchmarks/suite.py')
+    parser.add_argument(
+        '--users', type=int, default=10000,
+        help='Number of generated users, other volumes scale with it.')
+    parser.add_argument(
+        '--url', default='sqlite:///:memory:',
+        help='Database URL, should point to an empty database.')
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='Multiply the number of iterations of all benchmarks.')
+    parser.add_argument(
+        '--only', default='', help='Run benchmarks matching this regex.')
+    parser.add_argument('--save', help='Write results to this JSON file.')
+    parser.add_argument(
+        '--compare', help='Compare results to this JSON baseline.')
+    parser.add_argument(
+        '--threshold', type=float, default=0.25,
+        help='Allowed relative growth of latency and allocations.')
+    args = parser.parse_args()
+
+    env = setup_environment(args.users, args.url)
+    print '{:<36} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}'.format(  # noqa
+        'benchmark', 'calls', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'queries', 'objects')
+
+    results = {}
+    for setup in SUITE:
+        for case in setup(env):
+            if not re.search(args.only, case.name):
+                continue
+            result = results[case.name] = measure(case, args.scale)
+            print '{:<36} {iterations:>6} {p50:>9.3f} {p90:>9.3f} {p99:>9.3f} {max:>9.3f} {queries:>7} {objects:>8}'.format(  # noqa
+                case.name, **result)
+    testing.tearDown()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        for regression in found:
+            print 'REGRESSION {}'.format(regression)  # noqa
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[
+        'Chameleon',
         'ColanderAlchemy',
         'Paste',
         'SQLAlchemy',
@@ -6,6 +6,7 @@ from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
 from pyramid.security import NO_PERMISSION_REQUIRED
 from pyramid.settings import asbool
+from pyramid.tweens import MAIN
 from pyramid_basemodel import Session
 from pyramid_beaker import session_factory_from_settings
 from pyramid_bimt import sanitycheck
@@ -17,16 +18,20 @@ from pyramid_bimt.acl import PortletFactory
 from pyramid_bimt.acl import RootFactory
 from pyramid_bimt.acl import UserFactory
 from pyramid_bimt.acl import groupfinder
+from pyramid_bimt.amqp import kill_connections  # noqa
+from pyramid_bimt.amqp import kill_connections_in_background
+from pyramid_bimt.clickbank import configure_clickbank
 from pyramid_bimt.const import Modes
+from pyramid_bimt.forwarding import configure_forwarding
 from pyramid_bimt.hooks import get_authenticated_user
+from pyramid_bimt.security import configure_encryption
+from pyramid_bimt.security import configure_hashing
 from sqlalchemy import engine_from_config
 
 import deform
 import logging
 import pkg_resources
-import requests
 import sys
-import urllib
 
 logger = logging.getLogger('init')
 
@@ -68,6 +73,17 @@ REQUIRED_SETTINGS_PRODUCTION = [
     'mail.username',
 ]
 
+#: Modules (and packages) with venusian decorators, scanned by ``configure``.
+#: Scanning only these, instead of the whole package, keeps ``task``
+#: (celery, raven) and ``scripts`` from being imported on app start.
+SCAN_MODULES = [
+    'pyramid_bimt.hooks',
+    'pyramid_bimt.layout',
+    'pyramid_bimt.models.mailing',
+    'pyramid_bimt.sanitycheck',
+    'pyramid_bimt.views',
+]
+
 
 def add_routes_auth(config):
     config.add_route('login', '/login/')
@@ -145,6 +161,7 @@ def add_routes_mailing(config):
 def add_routes_other(config):
     config.add_route('jvzoo', '/jvzoo/')
     config.add_route('clickbank', '/clickbank/')
+    config.add_route('ipn_provider', '/ipn/{provider}/')
     config.add_route('raise_js_error', '/raise-error/js/')
     config.add_route('raise_http_error', '/raise-error/{error_code}/')
     config.add_route('config', '/config/')
@@ -182,26 +199,18 @@ def register_utilities(config):
         name='check_users_enabled_disabled'
     )
 
-
-def kill_connections(username=None, password=None, apiurl=None):
-    try:
-        r = requests.get(
-            '{}/api/connections'.format(apiurl),
-            auth=(username, password)
-        )
-        assert r.status_code == 200
-
-        for connection_dict in r.json():
-            name = urllib.quote(connection_dict['name'])
-            requests.delete(
-                '{}/api/connections/{}'.format(apiurl, name),
-                auth=(username, password),
-                headers={'X-Reason': 'Auto-kill on app start'}
-            )
-
-    except Exception as ex:  # catch everything
-        # do not allow errors in this function to stop startup of application
-        logger.warning(str(ex))
+    # register IPN providers, by dotted name so that importing this package
+    # does not import the IPN views
+    config.registry.registerUtility(
+        config.maybe_dotted('pyramid_bimt.views.ipn.JVZooProvider'),
+        config.maybe_dotted('pyramid_bimt.views.ipn.IIPNProvider'),
+        name='jvzoo'
+    )
+    config.registry.registerUtility(
+        config.maybe_dotted('pyramid_bimt.views.ipn.ClickbankProvider'),
+        config.maybe_dotted('pyramid_bimt.views.ipn.IIPNProvider'),
+        name='clickbank'
+    )
 
 
 def add_custom_deform_templates():
@@ -245,27 +254,42 @@ def configure(config, settings={}):
     # register ZCA utilities
     register_utilities(config)
 
+    # setup password hashing cost and worker processes
+    configure_hashing(settings)
+
+    # setup encryption of secure properties
+    configure_encryption(settings)
+
+    # setup background forwarding of IPN requests
+    configure_forwarding(settings)
+
+    # setup the shared Clickbank API client
+    configure_clickbank(settings)
+
     add_custom_deform_templates()
 
+    # count SQL queries of sampled requests, including those run on commit
+    config.add_tween(
+        'pyramid_bimt.querystats.query_stats_tween_factory',
+        over=('pyramid_tm.tm_tween_factory', MAIN),
+    )
+
     # enable views that we need in Robot tests
-    ignores = ['pyramid_bimt.tests']
+    scan = list(SCAN_MODULES)
     if asbool(settings.get('robot_testing', 'false')):  # pragma: no cover
         config.add_route('ping', '/ping/')
         config.add_route('robot_commands', '/robot/{command}')
         config.add_tween('pyramid_bimt.testing.inject_js_errorlogger')
         config.add_tween('pyramid_bimt.testing.log_notfound')
-    else:
-        ignores.append('pyramid_bimt.testing')
+        scan.append('pyramid_bimt.testing')
 
-    # Run a venusian scan to pick up the declarative configuration.
-    config.scan('pyramid_bimt', ignore=ignores)
+    # Run a venusian scan of modules with declarative configuration.
+    for module in scan:
+        config.scan(module)
 
-    if settings.get('bimt.kill_cloudamqp_connections'):  # pragma: no cover
-        kill_connections(
-            username=settings.get('bimt.amqp_username', ''),
-            password=settings.get('bimt.amqp_password', ''),
-            apiurl=settings.get('bimt.amqp_apiurl', '')
-        )
+    # kill stale AMQP connections without delaying startup
+    if settings.get('bimt.kill_cloudamqp_connections'):
+        kill_connections_in_background(settings)
 
 
 def check_required_settings(config):
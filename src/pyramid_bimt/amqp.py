@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Kill stale CloudAMQP connections when the app starts."""
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
+import logging
+import requests
+import threading
+import time
+import urllib
+
+logger = logging.getLogger(__name__)
+
+
+def kill_connections(
+    username=None,
+    password=None,
+    apiurl=None,
+    timeout=30,
+    workers=8,
+    request_timeout=5,
+):
+    """Close all connections listed by the RabbitMQ management API.
+
+    Connections are deleted concurrently by ``workers`` threads over a
+    single pooled ``requests.Session``. Each request is limited to
+    ``request_timeout`` seconds and the whole run to ``timeout`` seconds,
+    connections that are not deleted by then are left open.
+
+    Errors are logged and never raised, so they do not stop the app from
+    starting.
+
+    :param timeout: Seconds after which remaining connections are skipped.
+    :type timeout: float
+    :param workers: Number of concurrent DELETE requests.
+    :type workers: int
+    :param request_timeout: Seconds to wait for a single response.
+    :type request_timeout: float
+
+    :return: tuple of (number of killed connections, number of connections)
+    :rtype: tuple
+    """
+    start = time.time()
+    deadline = start + timeout
+    killed = total = 0
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=workers))
+    session.mount('https://', HTTPAdapter(pool_maxsize=workers))
+
+    def remaining():
+        return max(deadline - time.time(), 0)
+
+    def delete(name):
+        if not remaining():
+            return False
+        r = session.delete(
+            '{}/api/connections/{}'.format(apiurl, urllib.quote(name)),
+            auth=(username, password),
+            headers={'X-Reason': 'Auto-kill on app start'},
+            timeout=min(request_timeout, remaining()),
+        )
+        return r.ok
+
+    def delete_logged(name):
+        try:
+            return delete(name)
+        except Exception as ex:  # catch everything
+            logger.warning(u'Killing AMQP connection {} failed: {}'.format(
+                name, ex))
+            return False
+
+    try:
+        r = session.get(
+            '{}/api/connections'.format(apiurl),
+            auth=(username, password),
+            timeout=request_timeout,
+        )
+        assert r.status_code == 200
+        names = [connection['name'] for connection in r.json()]
+        total = len(names)
+
+        pool = ThreadPool(min(workers, total) or 1)
+        try:
+            results = pool.imap_unordered(delete_logged, names)
+            for i in range(total):
+                killed += results.next(remaining())
+        except TimeoutError:
+            logger.warning(
+                'Gave up killing AMQP connections after {} seconds.'.format(
+                    timeout))
+        finally:
+            pool.terminate()
+
+    except Exception as ex:  # catch everything
+        # do not allow errors in this function to stop startup of application
+        logger.warning(str(ex))
+    finally:
+        session.close()
+
+    logger.info('Killed {} of {} AMQP connections in {:.2f} seconds.'.format(
+        killed, total, time.time() - start))
+    return killed, total
+
+
+def kill_connections_in_background(settings):
+    """Run ``kill_connections`` in a daemon thread, so startup is not delayed.
+
+    * ``bimt.amqp_username``, ``bimt.amqp_password`` and
+      ``bimt.amqp_apiurl``: management API credentials and URL,
+    * ``bimt.amqp_kill_timeout``: seconds after which remaining connections
+      are left open, default 30,
+    * ``bimt.amqp_kill_workers``: number of concurrent DELETE requests,
+      default 8.
+
+    :return: the started thread
+    :rtype: threading.Thread
+    """
+    thread = threading.Thread(
+        target=kill_connections,
+        kwargs=dict(
+            username=settings.get('bimt.amqp_username', ''),
+            password=settings.get('bimt.amqp_password', ''),
+            apiurl=settings.get('bimt.amqp_apiurl', ''),
+            timeout=float(settings.get('bimt.amqp_kill_timeout', 30)),
+            workers=int(settings.get('bimt.amqp_kill_workers', 8)),
+        ),
+        name='kill-amqp-connections',
+    )
+    thread.daemon = True
+    thread.start()
+    return thread
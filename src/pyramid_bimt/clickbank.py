@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 """Clickbank API."""
 
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
+from requests.adapters import HTTPAdapter
+from threading import Lock
+
+import os
 import requests
+import time
+
+#: response status codes of GET requests that are retried
+RETRY_STATUSES = (500, 502, 503, 504)
 
 
 class ClickbankException(Exception):
@@ -11,23 +20,106 @@ class ClickbankException(Exception):
 
 
 class ClickbankAPI(object):
+    """Client for the Clickbank REST API.
+
+    Requests are sent over a pooled ``requests.Session`` that keeps
+    connections to Clickbank alive between requests. Each attempt is limited
+    to ``timeout`` seconds. GET requests that fail with a connection error,
+    a timeout or a 5xx response are retried ``retries`` times, waiting
+    ``backoff``, 2 * ``backoff``, ... seconds in between; POST requests are
+    never retried as they are not idempotent.
+
+    Latest receipts are cached for ``cache_ttl`` seconds, for at most
+    ``cache_size`` customers; the oldest entries are dropped first.
+
+    :param dev_key: Clickbank developer key.
+    :type dev_key: string
+    :param api_key: Clickbank clerk API key.
+    :type api_key: string
+    :param transport: Object with a ``requests.Session`` compatible
+        ``request`` method, a new pooled session by default.
+    :param api_endpoint: Base URL of the API, e.g. of a local fake server.
+    :type api_endpoint: string
+    :param timeout: Seconds to wait for Clickbank to respond.
+    :type timeout: float
+    :param retries: Number of retries after the first failed GET attempt.
+    :type retries: int
+    :param backoff: Seconds to wait before the first retry.
+    :type backoff: float
+    :param cache_ttl: Seconds to cache latest receipts for, 0 to disable.
+    :type cache_ttl: float
+    :param cache_size: Maximum number of cached receipts.
+    :type cache_size: int
+    """
+
     api_endpoint = 'https://api.clickbank.com/rest/1.3/'
 
-    def __init__(self, dev_key, api_key):
+    def __init__(
+        self,
+        dev_key,
+        api_key,
+        transport=None,
+        api_endpoint=None,
+        timeout=10,
+        retries=2,
+        backoff=0.5,
+        cache_ttl=60,
+        cache_size=1000,
+    ):
         self.dev_key = dev_key
         self.api_key = api_key
+        if api_endpoint:
+            self.api_endpoint = api_endpoint
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._transport = transport
+        self._session = None
+        self._pid = None
+        self._lock = Lock()
+        self._receipts = OrderedDict()
+        self._receipts_lock = Lock()
 
-    def _request(self, path, method='GET', params=None):
-        headers = {
+    @property
+    def transport(self):
+        """The transport, a new session is created in each forked process."""
+        if self._transport is not None:
+            return self._transport
+        with self._lock:
+            if self._pid != os.getpid():
+                self._session = requests.Session()
+                self._session.mount('https://', HTTPAdapter())
+                self._session.mount('http://', HTTPAdapter())
+                self._pid = os.getpid()
+            return self._session
+
+    def _request(self, path, method='GET', params=None, headers=None):
+        headers = dict(headers or {}, **{
             'Accept': 'application/json',
             'Authorization': '{}:{}'.format(self.dev_key, self.api_key)
-        }
-        return requests.request(
-            method,
-            self.api_endpoint + path,
-            headers=headers,
-            params=params,
-        )
+        })
+        retries = self.retries if method == 'GET' else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.transport.request(
+                    method,
+                    self.api_endpoint + path,
+                    headers=headers,
+                    params=params,
+                    timeout=self.timeout,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < retries:
+                continue
+            return response
+        raise ClickbankException(
+            'Clickbank request {} {} failed: {}'.format(method, path, error))
 
     def _get_date(self, response):
         date = datetime.strptime(response['date'][:-6], '%Y-%m-%dT%H:%M:%S')
@@ -38,8 +130,35 @@ class ClickbankAPI(object):
             date = date - timezone_hours
         return date
 
+    def _cached_receipt(self, key):
+        with self._receipts_lock:
+            cached = self._receipts.get(key)
+            if cached and cached[0] > time.time():
+                return cached[1]
+
+    def _cache_receipt(self, key, receipt):
+        now = time.time()
+        with self._receipts_lock:
+            self._receipts.pop(key, None)
+            # entries are kept in the order they expire in, drop expired
+            # ones and then the oldest ones over the size limit
+            while self._receipts and (
+                    next(self._receipts.itervalues())[0] <= now or
+                    len(self._receipts) >= self.cache_size):
+                self._receipts.popitem(last=False)
+            self._receipts[key] = (now + self.cache_ttl, receipt)
+
+    def _forget_receipt(self, key):
+        with self._receipts_lock:
+            self._receipts.pop(key, None)
+
     def get_user_latest_receipt(self, email, product):
         """Return user's latest ClickBank receipt."""
+        key = (email, product)
+        cached = self._cached_receipt(key)
+        if cached:
+            return cached
+
         response = self._request(
             'orders/list',
             params={'item': product, 'email': email}
@@ -56,20 +175,103 @@ class ClickbankAPI(object):
         else:  # pragma: no cover
             raise ValueError('Unknown response type {}: {}'.format(
                 type(orders), orders))
-        return latest_order['receipt']
 
-    def change_user_subscription(self, email, existing_product, new_product):
+        receipt = latest_order['receipt']
+        if self.cache_ttl and self.cache_size:
+            self._cache_receipt(key, receipt)
+        return receipt
+
+    def list_orders(self, **params):
+        """Yield pages of orders matching the ``orders/list`` params.
+
+        Clickbank returns 100 orders per page and responds with
+        ``206 Partial Content`` while there are more pages.
+
+        :return: generator of lists of order dicts
+        """
+        page = 1
+        while True:
+            response = self._request(
+                'orders/list', params=params, headers={'Page': str(page)})
+            if not response.ok:
+                raise ClickbankException('Clickbank error: {}'.format(
+                    response.content or response.status_code))
+            data = response.json() if response.content else None
+            if data:
+                orders = data['orderData']
+                yield orders if isinstance(orders, list) else [orders]
+            if response.status_code != 206:
+                return
+            page += 1
+
+    def change_user_subscription(
+        self, email, existing_product, new_product, receipt=None,
+    ):
         """Change user's subscription.
 
+        The receipt is looked up with ``get_user_latest_receipt`` unless it
+        is given, e.g. from the synced ``ClickbankReceipt`` table.
+
         Return the number of changed user's receipt.
         """
-        receipt = self.get_user_latest_receipt(email, existing_product)
+        if receipt is None:
+            receipt = self.get_user_latest_receipt(email, existing_product)
+        self._forget_receipt((email, existing_product))
         response = self._request(
             'orders/{}/changeProduct'.format(receipt),
             method='POST',
             params={'oldSku': existing_product, 'newSku': new_product}
         )
-        if response.content:
-            raise ClickbankException(
-                'Clickbank error: {}'.format(response.content))
+        if response.content or not response.ok:
+            raise ClickbankException('Clickbank error: {}'.format(
+                response.content or response.status_code))
         return receipt
+
+
+def parse_date(value):
+    """Parse a Clickbank timestamp, e.g. ``2014-12-18T01:53:59-08:00``.
+
+    :return: naive datetime in UTC
+    :rtype: datetime.datetime
+    """
+    date = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    offset = timedelta(hours=int(value[20:22]), minutes=int(value[23:25]))
+    if value[19] == '+':
+        return date - offset
+    return date + offset
+
+
+_api = ClickbankAPI(None, None)
+
+
+def configure_clickbank(settings):
+    """Configure the shared Clickbank API client from app settings.
+
+    * ``bimt.clickbank_dev_key`` and ``bimt.clickbank_api_key``: API
+      credentials,
+    * ``bimt.clickbank_timeout``: seconds to wait for a response, default 10,
+    * ``bimt.clickbank_retries``: retries after a failed GET attempt,
+      default 2,
+    * ``bimt.clickbank_backoff``: seconds to wait before the first retry,
+      doubled for each following retry, default 0.5,
+    * ``bimt.clickbank_cache_ttl``: seconds to cache latest receipts for,
+      default 60,
+    * ``bimt.clickbank_cache_size``: maximum number of cached receipts,
+      default 1000.
+    """
+    global _api
+    _api = ClickbankAPI(
+        settings.get('bimt.clickbank_dev_key'),
+        settings.get('bimt.clickbank_api_key'),
+        timeout=float(settings.get('bimt.clickbank_timeout', 10)),
+        retries=int(settings.get('bimt.clickbank_retries', 2)),
+        backoff=float(settings.get('bimt.clickbank_backoff', 0.5)),
+        cache_ttl=float(settings.get('bimt.clickbank_cache_ttl', 60)),
+        cache_size=int(settings.get('bimt.clickbank_cache_size', 1000)),
+    )
+    return _api
+
+
+def get_clickbank_api():
+    """Return the configured ``ClickbankAPI``."""
+    return _api
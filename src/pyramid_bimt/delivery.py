@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Send mailings to all their recipients in the background."""
+
+from pyramid.request import Request
+from pyramid.threadlocal import get_current_request
+from pyramid.threadlocal import manager
+from pyramid_bimt.locking import LockTimeout
+from pyramid_bimt.locking import lock
+from pyramid_bimt.models import MailingDelivery
+from pyramid_bimt.models import MailingDeliveryStatuses
+from pyramid_bimt.models import MailingRenderer
+from pyramid_bimt.models import Session
+from sqlalchemy.orm import joinedload
+from threading import Lock
+from threading import Thread
+
+import logging
+import transaction
+
+logger = logging.getLogger(__name__)
+
+#: ids of mailings that threads of this process are sending
+_sending = set()
+_sending_lock = Lock()
+
+
+def _send_batch(mailing_id, batch_size):
+    """Send the next batch of pending deliveries in its own transaction.
+
+    Delivery statuses are committed together with the emails of the batch,
+    so a crashed send continues with the first batch that did not commit.
+
+    :return: tuple of (number of sent, number of failed deliveries), None
+        if there are no pending deliveries
+    :rtype: tuple
+    """
+    with transaction.manager:
+        lock(u'mailing:{}'.format(mailing_id))
+        deliveries = MailingDelivery.query.options(
+            joinedload('mailing'),
+            joinedload('user'),
+        ).filter_by(
+            mailing_id=mailing_id,
+            status=MailingDeliveryStatuses.pending.name,
+        ).order_by(MailingDelivery.user_id).limit(batch_size).all()
+        if not deliveries:
+            return None
+
+        sent = failed = 0
+        renderer = None
+        for delivery in deliveries:
+            try:
+                if renderer is None:
+                    renderer = MailingRenderer(
+                        delivery.mailing, get_current_request())
+                delivery.mailing.send(delivery.user, renderer=renderer)
+                delivery.status = MailingDeliveryStatuses.sent.name
+                sent += 1
+            except Exception as e:
+                logger.exception(e)
+                delivery.status = MailingDeliveryStatuses.failed.name
+                delivery.error = u'{}'.format(e)
+                failed += 1
+    return sent, failed
+
+
+def deliver_mailing(mailing_id, request, batch_size=100):
+    """Send pending deliveries of a mailing, ``batch_size`` at a time.
+
+    Batches are committed one by one and progress is logged after each of
+    them. Sending stops when no deliveries are pending, when another worker
+    is sending the same mailing or when a batch fails to commit, e.g.
+    because the mail server is down; in that case run it again later to
+    continue.
+
+    :param mailing_id: Id of the ``Mailing`` to send.
+    :type mailing_id: int
+    :param request: Request used to render emails.
+    :type request: pyramid.request.Request
+    :param batch_size: Number of emails to send in one transaction.
+    :type batch_size: int
+
+    :return: tuple of (number of sent, number of failed deliveries)
+    :rtype: tuple
+    """
+    manager.push({'request': request, 'registry': request.registry})
+    sent = failed = 0
+    try:
+        while True:
+            try:
+                result = _send_batch(mailing_id, batch_size)
+            except LockTimeout:
+                logger.info(
+                    'Mailing {} is being sent by another worker.'.format(
+                        mailing_id))
+                break
+            except Exception as e:
+                logger.exception(e)
+                break
+            if result is None:
+                break
+            sent += result[0]
+            failed += result[1]
+            logger.info('Mailing {}: {} sent, {} failed.'.format(
+                mailing_id, sent, failed))
+    finally:
+        manager.pop()
+        Session.remove()
+    return sent, failed
+
+
+def send_in_background(mailing_id, request, batch_size=100):
+    """Run ``deliver_mailing`` in a daemon thread.
+
+    The thread renders emails with a new request for the application URL of
+    ``request``, as the original request ends before sending is done.
+
+    :return: the started thread, None if a thread of this process is already
+        sending the mailing
+    :rtype: threading.Thread
+    """
+    with _sending_lock:
+        if mailing_id in _sending:
+            return None
+        _sending.add(mailing_id)
+
+    job_request = Request.blank('/', base_url=request.application_url)
+    job_request.registry = request.registry
+
+    def send():
+        try:
+            deliver_mailing(mailing_id, job_request, batch_size)
+        finally:
+            with _sending_lock:
+                _sending.discard(mailing_id)
+
+    thread = Thread(target=send, name='mailing-{}'.format(mailing_id))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _after_commit(success, mailing_id, request, batch_size):
+    if success:
+        send_in_background(mailing_id, request, batch_size)
+
+
+def send_mailing(mailing, request):
+    """Queue all recipients of a mailing, send it once the transaction commits.
+
+    Set ``bimt.mailing_batch_size`` to the number of emails sent in one
+    transaction, default 100.
+
+    :return: number of pending deliveries
+    :rtype: int
+    """
+    pending = mailing.queue_deliveries()
+    batch_size = int(request.registry.settings.get(
+        'bimt.mailing_batch_size', 100))
+    transaction.get().addAfterCommitHook(
+        _after_commit, args=(mailing.id, request, batch_size))
+    return pending
+
+
+def pending_mailing_ids():
+    """Return ids of mailings with pending deliveries, e.g. after a crash."""
+    return [id for id, in Session.query(MailingDelivery.mailing_id).filter_by(
+        status=MailingDeliveryStatuses.pending.name,
+    ).distinct().order_by(MailingDelivery.mailing_id)]
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Forward IPN requests to ``Group.forward_ipn_to_url`` in the background."""
+
+from Queue import Queue
+from pyramid_bimt.models import IPNForward
+from pyramid_bimt.models import Session
+from requests.adapters import HTTPAdapter
+from threading import BoundedSemaphore
+from threading import Lock
+from threading import Thread
+from urlparse import urlparse
+
+import json
+import logging
+import os
+import requests
+import time
+import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class IPNForwarder(object):
+    """Deliver forwarded IPN requests from a pool of worker threads.
+
+    Requests are sent over a shared ``requests.Session`` so connections to
+    the same target are reused. Each attempt is limited to ``timeout``
+    seconds and failed attempts are retried ``retries`` times, waiting
+    ``backoff``, 2 * ``backoff``, 4 * ``backoff``, ... seconds in between.
+    At most ``per_target`` requests are sent to the same host at any time.
+
+    Forwards that still fail stay in the ``ipn_forwards`` table, use the
+    ``retry_ipn_forwards`` script to deliver them later.
+
+    Worker threads are started lazily in the process that first uses them,
+    so it is safe to configure the forwarder before the WSGI server forks
+    its workers.
+
+    :param workers: Number of worker threads.
+    :type workers: int
+    :param timeout: Seconds to wait for the target to respond.
+    :type timeout: float
+    :param retries: Number of retries after the first failed attempt.
+    :type retries: int
+    :param backoff: Seconds to wait before the first retry.
+    :type backoff: float
+    :param per_target: Maximum number of concurrent requests to one host.
+    :type per_target: int
+    """
+
+    def __init__(
+        self,
+        workers=2,
+        timeout=10,
+        retries=3,
+        backoff=1.0,
+        per_target=2,
+    ):
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.per_target = per_target
+        self._queue = None
+        self._session = None
+        self._pid = None
+        self._lock = Lock()
+        self._targets = {}
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                adapter = HTTPAdapter(pool_maxsize=self.workers)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+                self._queue = Queue()
+                for i in range(self.workers):
+                    thread = Thread(
+                        target=self._work,
+                        args=(self._queue, ),
+                        name='ipn-forwarder-{}'.format(i),
+                    )
+                    thread.daemon = True
+                    thread.start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def _work(self, queue):
+        while True:
+            forward_id = queue.get()
+            try:
+                if forward_id is None:
+                    return
+                self.deliver(forward_id)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                Session.remove()
+                queue.task_done()
+
+    def _target_slots(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._targets:
+                self._targets[host] = BoundedSemaphore(self.per_target)
+            return self._targets[host]
+
+    def submit(self, forward_id):
+        """Queue an ``IPNForward`` for delivery by a worker thread."""
+        self._start().put(forward_id)
+
+    def join(self):
+        """Wait until all queued forwards are processed."""
+        self._start().join()
+
+    def close(self):
+        """Stop worker threads once they process already queued forwards."""
+        with self._lock:
+            if self._pid == os.getpid():
+                for i in range(self.workers):
+                    self._queue.put(None)
+            self._pid = None
+
+    def post(self, url, params):
+        """POST params to url, retrying with backoff on failure.
+
+        :return: None on success, error message if all attempts failed
+        :rtype: unicode
+        """
+        self._start()
+        error = None
+        with self._target_slots(url):
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    response = self._session.post(
+                        url, params=params, timeout=self.timeout)
+                    response.raise_for_status()
+                    return None
+                except requests.RequestException as e:
+                    error = u'{}'.format(e)
+                    logger.warning(u'IPN re-post to {} failed: {}'.format(
+                        url, error))
+        return error
+
+    def deliver(self, forward_id):
+        """Deliver an ``IPNForward`` and remove it if it succeeded.
+
+        :return: True if the forward was delivered, False otherwise
+        :rtype: bool
+        """
+        with transaction.manager:
+            forward = IPNForward.by_id(forward_id)
+            if not forward:
+                return True  # already delivered
+            url, params = forward.url, json.loads(forward.params)
+
+        error = self.post(url, params)
+
+        with transaction.manager:
+            query = Session.query(IPNForward).filter_by(id=forward_id)
+            if error is None:
+                query.delete()
+                logger.info('IPN re-posted to {}.'.format(url))
+            else:
+                query.update({
+                    'attempts': IPNForward.attempts + 1,
+                    'last_error': error,
+                })
+                logger.error(u'Giving up re-posting IPN to {}: {}'.format(
+                    url, error))
+        return error is None
+
+
+_forwarder = IPNForwarder()
+
+
+def configure_forwarding(settings):
+    """Configure the IPN forwarder from app settings.
+
+    * ``bimt.ipn_forward_workers``: number of worker threads, default 2,
+    * ``bimt.ipn_forward_timeout``: seconds to wait for a response,
+      default 10,
+    * ``bimt.ipn_forward_retries``: retries after a failed attempt,
+      default 3,
+    * ``bimt.ipn_forward_backoff``: seconds to wait before the first retry,
+      doubled for each following retry, default 1,
+    * ``bimt.ipn_forward_per_target``: maximum number of concurrent
+      requests to one host, default 2.
+    """
+    global _forwarder
+    _forwarder.close()
+    _forwarder = IPNForwarder(
+        workers=int(settings.get('bimt.ipn_forward_workers', 2)),
+        timeout=float(settings.get('bimt.ipn_forward_timeout', 10)),
+        retries=int(settings.get('bimt.ipn_forward_retries', 3)),
+        backoff=float(settings.get('bimt.ipn_forward_backoff', 1)),
+        per_target=int(settings.get('bimt.ipn_forward_per_target', 2)),
+    )
+    return _forwarder
+
+
+def get_forwarder():
+    """Return the configured ``IPNForwarder``."""
+    return _forwarder
+
+
+def _after_commit(success, forward_id):
+    if success:
+        _forwarder.submit(forward_id)
+
+
+def forward_ipn(url, params):
+    """Forward IPN params to url once the current transaction commits.
+
+    The forward is stored in the ``ipn_forwards`` table as part of the
+    current transaction, so it is never sent for an IPN that failed, and is
+    never lost if the worker fails to deliver it.
+
+    :param url: URL to POST the IPN params to.
+    :type url: string
+    :param params: IPN params, as a list of (key, value) tuples
+    :type params: list
+
+    :return: the new forward
+    :rtype: pyramid_bimt.models.IPNForward
+    """
+    forward = IPNForward(url=url, params=unicode(json.dumps(params)))
+    Session.add(forward)
+    Session.flush()
+    transaction.get().addAfterCommitHook(_after_commit, args=(forward.id, ))
+    return forward
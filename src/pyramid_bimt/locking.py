@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Serialise concurrent transactions that modify the same records."""
+
+from pyramid_bimt.models import Session
+from sqlalchemy import func
+from sqlalchemy import select
+from threading import Lock
+from threading import local
+from transaction.interfaces import TransientError
+
+import time
+import transaction
+import zlib
+
+#: number of in-process locks that keys are spread over
+STRIPES = 64
+
+_stripes = [Lock() for i in range(STRIPES)]
+_held = local()
+
+
+class LockTimeout(TransientError):
+    """A lock was not acquired in time.
+
+    This is a ``TransientError`` so ``IPNView`` retries the IPN, and
+    ``pyramid_tm`` retries other requests when ``tm.attempts`` is greater
+    than 1.
+    """
+
+
+class StripeLocks(object):
+    """Data manager that holds in-process locks until the transaction ends.
+
+    It does not store anything, it only releases the locks acquired by
+    ``lock`` once the transaction is committed or aborted.
+    """
+
+    transaction_manager = transaction.manager
+
+    def __init__(self, txn):
+        self.transaction = txn
+        self.stripes = set()
+
+    def acquire(self, stripe, timeout):
+        if stripe in self.stripes:
+            return
+        deadline = time.time() + timeout
+        while not _stripes[stripe].acquire(False):
+            if time.time() > deadline:
+                raise LockTimeout(
+                    'Lock not acquired in {} seconds.'.format(timeout))
+            time.sleep(0.005)
+        self.stripes.add(stripe)
+
+    def release(self):
+        for stripe in self.stripes:
+            _stripes[stripe].release()
+        self.stripes.clear()
+
+    def abort(self, txn):
+        # also called when the transaction is rolled back to a savepoint
+        # taken before the locks joined it, they are not joined anymore then
+        self.release()
+        self.transaction = None
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        self.release()
+
+    def tpc_abort(self, txn):
+        self.release()
+
+    def sortKey(self):
+        return 'pyramid_bimt.locking'
+
+
+def _stripe_locks():
+    txn = transaction.get()
+    locks = getattr(_held, 'locks', None)
+    if locks is None or locks.transaction is not txn:
+        locks = _held.locks = StripeLocks(txn)
+        txn.join(locks)
+    return locks
+
+
+def lock(key, timeout=10):
+    """Hold a lock on ``key`` until the current transaction ends.
+
+    Transactions that lock the same key run one after another, which
+    prevents lost updates when concurrent requests change the same records,
+    even records that do not exist yet.
+
+    On PostgreSQL this is a transaction level advisory lock, shared by all
+    processes using the database. Deadlocks are detected by PostgreSQL and
+    the failing transaction is retried by ``pyramid_tm``. Other databases
+    fall back to one of ``STRIPES`` locks in the current process.
+
+    :param key: Name of the locked resource, e.g. ``u'ipn:foo@bar.com'``.
+    :type key: unicode
+    :param timeout: Seconds to wait for an in-process lock before raising
+        ``LockTimeout``.
+    :type timeout: float
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    checksum = zlib.crc32(key)
+
+    session = Session()
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(select([func.pg_advisory_xact_lock(checksum)]))
+    else:
+        _stripe_locks().acquire(checksum % STRIPES, timeout)
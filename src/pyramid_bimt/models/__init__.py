@@ -57,15 +57,22 @@ class WorkflowMixin(object):
 
 from .auditlog import AuditLogEntry  # noqa
 from .auditlog import AuditLogEventType  # noqa
+from .clickbank import ClickbankReceipt  # noqa
 from .group import Group  # noqa
 from .group import GroupProperty  # noqa
 from .group import user_group_table  # noqa
+from .ipn import IPNForward  # noqa
+from .ipn import IPNTransaction  # noqa
 from .mailing import Mailing  # noqa
+from .mailing import MailingDelivery  # noqa
+from .mailing import MailingDeliveryStatuses  # noqa
+from .mailing import MailingRenderer  # noqa
 from .mailing import MailingTriggers  # noqa
 from .mailing import exclude_mailing_group_table  # noqa
 from .mailing import mailing_group_table  # noqa
 from .portlet import Portlet  # noqa
 from .portlet import PortletPositions  # noqa
+from .portlet import exclude_portlet_group_table  # noqa
 from .portlet import portlet_group_table  # noqa
 from .user import User  # noqa
 from .user import UserProperty  # noqa
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Clickbank models."""
+
+from datetime import datetime
+from pyramid_basemodel import Base
+from pyramid_basemodel import BaseMixin
+from pyramid_basemodel import Session
+from pyramid_bimt.clickbank import parse_date
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
+from sqlalchemy import String
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import func
+
+#: types of Clickbank orders in which the customer paid
+PAYMENT_TXN_TYPES = ('SALE', 'BILL')
+
+
+class ClickbankReceipt(Base, BaseMixin):
+    """A Clickbank order, synced from the Clickbank order history.
+
+    Orders are fetched in the background by the
+    :func:`sync_clickbank_receipts
+    <pyramid_bimt.scripts.sync_clickbank_receipts.sync_clickbank_receipts>`
+    script, so that upgrades find a customer's latest receipt with an
+    indexed query instead of fetching all their orders from Clickbank.
+    """
+
+    __tablename__ = 'clickbank_receipts'
+    __table_args__ = (
+        UniqueConstraint('receipt', 'txn_type', name='receipt_txn_type'),
+        Index(
+            'ix_clickbank_receipts_email_product_date',
+            'email',
+            'product',
+            'date',
+        ),
+    )
+
+    #: receipt number of the order
+    receipt = Column(
+        String,
+        nullable=False,
+    )
+
+    #: type of the order, for example 'SALE', 'BILL' or 'RFND'
+    txn_type = Column(
+        String,
+        nullable=False,
+    )
+
+    #: lower-cased email of the customer
+    email = Column(
+        String,
+        nullable=False,
+    )
+
+    #: Clickbank item number, same as ``Group.product_id``
+    product = Column(
+        String,
+        nullable=False,
+    )
+
+    #: time of the order, in UTC
+    date = Column(
+        DateTime,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        """Custom representation of the ClickbankReceipt object."""
+        return u'<{}:{} (receipt={}, txn_type={}, email={})>'.format(
+            self.__class__.__name__,
+            self.id,
+            repr(self.receipt),
+            repr(self.txn_type),
+            repr(self.email),
+        )
+
+    @classmethod
+    def latest(class_, email, product, since=None):
+        """Get the latest receipt number of a customer for a product.
+
+        Only payments (SALE and BILL orders) count, not refunds or
+        chargebacks.
+
+        :param since: ignore orders before this day, e.g. the customer's
+            ``last_payment``, so that an order the sync has not fetched yet
+            is never shadowed by an older one
+        :type since: datetime.date
+
+        :return: receipt number, None if there are no matching synced orders
+        :rtype: string
+        """
+        ClickbankReceipt = class_
+        query = Session.query(ClickbankReceipt.receipt).filter(
+            ClickbankReceipt.email == email.lower(),
+            ClickbankReceipt.product == u'{}'.format(product),
+            ClickbankReceipt.txn_type.in_(PAYMENT_TXN_TYPES),
+        )
+        if since:
+            query = query.filter(ClickbankReceipt.date >= datetime(
+                since.year, since.month, since.day))
+        row = query.order_by(ClickbankReceipt.date.desc()).first()
+        return row[0] if row else None
+
+    @classmethod
+    def watermark(class_):
+        """Time of the newest synced order, None if nothing is synced yet."""
+        return Session.query(func.max(class_.date)).scalar()
+
+    @classmethod
+    def ingest(class_, orders):
+        """Add or update receipts from a page of Clickbank orders.
+
+        Timestamps are parsed here, once per order, and existing receipts of
+        the page are loaded with a single query.
+
+        :param orders: order dicts as returned by ``ClickbankAPI.list_orders``
+        :type orders: list
+
+        :return: number of added receipts
+        :rtype: int
+        """
+        ClickbankReceipt = class_
+        existing = {}
+        receipts = set(order['receipt'] for order in orders)
+        if receipts:
+            for row in ClickbankReceipt.query.filter(
+                    ClickbankReceipt.receipt.in_(receipts)):
+                existing[(row.receipt, row.txn_type)] = row
+
+        added = 0
+        for order in orders:
+            key = (order['receipt'], order['txnType'])
+            row = existing.get(key)
+            if row is None:
+                row = existing[key] = ClickbankReceipt(
+                    receipt=order['receipt'], txn_type=order['txnType'])
+                Session.add(row)
+                added += 1
+            row.email = order['email'].lower()
+            row.product = order['item']
+            row.date = parse_date(order['date'])
+        Session.flush()
+        return added
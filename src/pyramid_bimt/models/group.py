@@ -6,9 +6,10 @@ from pyramid.security import Allow
 from pyramid.security import DENY_ALL
 from pyramid_basemodel import Base
 from pyramid_basemodel import BaseMixin
+from pyramid_basemodel import Session
 from pyramid_bimt.models import GetByIdMixin
 from pyramid_bimt.models import GetByNameMixin
-from pyramid_bimt.security import SymmetricEncryption
+from pyramid_bimt.security import get_symmetric_encryption
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
@@ -17,6 +18,7 @@ from sqlalchemy import String
 from sqlalchemy import Table
 from sqlalchemy import Unicode
 from sqlalchemy import UniqueConstraint
+from sqlalchemy import func
 from sqlalchemy.orm import relationship
 
 
@@ -209,7 +211,7 @@ class Group(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
                 return default
         value = result.one().value
         if secure:
-            return SymmetricEncryption().decrypt(value)
+            return get_symmetric_encryption().decrypt(value)
         else:
             return value
 
@@ -226,7 +228,7 @@ class Group(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
         :type strict: bool
         """
         if secure:
-            value = unicode(SymmetricEncryption().encrypt(value))
+            value = unicode(get_symmetric_encryption().encrypt(value))
         result = GroupProperty.query.filter_by(group_id=self.id, key=key)
         if result.count() < 1 and strict:
             raise KeyError('Property "{}" not found.'.format(key))
@@ -241,15 +243,34 @@ class Group(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
         return Group.query.filter_by(product_id=product_id).first()
 
     @classmethod
-    def get_all(class_, order_by='name', filter_by=None, limit=None):
+    def get_all(
+        class_,
+        order_by='name',
+        filter_by=None,
+        limit=None,
+        with_member_count=False,
+    ):
         """Return all groups.
 
         filter_by: dict -> {'name': 'foo'}
 
         By default, order by Group.name.
+
+        With ``with_member_count`` the query returns ``(group, count)``
+        tuples, the number of members of each group counted by a single
+        grouped query, without loading any users.
         """
         Group = class_
-        q = Group.query
+        if with_member_count:
+            q = Session.query(
+                Group,
+                func.count(user_group_table.c.user_id).label('member_count'),
+            ).outerjoin(
+                user_group_table,
+                user_group_table.c.group_id == Group.id,
+            ).reset_joinpoint().group_by(Group.id)
+        else:
+            q = Group.query
         q = q.order_by(getattr(Group, order_by))
         if filter_by:
             q = q.filter_by(**filter_by)
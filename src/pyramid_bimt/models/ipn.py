@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""IPN models."""
+
+from pyramid_basemodel import Base
+from pyramid_basemodel import BaseMixin
+from pyramid_basemodel import Session
+from pyramid_bimt.models import GetByIdMixin
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import Unicode
+from sqlalchemy import UniqueConstraint
+from sqlalchemy.sql import exists
+
+
+class IPNTransaction(Base, BaseMixin):
+    """A ledger of processed IPN transactions.
+
+    Payment providers retry notifications until they get a response, so the
+    same transaction can reach the app several times. Every processed
+    transaction is recorded here and the unique index on ``provider``,
+    ``trans_id`` and ``trans_type`` makes sure it is only processed once.
+    """
+
+    __tablename__ = 'ipn_transactions'
+    __table_args__ = (
+        UniqueConstraint(
+            'provider',
+            'trans_id',
+            'trans_type',
+            name='provider_trans_id_trans_type',
+        ),
+    )
+
+    #: name of the IPN provider, 'jvzoo' or 'clickbank'
+    provider = Column(
+        String,
+        nullable=False,
+    )
+
+    #: receipt number of the transaction
+    trans_id = Column(
+        String,
+        nullable=False,
+    )
+
+    #: type of the transaction, for example 'SALE' or 'BILL'
+    trans_type = Column(
+        String,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        """Custom representation of the IPNTransaction object."""
+        return u'<{}:{} (provider={}, trans_id={}, trans_type={})>'.format(
+            self.__class__.__name__,
+            self.id,
+            repr(self.provider),
+            repr(self.trans_id),
+            repr(self.trans_type),
+        )
+
+    @classmethod
+    def exists(class_, provider, trans_id, trans_type):
+        """Check if the given transaction has already been processed.
+
+        :return: True if the transaction is in the ledger, False otherwise
+        :rtype: bool
+        """
+        IPNTransaction = class_
+        return Session.query(exists().where(
+            (IPNTransaction.provider == provider) &
+            (IPNTransaction.trans_id == u'{}'.format(trans_id)) &
+            (IPNTransaction.trans_type == trans_type)
+        )).scalar()
+
+    @classmethod
+    def record(class_, provider, trans_id, trans_type):
+        """Add the given transaction to the ledger.
+
+        The row is flushed right away so that a concurrent request processing
+        the same transaction fails on the unique index before it touches any
+        users or groups.
+
+        :return: the new ledger entry
+        :rtype: IPNTransaction
+        """
+        transaction = class_(
+            provider=provider,
+            trans_id=u'{}'.format(trans_id),
+            trans_type=trans_type,
+        )
+        Session.add(transaction)
+        Session.flush()
+        return transaction
+
+
+class IPNForward(Base, BaseMixin, GetByIdMixin):
+    """An IPN request waiting to be forwarded to ``forward_ipn_to_url``.
+
+    Rows are added in the same transaction as the IPN they forward and
+    removed once the target accepts the request, see
+    :func:`pyramid_bimt.forwarding.forward_ipn`.
+    """
+
+    __tablename__ = 'ipn_forwards'
+
+    #: URL to POST the IPN params to
+    url = Column(
+        String,
+        nullable=False,
+    )
+
+    #: JSON-encoded list of IPN params
+    params = Column(
+        Unicode,
+        nullable=False,
+    )
+
+    #: number of failed deliveries
+    attempts = Column(
+        Integer,
+        default=0,
+        nullable=False,
+    )
+
+    #: error message of the last failed delivery
+    last_error = Column(
+        Unicode,
+    )
+
+    def __repr__(self):
+        """Custom representation of the IPNForward object."""
+        return u'<{}:{} (url={}, attempts={})>'.format(
+            self.__class__.__name__,
+            self.id,
+            repr(self.url),
+            repr(self.attempts),
+        )
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 """Mailing models."""
 
+from .group import user_group_table
+from .user import User
+from cgi import escape
+from chameleon import PageTemplate
 from flufl.enum import Enum
+from pyramid.events import BeforeRender
 from pyramid.events import subscriber
 from pyramid.renderers import render
 from pyramid.threadlocal import get_current_request
 from pyramid_basemodel import Base
 from pyramid_basemodel import BaseMixin
+from pyramid_basemodel import Session
 from pyramid_bimt.events import UserChangedPassword
 from pyramid_bimt.events import UserCreated
 from pyramid_bimt.events import UserDisabled
@@ -16,19 +22,28 @@ from pyramid_bimt.widgets import ChosenSelectWidget
 from pyramid_mailer import get_mailer
 from pyramid_mailer.message import Message
 from sqlalchemy import Column
+from sqlalchemy import Date
+from sqlalchemy import DateTime
 from sqlalchemy import Enum as SAEnum
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import Table
 from sqlalchemy import Unicode
 from sqlalchemy import UniqueConstraint
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import literal
 from sqlalchemy.orm import relationship
 
 import colander
+import datetime
 import deform
 import logging
-import tempfile
+import re
 
 
 logger = logging.getLogger(__name__)
@@ -162,6 +177,17 @@ class Mailing(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
         )},
     )
 
+    #: last day for which ``send_mailings`` sent this mailing to all users
+    processed_until = Column(
+        Date,
+    )
+
+    #: last user that ``send_mailings`` sent this mailing to on the day
+    #: after ``processed_until``, if it was interrupted
+    processed_user_id = Column(
+        Integer,
+    )
+
     def __repr__(self):
         """Custom representation of the Mailing object."""
         return u'<{}:{} (name={})>'.format(
@@ -172,33 +198,140 @@ class Mailing(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
         """False if exclude_groups contains group named unsubscribed."""
         return 'unsubscribed' not in [g.name for g in self.exclude_groups]
 
-    def send(self, recipient, password=None):
-        """Send the mailing to a recipient."""
+    def _member_of(self, table):
+        """EXISTS clause: user is in one of the groups linked by table."""
+        # id is read when the query runs, after a new mailing is flushed
+        mailing_id = bindparam(None, callable_=lambda: self.id, type_=Integer)
+        return exists().where(and_(
+            user_group_table.c.user_id == User.id,
+            user_group_table.c.group_id == table.c.group_id,
+            table.c.mailing_id == mailing_id,
+        ))
+
+    def recipients_query(self):
+        """Return a query of users that this mailing is sent to.
+
+        These are users in any of ``groups`` and in none of
+        ``exclude_groups``. Groups are matched with EXISTS/NOT EXISTS
+        subqueries on ``user_group``, so members of groups are never loaded
+        just to find recipients. Use ``.count()`` to count recipients and
+        :meth:`iter_recipients` to go through them.
+        """
+        return User.query.filter(
+            self._member_of(mailing_group_table),
+            ~self._member_of(exclude_mailing_group_table),
+        )
+
+    def iter_recipients(self, batch_size=500):
+        """Yield recipients ordered by id, loading ``batch_size`` at a time.
+
+        Batches are fetched with a keyset on ``User.id``, so memory use
+        does not grow with the number of recipients.
+        """
+        last_id = 0
+        while True:
+            batch = self.recipients_query().filter(
+                User.id > last_id).order_by(User.id).limit(batch_size).all()
+            for user in batch:
+                yield user
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+
+    def queue_deliveries(self):
+        """Add a pending ``MailingDelivery`` for every recipient.
+
+        Deliveries are added with a single INSERT ... SELECT. If deliveries
+        of a previous send are still pending, they are kept as they are, so
+        an interrupted send continues where it stopped. Otherwise the log of
+        the previous send is cleared and all recipients are queued again.
+
+        :return: number of pending deliveries
+        :rtype: int
+        """
+        Session.flush()
+        deliveries = Session.query(MailingDelivery).filter_by(
+            mailing_id=self.id)
+        pending = deliveries.filter_by(
+            status=MailingDeliveryStatuses.pending.name).count()
+        if pending:
+            return pending
+
+        deliveries.delete()
+        now = datetime.datetime.utcnow()
+        recipients = self.recipients_query().with_entities(
+            literal(self.id),
+            User.id,
+            literal(MailingDeliveryStatuses.pending.name),
+            literal(1),
+            literal(now, DateTime),
+            literal(now, DateTime),
+        )
+        table = MailingDelivery.__table__
+        Session.execute(table.insert().from_select(
+            ['mailing_id', 'user_id', 'status', 'v', 'c', 'm'],
+            recipients.statement,
+        ))
+        return deliveries.filter_by(
+            status=MailingDeliveryStatuses.pending.name).count()
+
+    def delivery_progress(self):
+        """Count deliveries of this mailing by status.
+
+        :return: map of status names to counts, empty if the mailing was
+            never sent with :meth:`queue_deliveries`
+        :rtype: dict
+        """
+        return dict(Session.query(
+            MailingDelivery.status,
+            func.count(MailingDelivery.id),
+        ).filter_by(mailing_id=self.id).group_by(MailingDelivery.status))
+
+    def send(self, recipient, password=None, renderer=None):
+        """Send the mailing to a recipient.
+
+        Pass a :class:`MailingRenderer` of this mailing when sending to many
+        recipients, so the templates are prepared only once.
+        """
         request = get_current_request()
         mailer = get_mailer(request)
+        if renderer is None:
+            renderer = MailingRenderer(self, request)
+
+        subject, html = renderer(recipient, password=password)
+        mailer.send(Message(
+            subject=subject,
+            recipients=[recipient.email, ],
+            html=html))
+        logger.info(u'Mailing "{}" sent to "{}".'.format(
+            self.name, recipient.email))
 
-        with tempfile.NamedTemporaryFile(suffix='.pt') as body_template:
-            assert type(self.body) is unicode, 'Mail body type must be unicode, not {}!'.format(type(self.body))  # noqa
-            body_template.write(self.body.encode('utf-8'))
-            body_template.seek(0)
-
-            params = {
-                'request': request,
-                'user': recipient,
-                'settings': request.registry.settings,
-                'password': password,
-                'unsubscribe_url': None if self.allow_unsubscribed else request.route_url('user_unsubscribe'),  # noqa
-            }
-
-            body = render(body_template.name, params)
-            params['body'] = body
-
-            mailer.send(Message(
-                subject=self.subject.format(**params),
-                recipients=[recipient.email, ],
-                html=render('pyramid_bimt:templates/email.pt', params)))
-            logger.info(u'Mailing "{}" sent to "{}".'.format(
-                self.name, recipient.email))
+    @classmethod
+    def get_all(
+        cls,
+        order_by='name',
+        filter_by=None,
+        limit=None,
+        options=None,
+    ):
+        """Return all Mailings.
+
+        filter_by: dict -> {'name': 'foo'}
+
+        options: list -> [subqueryload('groups')], relationship loading
+        options, to avoid lazy loading them for every mailing
+
+        By default, order by Mailing.name.
+        """
+        q = cls.query
+        q = q.order_by(getattr(Mailing, order_by))
+        if options:
+            q = q.options(*options)
+        if filter_by:
+            q = q.filter_by(**filter_by)
+        if limit:
+            q = q.limit(limit)
+        return q.all()
 
     @classmethod
     def by_trigger_name(self, trigger_name):
@@ -206,6 +339,151 @@ class Mailing(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
         return Mailing.query.filter_by(trigger=trigger_name).all()
 
 
+#: marks a slot in a pre-rendered email, filled in for every recipient
+_SLOT = u'\ue000{}\ue001'
+_SLOT_RE = re.compile(u'\ue000(.+?)\ue001')
+
+
+class _RecipientSlots(object):
+    """Stand-in recipient whose attributes render as slots."""
+
+    def __getattr__(self, name):
+        return _SLOT.format(u'user.' + name)
+
+
+class MailingRenderer(object):
+    """Render a mailing for many recipients.
+
+    Rendering is done in two phases. When the renderer is created, the body
+    template is compiled and the ``email.pt`` wrapper is rendered with
+    everything that is the same for all recipients: settings, the
+    unsubscribe URL and the footer. The recipient's fields and the body are
+    left as slots. For every recipient, only the compiled body is rendered
+    and the slots of the wrapper are filled in.
+
+    The body sees the same names as a template rendered with
+    ``pyramid.renderers.render``: renderer system values such as
+    ``request`` and ``context`` and globals added by ``BeforeRender``
+    subscribers. The wrapper is rendered once, so it gets the recipient's
+    fields as placeholders that must be output as they are.
+    """
+
+    def __init__(self, mailing, request):
+        assert type(mailing.body) is unicode, 'Mail body type must be unicode, not {}!'.format(type(mailing.body))  # noqa
+        self.mailing = mailing
+        self.body = PageTemplate(mailing.body)
+        self.params = {
+            'request': request,
+            'settings': request.registry.settings,
+            'unsubscribe_url': None if mailing.allow_unsubscribed else request.route_url('user_unsubscribe'),  # noqa
+        }
+        wrapper = render('pyramid_bimt:templates/email.pt', dict(
+            self.params,
+            user=_RecipientSlots(),
+            body=_SLOT.format(u'body'),
+        ), request=request)
+        #: text of the wrapper, every odd item is the name of a slot
+        self.parts = _SLOT_RE.split(wrapper)
+
+    def __call__(self, recipient, password=None):
+        """Render the mailing for a recipient.
+
+        :return: tuple of (subject, html)
+        :rtype: tuple
+        """
+        params = dict(self.params, user=recipient, password=password)
+        body = params['body'] = self._render_body(params)
+
+        html = []
+        for i, part in enumerate(self.parts):
+            if not i % 2:
+                html.append(part)
+            elif part == u'body':
+                html.append(body)
+            else:
+                value = getattr(recipient, part.split(u'.', 1)[1])
+                if value is not None:
+                    html.append(escape(unicode(value)))
+        return self.mailing.subject.format(**params), u''.join(html)
+
+    def _render_body(self, params):
+        """Render the compiled body the way ``render`` renders a template."""
+        request = params['request']
+        system = BeforeRender({
+            'view': None,
+            'renderer_name': 'mailing.pt',
+            'renderer_info': None,
+            'context': getattr(request, 'context', None),
+            'request': request,
+            'req': request,
+        }, params)
+        request.registry.notify(system)
+        system.update(params)
+        return self.body(**system)
+
+
+class MailingDeliveryStatuses(Enum):
+    """Statuses of a mailing delivery."""
+
+    pending = 'Pending'
+    sent = 'Sent'
+    failed = 'Failed'
+
+
+class MailingDelivery(Base, BaseMixin):
+    """A recipient of a mailing that is sent in the background.
+
+    Deliveries are queued by :meth:`Mailing.queue_deliveries` and processed
+    in batches by :func:`pyramid_bimt.delivery.deliver_mailing`, which marks
+    each of them as sent or failed.
+    """
+
+    __tablename__ = 'mailing_deliveries'
+    __table_args__ = (
+        UniqueConstraint('mailing_id', 'user_id', name='mailing_id_user_id'),
+        Index(
+            'ix_mailing_deliveries_mailing_id_status', 'mailing_id', 'status'),
+    )
+
+    mailing_id = Column(
+        Integer,
+        ForeignKey('mailings.id', onupdate='cascade', ondelete='cascade'),
+        nullable=False,
+    )
+    mailing = relationship('Mailing')
+
+    user_id = Column(
+        Integer,
+        ForeignKey('users.id', onupdate='cascade', ondelete='cascade'),
+        nullable=False,
+    )
+    user = relationship('User')
+
+    status = Column(
+        SAEnum(
+            *[s.name for s in MailingDeliveryStatuses],
+            name='mailing_delivery_statuses'
+        ),
+        nullable=False,
+        default=MailingDeliveryStatuses.pending.name,
+    )
+
+    #: why sending failed
+    error = Column(
+        Unicode,
+    )
+
+    def __repr__(self):
+        """Custom representation of the MailingDelivery object."""
+        return u'<{}:{} (mailing_id={}, user_id={}, status={})>'.format(
+            self.__class__.__name__,
+            self.id,
+            self.mailing_id,
+            self.user_id,
+            repr(self.status),
+        )
+
+
 @subscriber(UserCreated)
 def user_created_send_mailings(event):
     for mailing in Mailing.by_trigger_name(MailingTriggers.after_user_created.name):  # noqa
@@ -18,6 +18,7 @@ from sqlalchemy import Table
 from sqlalchemy import Unicode
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm import subqueryload
 
 import colander
 import deform
@@ -164,6 +165,7 @@ class Portlet(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
     def by_user_and_position(cls, user, position):
         """Get all portlets that are visible to a user."""
         portlets = Portlet.query.filter(Portlet.position == position) \
+            .options(subqueryload('groups'), subqueryload('exclude_groups')) \
             .order_by(Portlet.weight.desc())
 
         def any_group(groups1, groups2):
@@ -180,15 +182,27 @@ class Portlet(Base, BaseMixin, GetByIdMixin, GetByNameMixin):
         return shown_portlets
 
     @classmethod
-    def get_all(cls, order_by='position', filter_by=None, limit=None):
+    def get_all(
+        cls,
+        order_by='position',
+        filter_by=None,
+        limit=None,
+        options=None,
+    ):
         """Return all Portlets.
 
         filter_by: dict -> {'name': 'foo'}
 
-        By default, order by Portlet.position.
+        options: list -> [subqueryload('groups')], relationship loading
+        options, to avoid lazy loading them for every portlet
+
+        By default, order by Portlet.position, then by Portlet.weight,
+        highest first.
         """
         q = cls.query
-        q = q.order_by(getattr(Portlet, order_by))
+        q = q.order_by(getattr(Portlet, order_by), Portlet.weight.desc())
+        if options:
+            q = q.options(*options)
         if filter_by:
             q = q.filter_by(**filter_by)
         if limit:
@@ -11,14 +11,16 @@ from pyramid_basemodel import Base
 from pyramid_basemodel import BaseMixin
 from pyramid_basemodel import Session
 from pyramid_bimt.models import GetByIdMixin
-from pyramid_bimt.security import SymmetricEncryption
+from pyramid_bimt.security import get_symmetric_encryption
 from sqlalchemy import Column
 from sqlalchemy import Date
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import Unicode
 from sqlalchemy import UniqueConstraint
+from sqlalchemy import func
 from sqlalchemy import or_
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound
@@ -187,7 +189,7 @@ class User(Base, BaseMixin, GetByIdMixin):
                 return default
         value = result.one().value
         if secure:
-            return SymmetricEncryption().decrypt(value)
+            return get_symmetric_encryption().decrypt(value)
         else:
             return value
 
@@ -204,7 +206,7 @@ class User(Base, BaseMixin, GetByIdMixin):
         :type strict: bool
         """
         if secure:
-            value = unicode(SymmetricEncryption().encrypt(value))
+            value = unicode(get_symmetric_encryption().encrypt(value))
         result = UserProperty.query.filter_by(user_id=self.id, key=key)
         if result.count() < 1 and strict:
             raise KeyError('Property "{}" not found.'.format(key))
@@ -310,6 +312,31 @@ class User(Base, BaseMixin, GetByIdMixin):
         """Get a User by billing email."""
         return User.query.filter_by(billing_email=billing_email).first()
 
+    @classmethod
+    def by_any_email(self, email, for_update=False):
+        """Get a User by email or billing email, ignoring case.
+
+        Both columns are searched with one query that uses the lower-cased
+        email indexes. A match on email takes precedence over a match on
+        billing email.
+
+        Lock the matching rows until the transaction ends if ``for_update``.
+        """
+        if not isinstance(email, basestring):
+            return None
+        email = email.lower()
+        query = User.query.filter(or_(
+            func.lower(User.email) == email,
+            func.lower(User.billing_email) == email,
+        ))
+        if for_update:
+            query = query.with_for_update()
+        users = query.all()
+        for user in users:
+            if user.email.lower() == email:
+                return user
+        return users[0] if users else None
+
     @classmethod
     def get_all(
         class_,
@@ -353,3 +380,8 @@ class User(Base, BaseMixin, GetByIdMixin):
     def get_enabled(self):
         enabled = Group.by_name('enabled')
         return User.query.filter(User.groups.contains(enabled)).all()
+
+
+#: case-insensitive lookups in :meth:`User.by_any_email`
+Index('ix_users_email_lower', func.lower(User.email))
+Index('ix_users_billing_email_lower', func.lower(User.billing_email))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Count SQL queries and database time per request, to spot N+1 queries."""
+
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import local
+
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+_current = local()
+
+
+class QueryStats(object):
+    """SQL statements executed in a thread while stats are collected."""
+
+    def __init__(self):
+        #: number of executed statements
+        self.count = 0
+        #: seconds spent executing statements
+        self.duration = 0.0
+        #: number of executions of every statement, parameters ignored
+        self.statements = Counter()
+        self._start = None
+
+    def repeated(self, threshold=2):
+        """Return statements executed at least ``threshold`` times.
+
+        Statements that differ only in parameters count as the same, so
+        lazy loads in a loop show up as one often repeated statement.
+
+        :return: (statement, count) pairs, most repeated first
+        :rtype: list
+        """
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+
+def _before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None:
+        stats._start = time.time()
+
+
+def _after_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None and stats._start is not None:
+        stats.duration += time.time() - stats._start
+        stats._start = None
+        stats.count += 1
+        stats.statements[statement] += 1
+
+
+def _listen():
+    """Listen to statements of all engines, once per process."""
+    if not event.contains(
+            Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+@contextmanager
+def collect_query_stats():
+    """Collect stats of SQL statements executed in this thread in a block.
+
+    .. code-block:: python
+
+        with collect_query_stats() as stats:
+            User.get_all().all()
+        print stats.count, stats.duration
+
+    Statements executed in other threads are not counted.
+    """
+    _listen()
+    previous = getattr(_current, 'stats', None)
+    stats = _current.stats = QueryStats()
+    try:
+        yield stats
+    finally:
+        _current.stats = previous
+
+
+def query_stats_tween_factory(handler, registry):
+    """Count SQL queries and database time of sampled requests.
+
+    Set ``bimt.query_stats_sample_rate`` to the share of requests to collect
+    stats for, e.g. ``0.01`` for one in a hundred, or ``1`` for all of them
+    in development; by default it is ``0`` and the tween is left out.
+
+    Responses to sampled requests get ``X-DB-Queries``, ``X-DB-Time`` (in
+    milliseconds) and ``X-DB-Repeated`` headers and the numbers are logged,
+    also as ``db_queries``, ``db_time_ms`` and ``db_repeated`` attributes
+    of the log record. Statements executed at least
+    ``bimt.query_stats_repeated`` times (5 by default) in one request are
+    counted as repeated and logged as a warning, they usually come from
+    lazy loading relationships in a loop.
+    """
+    settings = registry.settings or {}
+    rate = float(settings.get('bimt.query_stats_sample_rate', 0))
+    if not rate:
+        return handler
+    threshold = int(settings.get('bimt.query_stats_repeated', 5))
+
+    def query_stats_tween(request):
+        if random.random() >= rate:
+            return handler(request)
+
+        with collect_query_stats() as stats:
+            response = handler(request)
+
+        repeated = stats.repeated(threshold)
+        duration = stats.duration * 1000
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['X-DB-Time'] = '{:.1f}'.format(duration)
+        response.headers['X-DB-Repeated'] = str(len(repeated))
+
+        logger.info(
+            '{} {} db_queries={} db_time_ms={:.1f} db_repeated={}'.format(
+                request.method, request.path, stats.count, duration,
+                len(repeated)),
+            extra={
+                'db_queries': stats.count,
+                'db_time_ms': duration,
+                'db_repeated': len(repeated),
+            },
+        )
+        for statement, count in repeated:
+            logger.warning(u'{} {} executed {} times: {}'.format(
+                request.method, request.path, count, statement))
+        return response
+
+    return query_stats_tween
@@ -1,19 +1,34 @@
 # -*- coding: utf-8 -*-
 """Regular checks if our data is sane."""
 
+from datetime import datetime
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from pyramid.httpexceptions import HTTPFound
+from pyramid.request import Request
+from pyramid.scripting import prepare
 from pyramid.view import view_config
+from pyramid_basemodel import Session
 from pyramid_bimt.const import BimtPermissions
 from pyramid_bimt.events import SanityCheckDone
 from pyramid_bimt.models import AuditLogEntry
 from pyramid_bimt.models import AuditLogEventType
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import User
+from pyramid_bimt.models import user_group_table
 from pyramid_bimt.static import app_assets
-from sqlalchemy.orm.exc import MultipleResultsFound
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import func
+from sqlalchemy import or_
 from zope.interface import Interface
 from zope.interface import implements
 
+import logging
+import threading
+import time
+import transaction
+
+logger = logging.getLogger(__name__)
+
 
 class ISanityCheck(Interface):
     """Definition class for all sanity checks."""
@@ -27,6 +42,24 @@ class ISanityCheck(Interface):
         pass
 
 
+class SanityCheckReport(object):
+    """Result of a single run of all sanity checks.
+
+    :param warnings: warnings found by all checks
+    :type warnings: list of strings
+    :param durations: number of seconds each check took, keyed by check name,
+        None if a check timed out
+    :type durations: dict
+    :param timestamp: UTC time when the run finished
+    :type timestamp: datetime
+    """
+
+    def __init__(self, warnings, durations, timestamp):
+        self.warnings = warnings
+        self.durations = durations
+        self.timestamp = timestamp
+
+
 @view_config(
     route_name='sanitycheck',
     permission=BimtPermissions.manage,
@@ -34,23 +67,172 @@ class ISanityCheck(Interface):
     renderer='pyramid_bimt:templates/sanitycheck.pt',
 )
 def sanitycheck_view(request):
-    """An admin view for manual sanity checks."""
+    """An admin view for manual sanity checks.
+
+    Serve the last cached report if there is one, otherwise run all checks
+    right away. Pass ``refresh`` in the query string to re-run checks in the
+    background.
+    """
     app_assets.need()
-    warnings = run_all_checks(request)
+    report = get_last_report(request.registry)
+
+    if 'refresh' in request.GET and report:
+        refresh_in_background(request)
+        request.session.flash(
+            u'Sanity check started, reload the page in a while to see '
+            'the new report.')
+        return HTTPFound(location=request.route_path('sanitycheck'))
+
+    if not report:
+        run_all_checks(request)
+        report = get_last_report(request.registry)
+
     return {
-        'warnings': warnings,
+        'warnings': report.warnings,
+        'durations': sorted(report.durations.items()),
+        'timestamp': report.timestamp,
     }
 
 
+def get_last_report(registry):
+    """Return the cached result of the last sanity check run, if any.
+
+    :rtype: SanityCheckReport or None
+    """
+    return getattr(registry, 'sanitycheck_report', None)
+
+
+def refresh_in_background(request):
+    """Run all sanity checks in a background thread.
+
+    The thread uses its own request, DB session and transaction, because
+    the given request is finished before the checks are. The result is
+    available through :func:`get_last_report` once the thread finishes.
+    """
+    registry = request.registry
+    application_url = request.application_url
+
+    def refresh():
+        env = prepare(
+            request=Request.blank('/', base_url=application_url),
+            registry=registry,
+        )
+        try:
+            with transaction.manager:
+                run_all_checks(env['request'])
+        except Exception as exc:  # catch everything
+            logger.exception(exc)
+        finally:
+            Session.remove()
+            env['closer']()
+
+    thread = threading.Thread(target=refresh, name='sanitycheck')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _check_name(check):
+    return getattr(check, '__name__', str(check))
+
+
+def _run_check(check):
+    """Run a single check and return its warnings and duration."""
+    start = time.time()
+    warnings = check()()
+    return warnings, time.time() - start
+
+
+class _PooledCheck(object):
+    """A check run in a pool thread, with a thread-local DB session."""
+
+    def __init__(self, check):
+        self.check = check
+        self.started = threading.Event()
+        self.start = None
+        self.cancelled = False
+
+    def __call__(self):
+        if self.cancelled:
+            return [], None
+        self.start = time.time()
+        self.started.set()
+        try:
+            return _run_check(self.check)
+        finally:
+            Session.remove()
+
+    def result(self, async_result, timeout):
+        """Wait for the check's warnings and duration, None if it timed out.
+
+        The check may wait ``timeout`` seconds for a free thread and then
+        run for ``timeout`` seconds. If it does not get a thread in time, it
+        is not started at all.
+        """
+        if not self.started.wait(timeout):
+            self.cancelled = True
+            return None
+        try:
+            return async_result.get(
+                max(self.start + timeout - time.time(), 0))
+        except TimeoutError:
+            return None
+
+
+def run_checks(registry):
+    """Run all registered sanity checks.
+
+    Checks run concurrently in a pool of ``bimt.sanitycheck_workers``
+    threads (``4`` by default), each check with its own DB session and
+    limited to ``bimt.sanitycheck_timeout`` seconds (``60`` by default).
+    Checks that time out are reported as failed and are left to finish in
+    the background. Set ``bimt.sanitycheck_workers`` to ``0`` to run checks
+    one after another in the current thread and DB session, without a
+    timeout, for example on an in-memory SQLite database that other threads
+    do not see.
+
+    :returns: sanitycheck report, also cached on the registry
+    :rtype: SanityCheckReport
+    """
+    settings = registry.settings or {}
+    workers = int(settings.get('bimt.sanitycheck_workers', 4))
+    timeout = float(settings.get('bimt.sanitycheck_timeout', 60))
+
+    checks = registry.getAllUtilitiesRegisteredFor(ISanityCheck)
+    warnings = []
+    durations = {}
+
+    if workers > 0:
+        pool = ThreadPool(min(workers, len(checks)) or 1)
+        pooled = [_PooledCheck(check) for check in checks]
+        results = [pool.apply_async(check) for check in pooled]
+        pool.close()
+        for check, async_result in zip(pooled, results):
+            result = check.result(async_result, timeout)
+            if result is None:
+                result = [
+                    'Sanity check {} timed out after {} seconds.'.format(
+                        _check_name(check.check), timeout)], None
+            warnings += result[0]
+            durations[_check_name(check.check)] = result[1]
+    else:
+        for check in checks:
+            check_warnings, duration = _run_check(check)
+            warnings += check_warnings
+            durations[_check_name(check)] = duration
+
+    report = SanityCheckReport(warnings, durations, datetime.utcnow())
+    registry.sanitycheck_report = report
+    return report
+
+
 def run_all_checks(request):
     """Find all sanity checks and run them.
 
     :returns: sanitycheck warnings
     :rtype: list of strings
     """
-    warnings = []
-    for check in request.registry.getAllUtilitiesRegisteredFor(ISanityCheck):
-        warnings += check()()
+    warnings = run_checks(request.registry).warnings
     if warnings:
         comment = u', '.join(warnings)
     else:
@@ -97,12 +279,17 @@ class CheckUsersProperties:
     implements(ISanityCheck)
 
     def __call__(self):
+        """Find users with an empty fullname in a single query."""
         warnings = []
-        for user in User.get_all():
-            if user.fullname is None or not user.fullname.strip():
-                warnings.append(
-                    'User {} ({}) has an empty fullname.'.format(
-                        user.email, user.id))
+        query = Session.query(User.id, User.email)\
+            .filter(or_(
+                User.fullname == None,  # noqa
+                func.trim(User.fullname) == u'',
+            ))\
+            .order_by(User.email)
+        for id_, email in query:
+            warnings.append(
+                'User {} ({}) has an empty fullname.'.format(email, id_))
 
         return warnings
 
@@ -111,16 +298,24 @@ class CheckUsersProductGroup:
     implements(ISanityCheck)
 
     def __call__(self):
+        """Find users with more than one product group in a single query.
+
+        Add-on groups are ignored, same as in
+        :attr:`User.product_group <pyramid_bimt.models.User.product_group>`.
+        """
         warnings = []
-        for user in User.get_all():
-            try:
-                user.product_group
-            except NoResultFound:
-                pass  # continue to next user
-            except MultipleResultsFound:
-                warnings.append(
-                    'User {} ({}) has multiple product groups.'.format(
-                        user.email, user.id))
+        query = Session.query(User.id, User.email)\
+            .join(user_group_table, user_group_table.c.user_id == User.id)\
+            .join(Group, Group.id == user_group_table.c.group_id)\
+            .filter(Group.addon == False)\
+            .filter(Group.product_id != None)\
+            .group_by(User.id, User.email)\
+            .having(func.count(Group.id) > 1)\
+            .order_by(User.email)  # noqa
+        for id_, email in query:
+            warnings.append(
+                'User {} ({}) has multiple product groups.'.format(
+                    email, id_))
 
         return warnings
 
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""Fill the DB with a large generated dataset for load and benchmark tests.
+
+Production-like volumes, in an empty database::
+
+    bin/py -m pyramid_bimt.scripts.generate_data etc/development.ini \
+        --users 500000 --groups 50 --properties 1000000 \
+        --audit-entries 20000000 --portlets 200 --mailings 50
+"""
+
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from pyramid_basemodel import Base
+from pyramid_basemodel import Session
+from pyramid_bimt.models import AuditLogEntry
+from pyramid_bimt.models import AuditLogEventType
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import MailingTriggers
+from pyramid_bimt.models import Portlet
+from pyramid_bimt.models import PortletPositions
+from pyramid_bimt.models import User
+from pyramid_bimt.models import UserProperty
+from pyramid_bimt.models import exclude_mailing_group_table
+from pyramid_bimt.models import exclude_portlet_group_table
+from pyramid_bimt.models import mailing_group_table
+from pyramid_bimt.models import portlet_group_table
+from pyramid_bimt.models import user_group_table
+from pyramid_bimt.scripts.populate import SECRET_ENC
+from pyramid_bimt.scripts.populate import add_audit_log_event_types
+from pyramid_bimt.scripts.populate import add_groups
+from pyramid_bimt.security import get_symmetric_encryption
+from sqlalchemy import func
+from sqlalchemy import text
+from zope.sqlalchemy import mark_changed
+
+import argparse
+import bisect
+import logging
+import random
+import sys
+import transaction
+
+logger = logging.getLogger(__name__)
+
+#: generated dates end on this day, so runs with the same seed are equal
+UNTIL = date(2015, 1, 1)
+
+FIRST_NAMES = [
+    u'Ana', u'Bob', u'Čedomir', u'Diana', u'Erik', u'Fatima', u'Gregor',
+    u'Hana', u'Ivan', u'Jože', u'Kim', u'Luka', u'Maja', u'Nina', u'Oscar',
+    u'Petra', u'Rok', u'Sara', u'Tomaž', u'Urška',
+]
+
+LAST_NAMES = [
+    u'Novak', u'Smith', u'Müller', u'Horvat', u'García', u'Kovač', u'Rossi',
+    u'Nguyen', u'Jensen', u'Ivanov', u'Zupan', u"O'Brien",
+]
+
+#: keys of user properties, the first ones are set for more users
+PROPERTY_KEYS = [
+    u'bimt', u'api_key', u'newsletter', u'timezone', u'referrer', u'theme',
+]
+
+#: how often each audit log event happens, compared to others (1)
+EVENT_WEIGHTS = {
+    'UserLoggedIn': 60,
+    'UserLoggedOut': 20,
+    'UserSubscriptionChanged': 5,
+    'UserChangedPassword': 3,
+}
+
+#: mailing triggers and how often they are used, compared to each other
+TRIGGER_WEIGHTS = [
+    (MailingTriggers.after_created.name, 5),
+    (MailingTriggers.after_last_payment.name, 3),
+    (MailingTriggers.before_valid_to.name, 3),
+    (MailingTriggers.never.name, 1),
+]
+
+
+class WeightedChoice(object):
+    """Pick items at random, proportionally to their weights."""
+
+    def __init__(self, rng, items, weights):
+        self.rng = rng
+        self.items = items
+        self.totals = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.totals.append(total)
+
+    def __call__(self):
+        return self.items[bisect.bisect(
+            self.totals, self.rng.random() * self.totals[-1])]
+
+
+class RowWriter(object):
+    """Insert rows with executemany, committing every ``chunk_size`` rows.
+
+    Tables are written in dependency order, so rows may reference rows that
+    were added to the writer before them.
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.rows = {}
+        self.pending = 0
+        #: number of inserted rows per table name
+        self.counts = {}
+
+    def add(self, table, **row):
+        self.rows.setdefault(table, []).append(row)
+        self.pending += 1
+        if self.pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        with transaction.manager:
+            for table in Base.metadata.sorted_tables:
+                rows = self.rows.pop(table, None)
+                if rows:
+                    Session.execute(table.insert(), rows)
+                    self.counts[table.name] = (
+                        self.counts.get(table.name, 0) + len(rows))
+            mark_changed(Session())
+        self.pending = 0
+        logger.info('Inserted {} rows.'.format(sum(self.counts.values())))
+
+
+def _next_id(model):
+    return (Session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _reset_sequences(tables):
+    """Move PostgreSQL id sequences past the ids that were inserted."""
+    with transaction.manager:
+        for table in tables:
+            Session.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "(SELECT max(id) FROM {0}))".format(table)))
+        mark_changed(Session())
+
+
+def _user(rng, now, ids, product, addons):
+    """Return a user's created datetime, subscription and group ids."""
+    until = now.date()
+    created = now - timedelta(
+        days=min(int(rng.expovariate(1 / 365.0)), 5 * 365),
+        seconds=rng.randint(0, 24 * 60 * 60 - 1),
+    )
+    status = rng.random()
+    if status < 0.1:  # on a trial
+        created = now - timedelta(days=rng.randint(0, 13))
+        last_payment = None
+        valid_to = created.date() + timedelta(days=14)
+        memberships = [ids['enabled'], ids['trial']]
+    else:
+        if status < 0.8:  # paying
+            last_payment = max(
+                until - timedelta(days=rng.randint(0, 30)), created.date())
+            valid_to = last_payment + timedelta(days=31)
+            memberships = [ids['enabled']]
+        else:  # expired
+            valid_to = max(
+                until - timedelta(days=rng.randint(1, 365)), created.date())
+            last_payment = None
+            if rng.random() < 0.5:
+                last_payment = valid_to - timedelta(days=31)
+            memberships = []
+        if product:
+            memberships.append(product())
+        if addons and rng.random() < 0.1:
+            memberships.append(rng.choice(addons))
+    if rng.random() < 0.05:
+        memberships.append(ids['unsubscribed'])
+    return created, valid_to, last_payment, memberships
+
+
+def _add_groups(writer, rng, first_id, count):
+    """Add product groups, return ids of products and of addons."""
+    products = []
+    addons = []
+    for i in range(first_id, first_id + count):
+        addon = rng.random() < 0.2
+        (addons if addon else products).append(i)
+        writer.add(
+            Group.__table__,
+            id=i,
+            name='product-{}'.format(i),
+            product_id='product-{}'.format(i),
+            validity=rng.choice([31, 31, 31, 365]),
+            trial_validity=rng.choice([0, 0, 7, 14]),
+            addon=addon,
+            forward_ipn_to_url=None,
+        )
+    return products, addons
+
+
+def _api_key(rng, encryption):
+    """Return a random API key, encrypted like a secure property."""
+    iv = '{:032x}'.format(rng.getrandbits(128)).decode('hex')
+    return unicode(encryption.encrypt(
+        '{:032x}'.format(rng.getrandbits(128)), iv=iv))
+
+
+def _add_users(writer, rng, now, ids, count, properties, products, addons):
+    encryption = get_symmetric_encryption()
+    product = None
+    if products:
+        # Zipf: the n-th most popular product has 1/n of the first's members
+        weights = [1.0 / rank for rank in range(1, len(products) + 1)]
+        product = WeightedChoice(rng, products, weights)
+
+    property_id = ids['property']
+    per_user = float(properties) / count if count else 0
+    for i in range(ids['user'], ids['user'] + count):
+        created, valid_to, last_payment, memberships = _user(
+            rng, now, ids, product, addons)
+        writer.add(
+            User.__table__,
+            id=i,
+            email='user{}@example.com'.format(i),
+            password=SECRET_ENC,
+            fullname=u'{} {}'.format(
+                rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+            affiliate=u'affiliate{}@example.com'.format(rng.randint(1, 100))
+            if rng.random() < 0.05 else None,
+            billing_email=None,
+            valid_to=valid_to,
+            last_payment=last_payment,
+            c=created,
+            m=created,
+        )
+        for group in memberships:
+            writer.add(user_group_table, user_id=i, group_id=group)
+
+        keys = int(per_user) + (rng.random() < per_user - int(per_user))
+        for key in PROPERTY_KEYS[:keys]:
+            writer.add(
+                UserProperty.__table__,
+                id=property_id,
+                user_id=i,
+                key=key,
+                value=_api_key(rng, encryption)
+                if key == u'api_key' else u'on',
+            )
+            property_id += 1
+
+
+def _add_audit_entries(writer, rng, now, ids, count, users, event_types):
+    event_type = WeightedChoice(
+        rng,
+        [id for id, name in event_types],
+        [EVENT_WEIGHTS.get(name, 1) for id, name in event_types],
+    )
+    for i in range(ids['entry'], ids['entry'] + count):
+        age = timedelta(seconds=min(
+            int(rng.expovariate(1 / (90 * 24 * 60 * 60.0))),
+            5 * 365 * 24 * 60 * 60,
+        ))
+        writer.add(
+            AuditLogEntry.__table__,
+            id=i,
+            # a few users cause most of the entries
+            user_id=ids['user'] + int(users * rng.random() ** 3),
+            event_type_id=event_type(),
+            timestamp=now - age,
+            comment=u'',
+            read=age > timedelta(days=30) or rng.random() < 0.5,
+        )
+
+
+def _add_portlets(writer, rng, ids, count, audience):
+    positions = [p.name for p in PortletPositions]
+    for i in range(ids['portlet'], ids['portlet'] + count):
+        writer.add(
+            Portlet.__table__,
+            id=i,
+            name='generated-{}'.format(i),
+            position=rng.choice(positions),
+            weight=rng.randint(-10, 10),
+            html=u'<p>Portlet {}</p>'.format(i),
+        )
+        for group in rng.sample(
+                audience, rng.randint(1, min(3, len(audience)))):
+            writer.add(portlet_group_table, portlet_id=i, group_id=group)
+        if rng.random() < 0.3:
+            writer.add(
+                exclude_portlet_group_table,
+                portlet_id=i,
+                group_id=ids['trial'],
+            )
+
+
+def _add_mailings(writer, rng, ids, count, audience):
+    trigger = WeightedChoice(rng, *zip(*TRIGGER_WEIGHTS))
+    for i in range(ids['mailing'], ids['mailing'] + count):
+        writer.add(
+            Mailing.__table__,
+            id=i,
+            name='generated-{}'.format(i),
+            trigger=trigger(),
+            days=rng.choice([1, 3, 7, 14, 30]),
+            subject=u'{{user.fullname}}, news #{}'.format(i),
+            body=u'<p>Mailing {} for ${{user.email}}.</p>'.format(i),
+            processed_until=None,
+            processed_user_id=None,
+        )
+        for group in rng.sample(
+                audience, rng.randint(1, min(2, len(audience)))):
+            writer.add(mailing_group_table, mailing_id=i, group_id=group)
+        if rng.random() < 0.8:
+            writer.add(
+                exclude_mailing_group_table,
+                mailing_id=i,
+                group_id=ids['unsubscribed'],
+            )
+
+
+def generate_data(
+    seed=0,
+    users=1000,
+    groups=10,
+    properties=2000,
+    audit_entries=10000,
+    portlets=20,
+    mailings=10,
+    until=UNTIL,
+    chunk_size=10000,
+):
+    """Insert a generated dataset of the given size.
+
+    Rows are generated with a random generator seeded with ``seed`` and
+    inserted with bulk Core inserts, ``chunk_size`` rows per transaction,
+    so memory use does not grow with the volume. Given the same seed and an
+    empty database, every run generates the same data.
+
+    Users mostly signed up recently. About 70% of them are paying, 10% are
+    on a trial and 20% have expired. Paying and expired users are members
+    of one product group, popular products having many more members than
+    others. Audit log entries are mostly logins of a minority of very
+    active users, most of them from the last few months. API keys are
+    encrypted with the app's ``bimt.encryption_aes_16b_key``, same as
+    secure properties. The default groups and audit log event types are
+    added first if they are missing.
+
+    :param seed: Seed of the random generator.
+    :type seed: int
+    :param users: Number of users to add.
+    :type users: int
+    :param groups: Number of product groups to add.
+    :type groups: int
+    :param properties: Approximate number of user properties to add.
+    :type properties: int
+    :param audit_entries: Number of audit log entries to add.
+    :type audit_entries: int
+    :param portlets: Number of portlets to add.
+    :type portlets: int
+    :param mailings: Number of mailings to add.
+    :type mailings: int
+    :param until: Date of the newest generated user, payment and entry.
+    :type until: datetime.date
+    :param chunk_size: Number of rows to insert in one transaction.
+    :type chunk_size: int
+
+    :return: number of inserted rows per table name
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    now = datetime.combine(until, datetime.min.time())
+
+    with transaction.manager:
+        has_event_types = AuditLogEventType.query.count()
+        has_groups = Group.by_name('enabled')
+    if not has_event_types:
+        add_audit_log_event_types()
+    if not has_groups:
+        add_groups()
+
+    with transaction.manager:
+        ids = {
+            'enabled': Group.by_name('enabled').id,
+            'trial': Group.by_name('trial').id,
+            'unsubscribed': Group.by_name('unsubscribed').id,
+            # ids of the first added rows
+            'group': _next_id(Group),
+            'user': _next_id(User),
+            'property': _next_id(UserProperty),
+            'entry': _next_id(AuditLogEntry),
+            'portlet': _next_id(Portlet),
+            'mailing': _next_id(Mailing),
+        }
+        event_types = Session.query(
+            AuditLogEventType.id, AuditLogEventType.name).all()
+
+    writer = RowWriter(chunk_size)
+    products, addons = _add_groups(writer, rng, ids['group'], groups)
+    _add_users(writer, rng, now, ids, users, properties, products, addons)
+    if users:
+        _add_audit_entries(
+            writer, rng, now, ids, audit_entries, users, event_types)
+    audience = [ids['enabled'], ids['trial']] + products + addons
+    _add_portlets(writer, rng, ids, portlets, audience)
+    _add_mailings(writer, rng, ids, mailings, audience)
+    writer.flush()
+
+    if Session.get_bind().dialect.name == 'postgresql':
+        _reset_sequences([
+            'groups', 'users', 'user_properties', 'audit_log_entries',
+            'portlets', 'mailings',
+        ])
+    return writer.counts
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        usage='bin/py -m '
+        'pyramid_bimt.scripts.generate_data etc/development.ini',
+    )
+    parser.add_argument(
+        'config', type=str, metavar='<config>',
+        help='Pyramid application configuration file.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument(
+        '--groups', type=int, default=10, help='Number of product groups.')
+    parser.add_argument('--properties', type=int, default=2000)
+    parser.add_argument('--audit-entries', type=int, default=10000)
+    parser.add_argument('--portlets', type=int, default=20)
+    parser.add_argument('--mailings', type=int, default=10)
+    parser.add_argument(
+        '--until', type=str, default=UNTIL.isoformat(),
+        help='Date (YYYY-MM-DD) of the newest generated data.')
+    parser.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='Number of rows to insert in one transaction.')
+    args = parser.parse_args()
+
+    env = bootstrap(args.config)
+    setup_logging(args.config)
+
+    counts = generate_data(
+        seed=args.seed,
+        users=args.users,
+        groups=args.groups,
+        properties=args.properties,
+        audit_entries=args.audit_entries,
+        portlets=args.portlets,
+        mailings=args.mailings,
+        until=datetime.strptime(args.until, '%Y-%m-%d').date(),
+        chunk_size=args.chunk_size,
+    )
+
+    env['closer']()
+    for table, count in sorted(counts.items()):
+        logger.info('Inserted {} rows into {}.'.format(count, table))
+
+
+if __name__ == '__main__':
+    main()
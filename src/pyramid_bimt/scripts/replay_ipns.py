@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Replay IPN requests from a JSON-lines export."""
+
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from pyramid_basemodel import Session
+from pyramid_bimt.forwarding import forward_ipn
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import IPNTransaction
+from pyramid_bimt.models import User
+from pyramid_bimt.security import configure_hashing
+from pyramid_bimt.security import encrypt_many
+from pyramid_bimt.security import generate
+from pyramid_bimt.utils import flatten
+from pyramid_bimt.views.ipn import IIPNProvider
+from pyramid_bimt.views.ipn import IPNView
+from sqlalchemy import func
+from sqlalchemy import or_
+
+import argparse
+import json
+import logging
+import sys
+import time
+import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def _key(provider, params):
+    return provider, u'{}'.format(params.trans_id), params.trans_type
+
+
+class ReplayCache(object):
+    """Users, groups and processed transactions of a batch of IPNs.
+
+    Everything a batch needs is loaded with three queries, instead of three
+    queries per IPN.
+    """
+
+    def __init__(self, items):
+        emails = set(params.email for _, _, params, _ in items)
+        product_ids = set(params.product_id for _, _, params, _ in items)
+        trans_ids = set(
+            u'{}'.format(params.trans_id) for _, _, params, _ in items)
+
+        self.users = {}
+        self.groups = {}
+        self.transactions = set()
+        self.duplicates = 0
+
+        users = User.query.filter(or_(
+            func.lower(User.email).in_(emails),
+            func.lower(User.billing_email).in_(emails),
+        )).all()
+        # match by email takes precedence over match by billing email, same
+        # as in User.by_any_email
+        for user in users:
+            if user.billing_email:
+                self.users[user.billing_email.lower()] = user
+        for user in users:
+            self.users[user.email.lower()] = user
+
+        for group in Group.query.filter(Group.product_id.in_(product_ids)):
+            self.groups[group.product_id] = group
+
+        self.transactions.update(Session.query(
+            IPNTransaction.provider,
+            IPNTransaction.trans_id,
+            IPNTransaction.trans_type,
+        ).filter(IPNTransaction.trans_id.in_(trans_ids)))
+
+        # hashing passwords is the slowest part of creating users, hash
+        # them all at once, in parallel if hashing processes are configured
+        new_users = len(set(
+            params.email for _, provider, params, _ in items
+            if params.email not in self.users and
+            _key(provider, params) not in self.transactions
+        ))
+        passwords = [generate() for i in range(new_users)]
+        self.passwords = zip(passwords, encrypt_many(passwords))
+
+
+class ReplayIPNView(IPNView):
+    """Process a replayed IPN using a ``ReplayCache`` instead of queries."""
+
+    def __init__(self, request, provider, params, payload, cache, forward):
+        self.request = request
+        self.provider = provider
+        self.params = params
+        self.payload = payload
+        self.cache = cache
+        self.forwarding = forward
+
+    def is_duplicate(self):
+        if _key(self.provider, self.params) in self.cache.transactions:
+            self.cache.duplicates += 1
+            return True
+        return False
+
+    def record_transaction(self):
+        Session.add(IPNTransaction(
+            provider=self.provider,
+            trans_id=u'{}'.format(self.params.trans_id),
+            trans_type=self.params.trans_type,
+        ))
+        self.cache.transactions.add(_key(self.provider, self.params))
+
+    def find_user(self):
+        return self.cache.users.get(self.params.email)
+
+    def create_user(self):
+        user = super(ReplayIPNView, self).create_user()
+        self.cache.users[self.params.email] = user
+        return user
+
+    def generate_password(self):
+        return self.cache.passwords.pop()
+
+    def find_group(self):
+        return self.cache.groups.get(self.params.product_id)
+
+    def forward(self, group):
+        if self.forwarding:
+            forward_ipn(group.forward_ipn_to_url, sorted(self.payload.items()))
+
+
+def read_ipns(lines, registry, stats=None):
+    """Parse lines of a JSON-lines export into IPNParams.
+
+    Each line is a JSON object with the ``provider`` name and the IPN values
+    as the provider sent them, for example JVZoo's POST params or Clickbank's
+    decrypted notification. Malformed lines are logged and skipped.
+
+    :param stats: dict to count skipped malformed lines in, as ``failed``
+    :type stats: dict
+
+    :return: generator of (line number, provider, params, payload) tuples
+    """
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+            provider = payload.pop('provider')
+            factory = registry.queryUtility(IIPNProvider, name=provider)
+            if factory is None:
+                raise ValueError('Unknown IPN provider: {}'.format(provider))
+            params = factory().params(flatten(payload).iteritems())
+        except (KeyError, ValueError) as e:
+            logger.warning(
+                'Skipping malformed IPN on line {}: {}'.format(lineno, e))
+            if stats is not None:
+                stats['failed'] += 1
+        else:
+            yield lineno, provider, params, payload
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _replay_batch(request, batch, forward):
+    """Replay a batch of IPNs in one transaction.
+
+    :return: tuple of (number of duplicate, number of ignored IPNs)
+    """
+    ignored = request.registry.settings.get(
+        'bimt.products_to_ignore', '').split(',')
+    items = [item for item in batch if item[2].product_id not in ignored]
+    if not items:
+        return 0, len(batch)
+    with transaction.manager:
+        cache = ReplayCache(items)
+        for lineno, provider, params, payload in items:
+            ReplayIPNView(
+                request, provider, params, payload, cache, forward).ipn()
+    return cache.duplicates, len(batch) - len(items)
+
+
+def replay_ipns(request, lines, batch_size=500, forward=False):
+    """Replay IPN requests from a JSON-lines export.
+
+    IPNs are processed in batches with the same logic as ``IPNView``, each
+    batch in a single transaction. Transactions that were already processed
+    are skipped, so it is safe to replay an export again, and so are IPNs
+    for ``bimt.products_to_ignore``. If any IPN in a batch fails, the batch
+    is replayed one IPN per transaction and the failed IPNs are logged and
+    skipped.
+
+    :param request: Request used for sending events.
+    :type request: pyramid.request.Request
+    :param lines: Lines of the JSON-lines export, see ``read_ipns``.
+    :type lines: iterable
+    :param batch_size: Number of IPNs replayed in one transaction.
+    :type batch_size: int
+    :param forward: Re-post IPNs to the ``forward_ipn_to_url`` of groups.
+    :type forward: bool
+
+    :return: dict with numbers of ``replayed``, ``duplicate``, ``skipped``
+        (ignored products) and ``failed`` IPNs
+    :rtype: dict
+    """
+    stats = {'replayed': 0, 'duplicate': 0, 'skipped': 0, 'failed': 0}
+    start = time.time()
+    items = read_ipns(lines, request.registry, stats)
+    for batch in _batches(items, batch_size):
+        try:
+            duplicates, skipped = _replay_batch(request, batch, forward)
+            stats['replayed'] += len(batch) - duplicates - skipped
+            stats['duplicate'] += duplicates
+            stats['skipped'] += skipped
+        except Exception as e:
+            logger.warning(
+                'Replaying IPNs on lines {}-{} failed ({}), replaying them '
+                'one by one.'.format(batch[0][0], batch[-1][0], e))
+            for item in batch:
+                try:
+                    duplicates, skipped = _replay_batch(
+                        request, [item], forward)
+                    stats['replayed'] += 1 - duplicates - skipped
+                    stats['duplicate'] += duplicates
+                    stats['skipped'] += skipped
+                except Exception as e:
+                    logger.exception(
+                        'Replaying IPN on line {} failed: {}'.format(
+                            item[0], e))
+                    stats['failed'] += 1
+        finally:
+            Session.remove()
+
+        done = sum(stats.values())
+        logger.info('Replayed {} IPNs ({:.1f}/s).'.format(
+            done, done / (time.time() - start)))
+    return stats
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        usage='bin/py -m '
+        'pyramid_bimt.scripts.replay_ipns etc/production.ini <export>',
+    )
+    parser.add_argument(
+        'config', type=str, metavar='<config>',
+        help='Pyramid application configuration file.')
+    parser.add_argument(
+        'export', type=argparse.FileType('r'), metavar='<export>',
+        help='JSON-lines file with one IPN per line, "-" for stdin.')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=500,
+        help='Number of IPNs replayed in one transaction.')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=0,
+        help='Number of worker processes for hashing passwords of new users.')
+    parser.add_argument(
+        '-f', '--forward', action='store_true',
+        help='Re-post IPNs to the forward_ipn_to_url of groups.')
+    args = parser.parse_args()
+
+    env = bootstrap(args.config)
+    setup_logging(args.config)
+
+    if args.processes:
+        settings = dict(env['registry'].settings)
+        settings['bimt.password_hashing_processes'] = args.processes
+        configure_hashing(settings)
+
+    stats = replay_ipns(
+        env['request'],
+        args.export,
+        batch_size=args.batch_size,
+        forward=args.forward,
+    )
+
+    env['closer']()
+    logger.info(
+        'Replayed {replayed} IPNs, skipped {duplicate} duplicates and '
+        '{skipped} IPNs of ignored products, {failed} failed.'.format(
+            **stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Finish sending mailings that were interrupted, e.g. by a restart."""
+
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from pyramid_bimt.delivery import deliver_mailing
+from pyramid_bimt.delivery import pending_mailing_ids
+
+import argparse
+import logging
+import sys
+import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def resume_mailings(request, batch_size=100):
+    """Send all pending mailing deliveries, e.g. after a crash or restart.
+
+    Each mailing continues after its last committed batch.
+
+    :param request: Request used to render emails.
+    :type request: pyramid.request.Request
+    :param batch_size: Number of emails to send in one transaction.
+    :type batch_size: int
+
+    :return: tuple of (number of sent, number of failed deliveries)
+    :rtype: tuple
+    """
+    with transaction.manager:
+        mailing_ids = pending_mailing_ids()
+
+    sent = failed = 0
+    for mailing_id in mailing_ids:
+        result = deliver_mailing(mailing_id, request, batch_size)
+        sent += result[0]
+        failed += result[1]
+    return sent, failed
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        usage='bin/py -m '
+        'pyramid_bimt.scripts.resume_mailings etc/production.ini',
+    )
+    parser.add_argument(
+        'config', type=str, metavar='<config>',
+        help='Pyramid application configuration file.')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=100,
+        help='Number of emails to send in one transaction.')
+    args = parser.parse_args()
+
+    env = bootstrap(args.config)
+    setup_logging(args.config)
+
+    sent, failed = resume_mailings(env['request'], args.batch_size)
+
+    env['closer']()
+    logger.info('Sent {} emails of interrupted mailings, {} failed.'.format(
+        sent, failed))
+
+
+if __name__ == '__main__':
+    main()
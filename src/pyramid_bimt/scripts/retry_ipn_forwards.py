@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Re-send IPN forwards that failed to be delivered."""
+
+from datetime import datetime
+from datetime import timedelta
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from pyramid_basemodel import Session
+from pyramid_bimt.forwarding import get_forwarder
+from pyramid_bimt.models import IPNForward
+
+import argparse
+import logging
+import sys
+import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def claim(forward_id, cutoff):
+    """Claim a forward that was not touched since cutoff, in its own commit.
+
+    The forward's ``modified`` timestamp is moved to now, so other runs of
+    this script skip it until it is ``min_age`` old again.
+
+    :return: True if the forward was claimed, False if it was delivered or
+        claimed by someone else in the meantime
+    :rtype: bool
+    """
+    with transaction.manager:
+        return Session.query(IPNForward).filter(
+            IPNForward.id == forward_id,
+            IPNForward.modified < cutoff,
+        ).update(
+            {IPNForward.modified: datetime.utcnow()},
+            synchronize_session=False,
+        ) == 1
+
+
+def retry_ipn_forwards(max_attempts=None, min_age=600):
+    """Re-send IPN requests waiting in the ``ipn_forwards`` table.
+
+    Forwards are delivered one by one, oldest first, so a target that is
+    still down does not get flooded.
+
+    Only forwards not touched in the last ``min_age`` seconds are re-sent,
+    newer ones may still be delivered by the ``IPNForwarder`` worker
+    threads of the app. Each forward is claimed before it is sent, so
+    concurrent runs do not send it twice.
+
+    :param max_attempts: Skip forwards that already failed this many times.
+    :type max_attempts: int
+    :param min_age: Skip forwards added or tried less than this many
+        seconds ago. Keep it well above the time workers need to deliver a
+        forward with all their retries.
+    :type min_age: int
+
+    :return: tuple of (number of delivered, number of failed forwards)
+    :rtype: tuple
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=min_age)
+    with transaction.manager:
+        query = Session.query(IPNForward.id)\
+            .filter(IPNForward.modified < cutoff)\
+            .order_by(IPNForward.id)
+        if max_attempts:
+            query = query.filter(IPNForward.attempts < max_attempts)
+        ids = [id for id, in query]
+
+    forwarder = get_forwarder()
+    delivered = failed = 0
+    for forward_id in ids:
+        if not claim(forward_id, cutoff):
+            continue
+        if forwarder.deliver(forward_id):
+            delivered += 1
+        else:
+            failed += 1
+    return delivered, failed
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        usage='bin/py -m '
+        'pyramid_bimt.scripts.retry_ipn_forwards etc/production.ini',
+    )
+    parser.add_argument(
+        'config', type=str, metavar='<config>',
+        help='Pyramid application configuration file.')
+    parser.add_argument(
+        '-m', '--max-attempts', type=int, default=None,
+        help='Skip forwards that already failed this many times.')
+    parser.add_argument(
+        '-a', '--min-age', type=int, default=600,
+        help='Skip forwards added or tried less than this many seconds ago.')
+    args = parser.parse_args()
+
+    env = bootstrap(args.config)
+    setup_logging(args.config)
+
+    delivered, failed = retry_ipn_forwards(
+        max_attempts=args.max_attempts, min_age=args.min_age)
+
+    env['closer']()
+    logger.info('Re-sent {} IPN forwards, {} failed.'.format(
+        delivered, failed))
+
+
+if __name__ == '__main__':
+    main()
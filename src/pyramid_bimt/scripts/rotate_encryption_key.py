@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Re-encrypt secure user properties with a new encryption key."""
+
+from multiprocessing import Pool
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from pyramid_basemodel import Session
+from pyramid_bimt.models import UserProperty
+from pyramid_bimt.security import get_symmetric_encryption
+from sqlalchemy import bindparam
+from zope.sqlalchemy import mark_changed
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import transaction
+
+logger = logging.getLogger(__name__)
+
+#: Keys of user properties that are stored with ``secure=True``.
+SECURE_KEYS = ['api_key']
+
+
+class DecryptionError(Exception):
+    """Secure properties cannot be decrypted with the old key."""
+
+
+def reencrypt_batch(old_key, new_key, rows):
+    """Decrypt values with the old key and encrypt them with the new key.
+
+    :param rows: list of (id, value) tuples
+    :return: list of (id, new value) tuples
+    :raises DecryptionError: if a value was not encrypted with old_key, for
+        example because the rotation already finished
+    """
+    try:
+        values = get_symmetric_encryption(old_key).decrypt_many(
+            [value for id_, value in rows], strict=True)
+    except (TypeError, ValueError) as e:
+        raise DecryptionError(
+            'Properties {}-{} cannot be decrypted with the old key ({}), '
+            'were they re-encrypted already?'.format(
+                rows[0][0], rows[-1][0], e))
+    values = get_symmetric_encryption(new_key).encrypt_many(values)
+    return [(id_, unicode(value)) for (id_, old), value in zip(rows, values)]
+
+
+def _reencrypt_batch(args):
+    return reencrypt_batch(*args)
+
+
+def key_fingerprint(old_key, new_key):
+    """Return a short hash of both keys, to tell rotations apart."""
+    return hashlib.sha256(old_key + '\0' + new_key).hexdigest()[:16]
+
+
+def read_checkpoint(state_file, fingerprint):
+    """Return the id of the last re-encrypted property, 0 if none.
+
+    If the run was interrupted while committing a batch, the stored new
+    value of the batch's last property tells whether the commit went
+    through, so the batch is neither skipped nor re-encrypted twice.
+
+    :raises ValueError: if ``state_file`` was written by a rotation with
+        different keys
+    """
+    if not state_file or not os.path.exists(state_file):
+        return 0
+    with open(state_file) as f:
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = None
+    if not isinstance(state, dict) or state.get('keys') != fingerprint:
+        raise ValueError(
+            '{} was written by a rotation with different keys, remove it to '
+            'start a new rotation.'.format(state_file))
+
+    if state.get('pending'):
+        id_, value = state['pending']
+        if Session.query(UserProperty.value).filter_by(
+                id=id_).scalar() == value:
+            return id_
+    return state['last_id']
+
+
+def write_checkpoint(state_file, fingerprint, last_id, pending=None):
+    """Remember the id of the last re-encrypted property.
+
+    :param pending: (id, new value) of the last property of a batch that is
+        about to be committed
+    """
+    if state_file:
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(
+                {'keys': fingerprint, 'last_id': last_id, 'pending': pending},
+                f,
+            )
+        os.rename(state_file + '.tmp', state_file)
+
+
+def read_batches(keys, last_id, batch_size, count):
+    """Read up to ``count`` batches of secure property rows after last_id.
+
+    Rows are read in primary key order with keyset pagination, so a batch
+    never needs to keep a cursor open across commits.
+    """
+    batches = []
+    for i in range(count):
+        rows = Session.query(UserProperty.id, UserProperty.value)\
+            .filter(UserProperty.key.in_(keys))\
+            .filter(UserProperty.id > last_id)\
+            .filter(UserProperty.value != None)\
+            .order_by(UserProperty.id)\
+            .limit(batch_size)\
+            .all()  # noqa
+        if not rows:
+            break
+        batches.append(rows)
+        last_id = rows[-1][0]
+    return batches
+
+
+def write_batch(rows):
+    """Write re-encrypted values back with a single executemany UPDATE."""
+    table = UserProperty.__table__
+    Session.execute(
+        table.update()
+        .where(table.c.id == bindparam('_id'))
+        .values(value=bindparam('_value')),
+        [{'_id': id_, '_value': value} for id_, value in rows],
+    )
+    mark_changed(Session())
+
+
+def rotate_encryption_key(
+    old_key,
+    new_key,
+    keys=SECURE_KEYS,
+    batch_size=1000,
+    processes=0,
+    state_file=None,
+):
+    """Re-encrypt all secure user properties from old_key to new_key.
+
+    Batches are re-encrypted in ``processes`` worker processes (0 to do it
+    in this process) and committed one by one. The id of the last committed
+    property is stored in ``state_file``, so an interrupted run continues
+    where it left off when started again with the same ``state_file`` and
+    keys. The file is removed when all properties are re-encrypted.
+
+    Nothing is written if a batch cannot be decrypted with old_key, so
+    running the rotation again after it finished does not corrupt values.
+
+    :return: number of re-encrypted properties
+    :rtype: int
+    :raises ValueError: if ``state_file`` belongs to another rotation
+    :raises DecryptionError: if properties are not encrypted with old_key
+    """
+    fingerprint = key_fingerprint(old_key, new_key)
+    last_id = read_checkpoint(state_file, fingerprint)
+    pool = Pool(processes) if processes else None
+    total = 0
+    start = time.time()
+
+    try:
+        while True:
+            batches = read_batches(
+                keys, last_id, batch_size, max(processes, 1))
+            if not batches:
+                break
+            args = [(old_key, new_key, rows) for rows in batches]
+            if pool:
+                results = pool.map(_reencrypt_batch, args)
+            else:
+                results = map(_reencrypt_batch, args)
+
+            for rows in results:
+                write_checkpoint(
+                    state_file, fingerprint, last_id, pending=rows[-1])
+                with transaction.manager:
+                    write_batch(rows)
+                last_id = rows[-1][0]
+                write_checkpoint(state_file, fingerprint, last_id)
+                total += len(rows)
+
+            logger.info(
+                'Re-encrypted {} properties, last id {} ({:.1f}/s).'.format(
+                    total, last_id, total / (time.time() - start)))
+    finally:
+        if pool:
+            pool.terminate()
+
+    if state_file and os.path.exists(state_file):
+        os.remove(state_file)
+    return total
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        usage='bin/py -m '
+        'pyramid_bimt.scripts.rotate_encryption_key etc/production.ini '
+        '<new_key>',
+    )
+    parser.add_argument(
+        'config', type=str, metavar='<config>',
+        help='Pyramid application configuration file.')
+    parser.add_argument(
+        'new_key', type=str, metavar='<new_key>',
+        help='New 16-byte value for bimt.encryption_aes_16b_key.')
+    parser.add_argument(
+        '-k', '--key', action='append', dest='keys',
+        help='Key of a secure user property, can be repeated. Defaults to '
+        '{}.'.format(', '.join(SECURE_KEYS)))
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=1000,
+        help='Number of properties re-encrypted per batch.')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=0,
+        help='Number of worker processes.')
+    parser.add_argument(
+        '-s', '--state-file', type=str, default='.rotate_encryption_key',
+        help='File to store progress in, so the run can be resumed.')
+    args = parser.parse_args()
+
+    env = bootstrap(args.config)
+    setup_logging(args.config)
+
+    try:
+        total = rotate_encryption_key(
+            old_key=env['registry'].settings['bimt.encryption_aes_16b_key'],
+            new_key=args.new_key,
+            keys=args.keys or SECURE_KEYS,
+            batch_size=args.batch_size,
+            processes=args.processes,
+            state_file=args.state_file,
+        )
+    except DecryptionError as exc:
+        logger.error(str(exc))
+        sys.exit(1)
+    except ValueError as exc:
+        parser.error(str(exc))
+    finally:
+        env['closer']()
+
+    logger.info(
+        'Re-encrypted {} properties. Set bimt.encryption_aes_16b_key to the '
+        'new key.'.format(total))
+
+
+if __name__ == '__main__':
+    main()
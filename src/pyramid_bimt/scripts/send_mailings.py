@@ -5,7 +5,9 @@ from datetime import date
 from datetime import timedelta
 from pyramid.paster import bootstrap
 from pyramid.paster import setup_logging
+from pyramid.threadlocal import get_current_request
 from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import MailingRenderer
 from pyramid_bimt.models import MailingTriggers
 from pyramid_bimt.models import User
 from sqlalchemy.sql.expression import func
@@ -17,37 +19,89 @@ import transaction
 
 logger = logging.getLogger(__name__)
 
-
-def send_mailings():
-    with transaction.manager:  # so send() will actually send emails
-        for mailing in Mailing.query.all():
-
-            def send(mailing, user):
-                mailing.send(user)
-                logger.info(
-                    u'Sent mailing "{}" for user "{}" ({}).'.format(
-                        mailing.name, user.email, user.id))
-
-            if mailing.trigger == MailingTriggers.after_created.name:
-                for user in User.query.filter(
-                    func.date(User.created) == func.date(
-                        date.today() - timedelta(days=mailing.days))
-                ).all():
-                    send(mailing, user)
-
-            elif mailing.trigger == MailingTriggers.after_last_payment.name:
-                for user in User.query.filter(
-                    func.date(User.last_payment) == func.date(
-                        date.today() - timedelta(days=mailing.days))
-                ).all():
-                    send(mailing, user)
-
-            elif mailing.trigger == MailingTriggers.before_valid_to.name:
-                for user in User.query.filter(
-                    func.date(User.valid_to) == func.date(
-                        date.today() + timedelta(days=mailing.days))
-                ).all():
-                    send(mailing, user)
+#: triggers handled by this script: the user column they match and whether
+#: ``Mailing.days`` are counted after (-1) or before (1) its date
+TRIGGERS = {
+    MailingTriggers.after_created.name: ('created', -1),
+    MailingTriggers.after_last_payment.name: ('last_payment', -1),
+    MailingTriggers.before_valid_to.name: ('valid_to', 1),
+}
+
+
+def days_to_process(mailing, today):
+    """Return days from the last processed day of a mailing up to today.
+
+    A mailing that was never processed only gets today, older days are not
+    back-filled.
+    """
+    if mailing.processed_until is None:
+        return [today]
+    return [
+        mailing.processed_until + timedelta(days=i)
+        for i in range(1, (today - mailing.processed_until).days + 1)
+    ]
+
+
+def _send_batch(mailing, day, batch_size):
+    """Send a mailing to the next batch of users matching its trigger on day.
+
+    :return: True if all users of the day have been processed
+    :rtype: bool
+    """
+    column, direction = TRIGGERS[mailing.trigger]
+    users = User.query.filter(
+        func.date(getattr(User, column)) == func.date(
+            day + timedelta(days=direction * mailing.days)),
+        User.id > (mailing.processed_user_id or 0),
+    ).order_by(User.id).limit(batch_size).all()
+
+    renderer = None
+    for user in users:
+        if renderer is None:
+            renderer = MailingRenderer(mailing, get_current_request())
+        mailing.send(user, renderer=renderer)
+        logger.info(
+            u'Sent mailing "{}" for user "{}" ({}).'.format(
+                mailing.name, user.email, user.id))
+
+    if len(users) < batch_size:
+        mailing.processed_until = day
+        mailing.processed_user_id = None
+        return True
+    mailing.processed_user_id = users[-1].id
+    return False
+
+
+def send_mailings(batch_size=500):
+    """Send mailings with date-based triggers to users that match them.
+
+    Every mailing remembers the last day it was processed for, so days
+    missed because the script did not run are caught up on the next run.
+    Users are sent to in batches of ``batch_size``, each batch committed
+    together with its emails and the position of the mailing, so an
+    interrupted run continues with the next batch.
+
+    :param batch_size: Number of emails to send in one transaction.
+    :type batch_size: int
+    """
+    today = date.today()
+    with transaction.manager:
+        mailing_ids = [id for id, in Mailing.query.with_entities(
+            Mailing.id,
+        ).filter(
+            Mailing.trigger.in_(TRIGGERS.keys()),
+        ).order_by(Mailing.id)]
+
+    for mailing_id in mailing_ids:
+        with transaction.manager:
+            days = days_to_process(Mailing.by_id(mailing_id), today)
+        for day in days:
+            done = False
+            while not done:
+                # so send() will actually send emails
+                with transaction.manager:
+                    done = _send_batch(
+                        Mailing.by_id(mailing_id), day, batch_size)
 
 
 def main(argv=sys.argv):
@@ -58,11 +112,15 @@ def main(argv=sys.argv):
     parser.add_argument(
         'config', type=str, metavar='<config>',
         help='Pyramid application configuration file.')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=500,
+        help='Number of emails to send in one transaction.')
+    args = parser.parse_args()
 
-    env = bootstrap(parser.parse_args().config)
-    setup_logging(parser.parse_args().config)
+    env = bootstrap(args.config)
+    setup_logging(args.config)
 
-    send_mailings()
+    send_mailings(args.batch_size)
 
     env['closer']()
     logger.info('Send mailings script finished.')
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Sync the Clickbank order history into the clickbank_receipts table."""
+
+from datetime import datetime
+from datetime import timedelta
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from pyramid_basemodel import Session
+from pyramid_bimt.clickbank import get_clickbank_api
+from pyramid_bimt.models import ClickbankReceipt
+
+import argparse
+import logging
+import sys
+import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def sync_clickbank_receipts(api=None, start_date=None):
+    """Fetch new Clickbank orders and store them as ``ClickbankReceipt``.
+
+    Orders are fetched page by page since the newest synced order, the
+    watermark, and each page is committed on its own, so an interrupted
+    sync continues where it stopped. The day before the watermark is
+    fetched again because Clickbank filters orders by date in its own time
+    zone; receipts that were already synced are updated, not duplicated.
+
+    :param api: Clickbank client, ``get_clickbank_api()`` by default.
+    :type api: pyramid_bimt.clickbank.ClickbankAPI
+    :param start_date: Fetch orders since this date instead of since the
+        watermark, e.g. for the first sync.
+    :type start_date: datetime.date
+
+    :return: tuple of (number of fetched orders, number of new receipts)
+    :rtype: tuple
+    """
+    api = api or get_clickbank_api()
+
+    if start_date is None:
+        with transaction.manager:
+            watermark = ClickbankReceipt.watermark()
+        if watermark:
+            start_date = (watermark - timedelta(days=1)).date()
+
+    params = {}
+    if start_date:
+        params['startDate'] = start_date.isoformat()
+
+    fetched = added = 0
+    try:
+        for orders in api.list_orders(**params):
+            with transaction.manager:
+                added += ClickbankReceipt.ingest(orders)
+            fetched += len(orders)
+            logger.info('Synced {} Clickbank orders.'.format(fetched))
+    finally:
+        Session.remove()
+    return fetched, added
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        usage='bin/py -m '
+        'pyramid_bimt.scripts.sync_clickbank_receipts etc/production.ini',
+    )
+    parser.add_argument(
+        'config', type=str, metavar='<config>',
+        help='Pyramid application configuration file.')
+    parser.add_argument(
+        '-s', '--start-date', type=str, default=None,
+        help='Fetch orders since this date (YYYY-MM-DD) instead of since '
+        'the last synced order.')
+    args = parser.parse_args()
+
+    env = bootstrap(args.config)
+    setup_logging(args.config)
+
+    start_date = None
+    if args.start_date:
+        start_date = datetime.strptime(args.start_date, '%Y-%m-%d').date()
+
+    fetched, added = sync_clickbank_receipts(start_date=start_date)
+
+    env['closer']()
+    logger.info('Fetched {} Clickbank orders, {} new receipts.'.format(
+        fetched, added))
+
+
+if __name__ == '__main__':
+    main()
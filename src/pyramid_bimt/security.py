@@ -1,36 +1,187 @@
 # -*- coding: utf-8 -*-
 """Security-aware methods."""
 
-from Crypto import Random
 from Crypto.Cipher import AES
-from passlib.apps import custom_app_context as pwd_context
+from multiprocessing import Pool
+from passlib.context import CryptContext
 from passlib.utils import generate_password
 from pyramid.threadlocal import get_current_registry
+from threading import BoundedSemaphore
+from threading import Lock
 
 import base64
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+#: Default number of sha512_crypt rounds, see ``bimt.password_rounds``.
+DEFAULT_ROUNDS = 90000
 
-def encrypt(cleartext):
-    """Encrypt a raw password into a secure salted hash using passlib."""
-    cleartext = cleartext.strip()
-    cyphertext = pwd_context.encrypt(
+_contexts = {}
+
+
+def _get_context(rounds):
+    """Return a passlib context that hashes with given number of rounds.
+
+    Hashes with fewer rounds are marked as needing an update, so they are
+    re-hashed on the next successful login.
+    """
+    if rounds not in _contexts:
+        _contexts[rounds] = CryptContext(
+            schemes=['sha512_crypt', 'sha256_crypt'],
+            default='sha512_crypt',
+            deprecated=['sha256_crypt'],
+            sha512_crypt__default_rounds=rounds,
+            sha512_crypt__min_rounds=rounds,
+        )
+    return _contexts[rounds]
+
+
+def _encrypt(cleartext, rounds):
+    return _get_context(rounds).encrypt(
         cleartext,
         scheme='sha512_crypt',
-        rounds=90000,
+        rounds=rounds,
     )
-    return unicode(cyphertext)
+
+
+def _encrypt_star(args):
+    return _encrypt(*args)
+
+
+def _verify_and_update(cleartext, cyphertext, rounds):
+    return _get_context(rounds).verify_and_update(cleartext, cyphertext)
+
+
+class HashingService(object):
+    """Hash and verify passwords, optionally in a pool of worker processes.
+
+    sha512_crypt is deliberately slow, so running it in the request thread
+    holds the GIL for as long as it takes to hash. With ``processes`` set,
+    hashing runs in a process pool, the calling thread only waits for the
+    result. At most ``max_pending`` hashing jobs are queued at any time,
+    further callers block until a slot is freed.
+
+    The pool is started lazily in the process that first uses it, so it is
+    safe to configure the service before the WSGI server forks its workers.
+
+    :param rounds: Number of sha512_crypt rounds for new hashes.
+    :type rounds: int
+    :param processes: Number of worker processes, 0 to hash in the calling
+        thread.
+    :type processes: int
+    :param max_pending: Maximum number of queued hashing jobs, defaults to
+        four times the number of processes.
+    :type max_pending: int
+    """
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, processes=0, max_pending=None):
+        self.rounds = rounds
+        self.processes = processes
+        self.max_pending = max_pending or processes * 4
+        self._pool = None
+        self._pid = None
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(self.max_pending or 1)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = Pool(self.processes)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _call(self, func, *args):
+        if not self.processes:
+            return func(*args)
+        pool = self._get_pool()
+        with self._slots:
+            return pool.apply_async(func, args).get()
+
+    def encrypt(self, cleartext):
+        """Hash a raw password."""
+        return unicode(self._call(_encrypt, cleartext.strip(), self.rounds))
+
+    def encrypt_many(self, cleartexts):
+        """Hash a list of raw passwords, in parallel if processes are set."""
+        args = [(cleartext.strip(), self.rounds) for cleartext in cleartexts]
+        if self.processes:
+            hashes = self._get_pool().map(_encrypt_star, args)
+        else:
+            hashes = map(_encrypt_star, args)
+        return [unicode(h) for h in hashes]
+
+    def verify_and_update(self, cleartext, cyphertext):
+        """Verify a password and re-hash it if it uses an outdated cost.
+
+        :return: tuple of (password is valid, new hash or None)
+        :rtype: tuple
+        """
+        valid, new_hash = self._call(
+            _verify_and_update, cleartext, cyphertext, self.rounds)
+        return valid, new_hash and unicode(new_hash)
+
+    def close(self):
+        """Stop worker processes, if any were started."""
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+            self._pid = None
+
+
+_service = HashingService()
+
+
+def configure_hashing(settings):
+    """Configure the password hashing service from app settings.
+
+    * ``bimt.password_rounds``: sha512_crypt rounds for new hashes, existing
+      hashes with fewer rounds are upgraded on successful login,
+    * ``bimt.password_hashing_processes``: number of worker processes, 0
+      (default) hashes in the request thread,
+    * ``bimt.password_hashing_max_pending``: maximum number of queued
+      hashing jobs.
+    """
+    global _service
+    _service.close()
+    _service = HashingService(
+        rounds=int(settings.get('bimt.password_rounds', DEFAULT_ROUNDS)),
+        processes=int(settings.get('bimt.password_hashing_processes', 0)),
+        max_pending=int(
+            settings.get('bimt.password_hashing_max_pending', 0)) or None,
+    )
+    return _service
+
+
+def encrypt(cleartext):
+    """Encrypt a raw password into a secure salted hash using passlib."""
+    return _service.encrypt(cleartext)
+
+
+def encrypt_many(cleartexts):
+    """Encrypt a list of raw passwords, see ``HashingService.encrypt_many``."""
+    return _service.encrypt_many(cleartexts)
 
 
 def verify(cleartext, cyphertext):
     """Verify a password using passlib."""
+    return verify_and_update(cleartext, cyphertext)[0]
+
+
+def verify_and_update(cleartext, cyphertext):
+    """Verify a password using passlib and return an upgraded hash if needed.
+
+    :return: tuple of (password is valid, new hash or None); store the new
+        hash if it is not None
+    :rtype: tuple
+    """
     try:
-        return pwd_context.verify(cleartext, cyphertext)
+        return _service.verify_and_update(cleartext, cyphertext)
     except Exception as e:
         logger.exception(e)
-        return False
+        return False, None
 
 
 def generate(**kwargs):
@@ -39,10 +190,16 @@ def generate(**kwargs):
 
 
 class SymmetricEncryption(object):
+    """AES-CBC encryption of short strings, such as secure properties.
+
+    :param key: 16-byte AES key, defaults to the
+        ``bimt.encryption_aes_16b_key`` setting of the current registry.
+    :type key: str
+    """
     BS = 16
 
-    def __init__(self):
-        self.key = get_current_registry().settings['bimt.encryption_aes_16b_key']  # noqa
+    def __init__(self, key=None):
+        self.key = key or get_current_registry().settings['bimt.encryption_aes_16b_key']  # noqa
 
     def _pad(self, s):
         return s + (self.BS - len(s) % self.BS) * chr(self.BS - len(s) % self.BS)  # noqa
@@ -50,14 +207,71 @@ class SymmetricEncryption(object):
     def _unpad(self, s):
         return s[:-ord(s[len(s) - 1:])]
 
-    def encrypt(self, s):
+    def _is_padded(self, s):
+        n = ord(s[len(s) - 1:] or '\0')
+        return 0 < n <= self.BS and s.endswith(s[-1] * n)
+
+    def encrypt(self, s, iv=None):
         s = self._pad(s)
-        iv = Random.new().read(AES.block_size)
+        iv = iv or os.urandom(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return base64.b64encode(iv + cipher.encrypt(s))
 
-    def decrypt(self, enc):
+    def decrypt(self, enc, strict=False):
         enc = base64.b64decode(enc)
         iv = enc[:16]
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return self._unpad(cipher.decrypt(enc[16:]))
+        s = cipher.decrypt(enc[16:])
+        if strict and not self._is_padded(s):
+            raise ValueError('Invalid padding, wrong encryption key?')
+        return self._unpad(s)
+
+    def encrypt_many(self, values):
+        """Encrypt an iterable of strings, return a list of cyphertexts."""
+        encrypt = self.encrypt
+        return [encrypt(value) for value in values]
+
+    def decrypt_many(self, values, strict=False):
+        """Decrypt an iterable of cyphertexts, return a list of strings.
+
+        :param strict: raise ValueError if a value is not padded correctly,
+            which means it was most likely encrypted with another key
+        """
+        decrypt = self.decrypt
+        return [decrypt(value, strict) for value in values]
+
+
+_symmetric_encryptions = {}
+_default_encryption = None
+
+
+def configure_encryption(settings):
+    """Build the shared encryption of secure properties from app settings.
+
+    The ``bimt.encryption_aes_16b_key`` setting is read once, so reading and
+    writing secure properties does not look up the current registry.
+    """
+    global _default_encryption
+    key = settings.get('bimt.encryption_aes_16b_key')
+    _default_encryption = key and get_symmetric_encryption(key) or None
+    return _default_encryption
+
+
+def get_symmetric_encryption(key=None):
+    """Return a shared :class:`SymmetricEncryption` instance for given key.
+
+    Instances are cached per key, so secure properties can be read and
+    written without building a new instance every time.
+
+    :param key: 16-byte AES key, defaults to the key set by
+        :func:`configure_encryption`, or to the ``bimt.encryption_aes_16b_key``
+        setting of the current registry if it was not called.
+    :type key: str
+    """
+    if not key:
+        if _default_encryption is not None:
+            return _default_encryption
+        key = get_current_registry().settings['bimt.encryption_aes_16b_key']  # noqa
+    if key not in _symmetric_encryptions:
+        _symmetric_encryptions[key] = SymmetricEncryption(key)
+    return _symmetric_encryptions[key]
@@ -2,6 +2,7 @@
 """Shared/common testing code."""
 
 from collections import deque
+from contextlib import contextmanager
 from pyramid.exceptions import HTTPNotFound
 from pyramid.httpexceptions import WSGIHTTPException
 from pyramid.response import Response
@@ -11,6 +12,7 @@ from pyramid.view import view_config
 from pyramid.view import view_defaults
 from pyramid_basemodel import Base
 from pyramid_basemodel import Session
+from pyramid_bimt.querystats import collect_query_stats
 from pyramid_bimt.scripts.populate import add_audit_log_event_types
 from pyramid_bimt.scripts.populate import add_demo_auditlog_entries
 from pyramid_bimt.scripts.populate import add_demo_mailing
@@ -28,9 +30,10 @@ def initTestingDB(
     groups=False,
     users=False,
     portlets=False,
-    mailings=False
+    mailings=False,
+    url='sqlite:///:memory:',
 ):
-    engine = create_engine('sqlite:///:memory:')
+    engine = create_engine(url)
     Base.metadata.create_all(engine)
     Session.configure(bind=engine)
 
@@ -54,6 +57,43 @@ def initTestingDB(
         add_demo_auditlog_entries()
 
 
+@contextmanager
+def assert_query_count(count=None, maximum=None):
+    """Fail if a block executes an unexpected number of SQL statements.
+
+    Use it in tests to catch N+1 queries, e.g. relationships lazy loaded
+    for every row of a list:
+
+    .. code-block:: python
+
+        with assert_query_count(2):
+            view()
+
+    :param count: Exact number of expected statements.
+    :type count: int
+    :param maximum: Maximum number of expected statements, use instead of
+        ``count`` for blocks that may skip some of them.
+    :type maximum: int
+    """
+    with collect_query_stats() as stats:
+        yield stats
+
+    if count is not None and stats.count != count:
+        expected = '{}'.format(count)
+    elif maximum is not None and stats.count > maximum:
+        expected = 'at most {}'.format(maximum)
+    else:
+        return
+    raise AssertionError(
+        'Expected {} SQL statements, {} were executed:\n{}'.format(
+            expected,
+            stats.count,
+            '\n'.join(
+                '{} x {}'.format(times, statement)
+                for statement, times in stats.statements.most_common()),
+        ))
+
+
 @view_defaults(permission=NO_PERMISSION_REQUIRED)
 class RobotAPI(object):  # pragma: no cover
     """HTTP API for Robot Framework tests
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""Test killing CloudAMQP connections on app start."""
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from pyramid import testing
+from pyramid_bimt.amqp import kill_connections
+from pyramid_bimt.amqp import kill_connections_in_background
+from threading import Condition
+from threading import Event
+from threading import Thread
+from threading import current_thread
+
+import json
+import mock
+import time
+import unittest
+
+
+class FakeManagementHandler(BaseHTTPRequestHandler):
+    """Respond like the RabbitMQ management API."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append((
+            self.command, self.path, self.headers.get('Authorization')))
+        if self.server.list_status != 200:
+            return self.respond(self.server.list_status)
+        self.respond(200, json.dumps(
+            [{'name': name} for name in self.server.connections]))
+
+    def do_DELETE(self):
+        self.server.requests.append((
+            self.command, self.path, self.headers.get('X-Reason')))
+        with self.server.arrived:
+            self.server.in_flight += 1
+            self.server.arrived.notify_all()
+            # hold the response until enough requests are in flight at once
+            end = time.time() + 5
+            while (self.server.in_flight < self.server.concurrency and
+                    time.time() < end):
+                self.server.arrived.wait(end - time.time())
+        self.server.release.wait(5)
+        self.respond(204)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeManagementServer(ThreadingMixIn, HTTPServer):
+    """Handle each connection in its own thread."""
+
+    daemon_threads = True
+    request_queue_size = 16
+
+    def handle_error(self, request, client_address):
+        pass  # client gave up waiting and closed the connection
+
+
+class TestKillConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeManagementServer(
+            ('127.0.0.1', 0), FakeManagementHandler)
+        self.server.requests = []
+        self.server.connections = []
+        self.server.list_status = 200
+        self.server.arrived = Condition()
+        self.server.in_flight = 0
+        self.server.concurrency = 0
+        self.server.release = Event()
+        self.server.release.set()
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.apiurl = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _deleted(self):
+        return sorted(
+            path for method, path, _ in self.server.requests
+            if method == 'DELETE'
+        )
+
+    def test_no_exception(self):
+        try:
+            # empty arguments could throw exception
+            kill_connections(username=None, password=None, apiurl=None)
+        except:  # noqa
+            self.fail('kill_connections function should not raise exception')
+
+    def test_kill_connections(self):
+        self.server.connections = ['foo bar', '127.0.0.1:1234 -> :5672']
+        self.assertEqual(
+            kill_connections(
+                username='foo', password='bar', apiurl=self.apiurl),
+            (2, 2),
+        )
+        self.assertEqual(self.server.requests[0], (
+            'GET', '/api/connections', 'Basic Zm9vOmJhcg=='))
+        self.assertEqual(self._deleted(), [
+            '/api/connections/127.0.0.1%3A1234%20-%3E%20%3A5672',
+            '/api/connections/foo%20bar',
+        ])
+        self.assertEqual(
+            set(reason for _, _, reason in self.server.requests[1:]),
+            set(['Auto-kill on app start']),
+        )
+
+    def test_no_connections(self):
+        self.assertEqual(kill_connections(apiurl=self.apiurl), (0, 0))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_concurrent(self):
+        # every DELETE is answered only once all 8 were received
+        self.server.connections = [str(i) for i in range(8)]
+        self.server.concurrency = 8
+        self.assertEqual(
+            kill_connections(apiurl=self.apiurl, workers=8), (8, 8))
+        self.assertEqual(len(self._deleted()), 8)
+
+    @mock.patch('pyramid_bimt.amqp.logger')
+    def test_deadline(self, logger):
+        self.server.connections = [str(i) for i in range(4)]
+        release = Event()
+        with mock.patch('pyramid_bimt.amqp.requests.Session.delete') as delete:
+            # DELETE requests never return before the deadline
+            delete.side_effect = lambda *args, **kwargs: release.wait()
+            try:
+                self.assertEqual(
+                    kill_connections(
+                        apiurl=self.apiurl, timeout=0.2, workers=2),
+                    (0, 4),
+                )
+            finally:
+                release.set()
+        logger.warning.assert_any_call(
+            'Gave up killing AMQP connections after 0.2 seconds.')
+
+    @mock.patch('pyramid_bimt.amqp.time')
+    def test_deadline_passed(self, time_):
+        # the deadline passes after connections are listed, before deleting
+        main = current_thread()
+        time_.time.side_effect = lambda: 0 if current_thread() is main else 60
+        self.server.connections = ['foo']
+        self.assertEqual(
+            kill_connections(apiurl=self.apiurl, timeout=30), (0, 1))
+        self.assertEqual(self._deleted(), [])
+
+    @mock.patch('pyramid_bimt.amqp.logger')
+    @mock.patch('pyramid_bimt.amqp.ThreadPool')
+    def test_pool_failed(self, ThreadPool, logger):
+        self.server.connections = ['foo']
+        pool = ThreadPool.return_value
+        pool.imap_unordered.return_value.next.side_effect = RuntimeError('x')
+        self.assertEqual(kill_connections(apiurl=self.apiurl), (0, 1))
+        self.assertTrue(pool.terminate.called)
+        logger.warning.assert_called_with('x')
+
+    @mock.patch('pyramid_bimt.amqp.logger')
+    def test_list_failed(self, logger):
+        self.server.list_status = 503
+        self.assertEqual(kill_connections(apiurl=self.apiurl), (0, 0))
+        self.assertEqual(self._deleted(), [])
+        self.assertTrue(logger.warning.called)
+
+    def test_in_background(self):
+        self.server.connections = ['foo']
+        self.server.release.clear()
+        thread = kill_connections_in_background({
+            'bimt.amqp_apiurl': self.apiurl,
+            'bimt.amqp_kill_timeout': '5',
+            'bimt.amqp_kill_workers': '2',
+        })
+        # returned while the DELETE request is still held by the server
+        self.assertTrue(thread.is_alive())
+        self.assertTrue(thread.daemon)
+        self.server.release.set()
+        thread.join()
+        self.assertEqual(self._deleted(), ['/api/connections/foo'])
+
+
+class TestConfigureKillConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @mock.patch('pyramid_bimt.kill_connections_in_background')
+    def test_enabled(self, kill_connections_in_background):
+        from pyramid_bimt import configure
+        settings = {'bimt.kill_cloudamqp_connections': True}
+        configure(self.config, settings)
+        kill_connections_in_background.assert_called_with(settings)
+
+    @mock.patch('pyramid_bimt.kill_connections_in_background')
+    def test_disabled(self, kill_connections_in_background):
+        from pyramid_bimt import configure
+        configure(self.config, {})
+        self.assertFalse(kill_connections_in_background.called)
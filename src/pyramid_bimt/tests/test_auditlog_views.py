@@ -5,11 +5,14 @@ from pyramid import testing
 from pyramid_basemodel import Session
 from pyramid_bimt import configure
 from pyramid_bimt.models import AuditLogEntry
+from pyramid_bimt.models import AuditLogEventType
 from pyramid_bimt.models import User
+from pyramid_bimt.testing import assert_query_count
 from pyramid_bimt.testing import initTestingDB
 from zope.testing.loggingsupport import InstalledHandler
 
 import mock
+import transaction
 import unittest
 import webtest
 
@@ -202,3 +205,47 @@ class TestAuditLogView(unittest.TestCase):
         AuditLogEntry.by_id(2).read = False
         self._make_view()
         self.assertEqual(AuditLogEntry.by_id(2).read, False)
+
+
+class TestAuditLogAJAXQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        configure(self.config)
+        initTestingDB(auditlog_types=True, groups=True, users=True)
+        with transaction.manager:
+            users = User.query.order_by(User.id).all()
+            event_types = AuditLogEventType.query.all()
+            for i in range(20):
+                Session.add(AuditLogEntry(
+                    user=users[i % len(users)],
+                    event_type=event_types[i % len(event_types)],
+                    comment=u'entry {}'.format(i),
+                    # unread entries of the user are marked read, one
+                    # UPDATE each, only on the first view
+                    read=True,
+                ))
+        self.request = testing.DummyRequest(params={'iDisplayLength': '50'})
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def _call(self, email):
+        from pyramid_bimt.views.auditlog import AuditLogAJAX
+        self.request.user = User.by_email(email)
+        with assert_query_count(3):
+            return AuditLogAJAX(self.request)()
+
+    def test_admin(self):
+        self.config.testing_securitypolicy(
+            userid='admin@bar.com', permissive=True)
+        result = self._call('admin@bar.com')
+        self.assertEqual(len(result['aaData']), 20)
+
+    def test_user(self):
+        self.config.testing_securitypolicy(
+            userid='one@bar.com', permissive=False)
+        result = self._call('one@bar.com')
+        self.assertEqual(len(result['aaData']), 6)
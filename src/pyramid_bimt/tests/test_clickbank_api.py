@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
 """Test clickbank api."""
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime
 from pyramid_bimt.clickbank import ClickbankAPI
+from pyramid_bimt.clickbank import ClickbankException
+from pyramid_bimt.clickbank import configure_clickbank
+from pyramid_bimt.clickbank import get_clickbank_api
+from pyramid_bimt.clickbank import parse_date
+from threading import Thread
 
+import json
 import mock
+import time
 import unittest
 
 RESPONSES = {}
@@ -93,55 +104,51 @@ class TestClickbankAPI(unittest.TestCase):
         dev_key = 'secret'
         api_key = 'secret'
 
-        self.client = ClickbankAPI(dev_key, api_key)
+        self.transport = mock.Mock()
+        self.client = ClickbankAPI(dev_key, api_key, transport=self.transport)
 
-    @mock.patch('pyramid_bimt.clickbank.requests')
-    def test_get_user_latest_receipt(self, requests):
-        requests.request.return_value.json.return_value = RESPONSES['list_orders']  # noqa
+    def test_get_user_latest_receipt(self):
+        self.transport.request.return_value.json.return_value = RESPONSES['list_orders']  # noqa
         receipt = self.client.get_user_latest_receipt(
             'ipntest', 'john.smith@gmail.com')
 
         self.assertEqual(receipt, 'LPJ9VE42')
 
-    @mock.patch('pyramid_bimt.clickbank.requests')
-    def test_get_user_latest_receipt_only_one_order(self, requests):
+    def test_get_user_latest_receipt_only_one_order(self):
         response = {}
         response['orderData'] = RESPONSES['list_orders']['orderData'][0]
-        requests.request.return_value.json.return_value = response
+        self.transport.request.return_value.json.return_value = response
         receipt = self.client.get_user_latest_receipt(
             'ipntest', 'john.smith@gmail.com')
 
         self.assertEqual(receipt, 'XDWXQSLE')
 
-    @mock.patch('pyramid_bimt.clickbank.requests')
-    def test_get_user_latest_receipt_empty(self, requests):
-        requests.request.return_value.json.return_value = None
+    def test_get_user_latest_receipt_empty(self):
+        self.transport.request.return_value.json.return_value = None
 
         with self.assertRaises(KeyError) as cm:
             self.client.get_user_latest_receipt('foo', 'bar')
         self.assertEqual(
             cm.exception.message, 'No receipt found for email foo.')
 
-    @mock.patch('pyramid_bimt.clickbank.requests')
     @mock.patch.object(ClickbankAPI, 'get_user_latest_receipt')
     def test_change_user_subscription_success(
-            self, get_user_latest_receipt, requests):
+            self, get_user_latest_receipt):
         get_user_latest_receipt.return_value = '1'
 
-        requests.request.return_value.content = ''
+        self.transport.request.return_value.content = ''
         receipt = self.client.change_user_subscription(
             'john.smith@gmail.com', 'ipntest', 'ipntest2')
 
         self.assertEqual(receipt, '1')
 
-    @mock.patch('pyramid_bimt.clickbank.requests')
     @mock.patch.object(ClickbankAPI, 'get_user_latest_receipt')
     def test_change_user_subscription_exception(
-            self, get_user_latest_receipt, requests):
+            self, get_user_latest_receipt):
         from pyramid_bimt.clickbank import ClickbankException
         get_user_latest_receipt.return_value = '1'
 
-        requests.request.return_value.content = 'error'
+        self.transport.request.return_value.content = 'error'
         with self.assertRaises(ClickbankException):
             self.client.change_user_subscription(
                 'john.smith@gmail.com', 'ipntest', 'ipntest2')
@@ -156,3 +163,239 @@ class TestClickbankAPI(unittest.TestCase):
 
         self.assertTrue(date2 > date1)
         self.assertTrue(date3 > date2)
+
+
+class TestParseDate(unittest.TestCase):
+
+    def test_utc(self):
+        self.assertEqual(
+            parse_date('2014-12-18T01:53:59-08:00'),
+            datetime(2014, 12, 18, 9, 53, 59),
+        )
+        self.assertEqual(
+            parse_date('2014-12-18T01:53:59+05:30'),
+            datetime(2014, 12, 17, 20, 23, 59),
+        )
+
+
+class FakeClickbankHandler(BaseHTTPRequestHandler):
+    """Respond like the Clickbank API, over keep-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        self.server.requests.append((
+            self.command,
+            self.path,
+            self.client_address[1],
+            self.headers.get('Page'),
+        ))
+        status = self.server.responses.pop(0) if self.server.responses else 200
+        if status is None:
+            time.sleep(0.5)
+            status = 200
+        body = ''
+        if status in (200, 206) and self.path.startswith('/orders/list'):
+            body = json.dumps(RESPONSES['list_orders'])
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeClickbankServer(ThreadingMixIn, HTTPServer):
+    """Handle each keep-alive connection in its own thread."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # client gave up waiting and closed the connection
+
+
+class TestClickbankAPIServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeClickbankServer(
+            ('127.0.0.1', 0), FakeClickbankHandler)
+        self.server.requests = []
+        self.server.responses = []
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = ClickbankAPI(
+            'dev',
+            'api',
+            api_endpoint='http://127.0.0.1:{}/'.format(
+                self.server.server_port),
+            timeout=0.2,
+            backoff=0,
+        )
+
+    def tearDown(self):
+        self.client.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        self.client.cache_ttl = 0
+        self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        ports = [r[2] for r in self.server.requests]
+        self.assertEqual(len(ports), 2)
+        self.assertEqual(ports[0], ports[1])
+
+    def test_cache(self):
+        self.assertEqual(
+            self.client.get_user_latest_receipt('foo@bar.com', 'ipntest'),
+            'LPJ9VE42',
+        )
+        self.assertEqual(
+            self.client.get_user_latest_receipt('foo@bar.com', 'ipntest'),
+            'LPJ9VE42',
+        )
+        self.assertEqual(len(self.server.requests), 1)
+
+        # changed subscription is no longer cached
+        self.client.change_user_subscription(
+            'foo@bar.com', 'ipntest', 'ipntest2')
+        self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        self.assertEqual(
+            [(r[0], r[1].split('?')[0]) for r in self.server.requests], [
+                ('GET', '/orders/list'),
+                ('POST', '/orders/LPJ9VE42/changeProduct'),
+                ('GET', '/orders/list'),
+            ])
+
+    def test_cache_expired(self):
+        self.client.cache_ttl = 0.01
+        self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        time.sleep(0.02)
+        self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_cache_size(self):
+        self.client.cache_size = 2
+        for email in ['foo@bar.com', 'bar@bar.com', 'baz@bar.com']:
+            self.client.get_user_latest_receipt(email, 'ipntest')
+        self.assertEqual(
+            self.client._receipts.keys(),
+            [('bar@bar.com', 'ipntest'), ('baz@bar.com', 'ipntest')],
+        )
+
+        # the oldest receipt was dropped
+        self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_cache_pruned(self):
+        self.client.cache_ttl = 0.01
+        self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        self.client.get_user_latest_receipt('bar@bar.com', 'ipntest')
+        time.sleep(0.02)
+        self.client.cache_ttl = 60
+        self.client.get_user_latest_receipt('baz@bar.com', 'ipntest')
+        self.assertEqual(
+            self.client._receipts.keys(), [('baz@bar.com', 'ipntest')])
+
+    def test_retry(self):
+        self.server.responses = [503, None]
+        self.assertEqual(
+            self.client.get_user_latest_receipt('foo@bar.com', 'ipntest'),
+            'LPJ9VE42',
+        )
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_give_up(self):
+        self.server.responses = [None, None, None]
+        with self.assertRaises(ClickbankException) as cm:
+            self.client.get_user_latest_receipt('foo@bar.com', 'ipntest')
+        self.assertIn(
+            'Clickbank request GET orders/list failed', str(cm.exception))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_list_orders(self):
+        self.server.responses = [206, 206, 200]
+        pages = list(self.client.list_orders(startDate='2014-12-01'))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(
+            [p[0]['receipt'] for p in pages], ['XDWXQSLE'] * 3)
+        self.assertEqual(
+            [r[3] for r in self.server.requests], ['1', '2', '3'])
+        self.assertEqual(
+            self.server.requests[0][1],
+            '/orders/list?startDate=2014-12-01',
+        )
+
+    def test_list_orders_no_content(self):
+        self.server.responses = [204]
+        self.assertEqual(list(self.client.list_orders()), [])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_list_orders_error(self):
+        self.server.responses = [403]
+        with self.assertRaises(ClickbankException) as cm:
+            list(self.client.list_orders())
+        self.assertEqual(str(cm.exception), 'Clickbank error: 403')
+
+    def test_change_user_subscription_synced_receipt(self):
+        self.client.change_user_subscription(
+            'foo@bar.com', 'ipntest', 'ipntest2', receipt='SYNCED')
+        self.assertEqual(
+            [r[1].split('?')[0] for r in self.server.requests],
+            ['/orders/SYNCED/changeProduct'],
+        )
+
+    def test_post_not_retried(self):
+        self.client._receipts[('foo@bar.com', 'ipntest')] = (
+            time.time() + 60, 'LPJ9VE42')
+        self.server.responses = [503]
+        with self.assertRaises(ClickbankException) as cm:
+            self.client.change_user_subscription(
+                'foo@bar.com', 'ipntest', 'ipntest2')
+        self.assertEqual(str(cm.exception), 'Clickbank error: 503')
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class TestConfigureClickbank(unittest.TestCase):
+
+    def tearDown(self):
+        configure_clickbank({})
+
+    def test_defaults(self):
+        api = configure_clickbank({})
+        self.assertIs(get_clickbank_api(), api)
+        self.assertIsNone(api.dev_key)
+        self.assertEqual(api.timeout, 10)
+        self.assertEqual(api.retries, 2)
+        self.assertEqual(api.backoff, 0.5)
+        self.assertEqual(api.cache_ttl, 60)
+        self.assertEqual(api.cache_size, 1000)
+
+    def test_settings(self):
+        api = configure_clickbank({
+            'bimt.clickbank_dev_key': 'dev',
+            'bimt.clickbank_api_key': 'api',
+            'bimt.clickbank_timeout': '2.5',
+            'bimt.clickbank_retries': '0',
+            'bimt.clickbank_backoff': '1',
+            'bimt.clickbank_cache_ttl': '0',
+            'bimt.clickbank_cache_size': '10',
+        })
+        self.assertEqual(api.dev_key, 'dev')
+        self.assertEqual(api.api_key, 'api')
+        self.assertEqual(api.timeout, 2.5)
+        self.assertEqual(api.retries, 0)
+        self.assertEqual(api.backoff, 1)
+        self.assertEqual(api.cache_ttl, 0)
+        self.assertEqual(api.cache_size, 10)
+
+    def test_session_per_process(self):
+        api = get_clickbank_api()
+        session = api.transport
+        self.assertIs(api.transport, session)
+        with mock.patch('pyramid_bimt.clickbank.os.getpid', return_value=0):
+            self.assertIsNot(api.transport, session)
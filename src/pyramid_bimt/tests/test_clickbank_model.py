@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Tests for the ClickbankReceipt model."""
+
+from datetime import date
+from datetime import datetime
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.models import ClickbankReceipt
+from pyramid_bimt.testing import initTestingDB
+
+import unittest
+
+
+def _order(receipt, date, email='Foo@bar.com', item='1', txn_type='SALE'):
+    return {
+        'receipt': receipt,
+        'txnType': txn_type,
+        'email': email,
+        'item': item,
+        'date': date,
+    }
+
+
+class TestClickbankReceiptModel(unittest.TestCase):
+
+    def setUp(self):
+        initTestingDB()
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test__repr__(self):
+        self.assertEqual(
+            repr(ClickbankReceipt(
+                id=1, receipt='A', txn_type='SALE', email='foo@bar.com')),
+            '<ClickbankReceipt:1 (receipt=\'A\', txn_type=\'SALE\', '
+            'email=\'foo@bar.com\')>',
+        )
+
+    def test_ingest(self):
+        added = ClickbankReceipt.ingest([
+            _order('A', '2014-12-18T01:53:59-08:00'),
+            _order('A', '2014-12-19T01:53:59-08:00', txn_type='RFND'),
+            _order('B', '2014-12-20T01:53:59-08:00', item='2'),
+        ])
+        self.assertEqual(added, 3)
+
+        receipt = ClickbankReceipt.query.filter_by(txn_type='RFND').one()
+        self.assertEqual(receipt.receipt, 'A')
+        self.assertEqual(receipt.email, 'foo@bar.com')
+        self.assertEqual(receipt.product, '1')
+        self.assertEqual(receipt.date, datetime(2014, 12, 19, 9, 53, 59))
+
+    def test_ingest_existing(self):
+        ClickbankReceipt.ingest([_order('A', '2014-12-18T01:53:59-08:00')])
+        added = ClickbankReceipt.ingest([
+            _order('A', '2014-12-18T01:53:59-08:00', email='bar@bar.com'),
+            _order('B', '2014-12-20T01:53:59-08:00'),
+        ])
+        self.assertEqual(added, 1)
+        self.assertEqual(ClickbankReceipt.query.count(), 2)
+        self.assertEqual(
+            ClickbankReceipt.query.filter_by(receipt='A').one().email,
+            'bar@bar.com',
+        )
+
+    def test_ingest_empty(self):
+        self.assertEqual(ClickbankReceipt.ingest([]), 0)
+
+    def test_latest(self):
+        self.assertIsNone(ClickbankReceipt.latest('foo@bar.com', '1'))
+        ClickbankReceipt.ingest([
+            _order('A', '2014-12-20T01:53:59-08:00'),
+            _order('B', '2014-12-19T23:53:59-08:00'),
+            _order('C', '2014-12-21T01:53:59-08:00', item='2'),
+            _order('D', '2014-12-22T01:53:59-08:00', email='bar@bar.com'),
+        ])
+        self.assertEqual(ClickbankReceipt.latest('Foo@bar.com', 1), 'A')
+        self.assertEqual(ClickbankReceipt.latest('foo@bar.com', '2'), 'C')
+
+    def test_latest_payments_only(self):
+        ClickbankReceipt.ingest([
+            _order('A', '2014-12-20T01:53:59-08:00'),
+            _order('B', '2014-12-21T01:53:59-08:00', txn_type='BILL'),
+            _order('B', '2014-12-22T01:53:59-08:00', txn_type='RFND'),
+            _order('C', '2014-12-23T01:53:59-08:00', txn_type='CGBK'),
+        ])
+        self.assertEqual(ClickbankReceipt.latest('foo@bar.com', '1'), 'B')
+
+    def test_latest_since(self):
+        ClickbankReceipt.ingest([
+            _order('A', '2014-12-20T01:53:59-08:00'),
+        ])
+        self.assertEqual(
+            ClickbankReceipt.latest(
+                'foo@bar.com', '1', since=date(2014, 12, 20)),
+            'A',
+        )
+        self.assertIsNone(ClickbankReceipt.latest(
+            'foo@bar.com', '1', since=date(2014, 12, 21)))
+
+    def test_watermark(self):
+        self.assertIsNone(ClickbankReceipt.watermark())
+        ClickbankReceipt.ingest([
+            _order('A', '2014-12-20T01:53:59-08:00'),
+            _order('B', '2014-12-19T01:53:59-08:00'),
+        ])
+        self.assertEqual(
+            ClickbankReceipt.watermark(), datetime(2014, 12, 20, 9, 53, 59))
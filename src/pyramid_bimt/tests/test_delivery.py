@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Tests for sending mailings in the background."""
+
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt import add_routes_user
+from pyramid_bimt.delivery import deliver_mailing
+from pyramid_bimt.delivery import pending_mailing_ids
+from pyramid_bimt.delivery import send_in_background
+from pyramid_bimt.delivery import send_mailing
+from pyramid_bimt.locking import LockTimeout
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import MailingDelivery
+from pyramid_bimt.models import User
+from pyramid_bimt.scripts.resume_mailings import resume_mailings
+from pyramid_bimt.testing import initTestingDB
+from pyramid_mailer import get_mailer
+from threading import Event
+
+import mock
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+SETTINGS = {
+    'mail.default_sender': 'admin@bimt.com',
+    'bimt.app_title': 'BIMT',
+}
+
+
+def _add_mailing(users=3, name='foo', body=u'Hi ${user.fullname}!'):
+    """Add a mailing to a group with ``users`` members, return its id."""
+    group = Group(name=name, users=[
+        User(
+            email='{}{}@bar.com'.format(name, i),
+            fullname=u'Üser {}'.format(i),
+        ) for i in range(users)
+    ])
+    mailing = Mailing(
+        name=name, groups=[group], days=0, subject=u'Süb', body=body)
+    Session.add(mailing)
+    Session.flush()
+    return mailing.id
+
+
+def _statuses(mailing_id):
+    with transaction.manager:
+        return [d.status for d in MailingDelivery.query.filter_by(
+            mailing_id=mailing_id).order_by(MailingDelivery.user_id)]
+
+
+class TestDeliverMailing(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings=SETTINGS)
+        self.config.include('pyramid_mailer.testing')
+        self.config.include('pyramid_chameleon')
+        add_routes_user(self.config)
+        self.request = testing.DummyRequest()
+        initTestingDB()
+        with transaction.manager:
+            self.mailing_id = _add_mailing()
+            Mailing.by_id(self.mailing_id).queue_deliveries()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def test_send_all(self):
+        self.assertEqual(
+            deliver_mailing(self.mailing_id, self.request, batch_size=2),
+            (3, 0),
+        )
+        self.assertEqual(_statuses(self.mailing_id), ['sent'] * 3)
+
+        outbox = get_mailer(self.request).outbox
+        self.assertEqual(
+            [m.recipients for m in outbox],
+            [['foo0@bar.com'], ['foo1@bar.com'], ['foo2@bar.com']],
+        )
+        self.assertEqual(outbox[0].subject, u'Süb')
+        self.assertIn(u'Hi Üser 0!', outbox[0].html)
+        self.assertIn('BIMT Team', outbox[0].html)
+
+    @mock.patch('pyramid_bimt.delivery.MailingRenderer')
+    def test_one_renderer_per_batch(self, MailingRenderer):
+        MailingRenderer.return_value.return_value = (u'Sub', u'Hi!')
+        deliver_mailing(self.mailing_id, self.request, batch_size=2)
+        self.assertEqual(MailingRenderer.call_count, 2)
+        self.assertEqual(MailingRenderer.return_value.call_count, 3)
+        self.assertEqual(len(get_mailer(self.request).outbox), 3)
+
+    def test_batches_committed(self):
+        with mock.patch('pyramid_bimt.delivery.logger') as logger:
+            deliver_mailing(self.mailing_id, self.request, batch_size=2)
+        self.assertEqual(logger.info.call_args_list, [
+            mock.call('Mailing {}: 2 sent, 0 failed.'.format(
+                self.mailing_id)),
+            mock.call('Mailing {}: 3 sent, 0 failed.'.format(
+                self.mailing_id)),
+        ])
+
+    def test_resume(self):
+        with transaction.manager:
+            first = MailingDelivery.query.order_by(
+                MailingDelivery.user_id).first()
+            first.status = 'sent'
+
+        self.assertEqual(
+            deliver_mailing(self.mailing_id, self.request), (2, 0))
+        self.assertEqual(
+            [m.recipients for m in get_mailer(self.request).outbox],
+            [['foo1@bar.com'], ['foo2@bar.com']],
+        )
+
+    @mock.patch('pyramid_bimt.delivery.logger')
+    def test_send_failed(self, logger):
+        def send(mailing, user, renderer=None):
+            if user.email == 'foo1@bar.com':
+                raise ValueError(u'Invalid recipient.')
+
+        with mock.patch.object(Mailing, 'send', send):
+            self.assertEqual(
+                deliver_mailing(self.mailing_id, self.request), (2, 1))
+        self.assertEqual(
+            _statuses(self.mailing_id), ['sent', 'failed', 'sent'])
+        with transaction.manager:
+            self.assertEqual(
+                MailingDelivery.query.filter_by(status='failed').one().error,
+                u'Invalid recipient.',
+            )
+        self.assertTrue(logger.exception.called)
+
+    @mock.patch('pyramid_bimt.delivery.lock')
+    def test_batch_not_committed(self, lock):
+        lock.side_effect = ValueError('Mail server is down.')
+        with mock.patch('pyramid_bimt.delivery.logger') as logger:
+            self.assertEqual(
+                deliver_mailing(self.mailing_id, self.request), (0, 0))
+        self.assertEqual(str(logger.exception.call_args[0][0]),
+                         'Mail server is down.')
+        self.assertEqual(_statuses(self.mailing_id), ['pending'] * 3)
+
+    @mock.patch('pyramid_bimt.delivery.lock')
+    def test_sent_by_another_worker(self, lock):
+        lock.side_effect = LockTimeout
+        self.assertEqual(
+            deliver_mailing(self.mailing_id, self.request), (0, 0))
+        self.assertEqual(_statuses(self.mailing_id), ['pending'] * 3)
+
+    def test_pending_mailing_ids(self):
+        with transaction.manager:
+            other_id = _add_mailing(name='bar')
+            Mailing.by_id(other_id).queue_deliveries()
+            self.assertEqual(
+                pending_mailing_ids(), [self.mailing_id, other_id])
+
+        deliver_mailing(self.mailing_id, self.request)
+        with transaction.manager:
+            self.assertEqual(pending_mailing_ids(), [other_id])
+
+    def test_resume_mailings(self):
+        with transaction.manager:
+            Mailing.by_id(_add_mailing(name='bar')).queue_deliveries()
+
+        self.assertEqual(resume_mailings(self.request, batch_size=2), (6, 0))
+        self.assertEqual(len(get_mailer(self.request).outbox), 6)
+        with transaction.manager:
+            self.assertEqual(pending_mailing_ids(), [])
+
+
+class TestSendMailing(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings=SETTINGS)
+        self.request = testing.DummyRequest()
+        initTestingDB()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    @mock.patch('pyramid_bimt.delivery.send_in_background')
+    def test_started_after_commit(self, send_in_background):
+        mailing_id = _add_mailing()
+        self.assertEqual(
+            send_mailing(Mailing.by_id(mailing_id), self.request), 3)
+        self.assertFalse(send_in_background.called)
+        transaction.commit()
+        send_in_background.assert_called_once_with(
+            mailing_id, self.request, 100)
+
+    @mock.patch('pyramid_bimt.delivery.send_in_background')
+    def test_batch_size(self, send_in_background):
+        self.config.registry.settings['bimt.mailing_batch_size'] = '20'
+        mailing = Mailing.by_id(_add_mailing())
+        send_mailing(mailing, self.request)
+        transaction.commit()
+        self.assertEqual(send_in_background.call_args[0][2], 20)
+
+    @mock.patch('pyramid_bimt.delivery.send_in_background')
+    def test_not_started_on_abort(self, send_in_background):
+        send_mailing(Mailing.by_id(_add_mailing()), self.request)
+        transaction.abort()
+        self.assertFalse(send_in_background.called)
+
+    @mock.patch('pyramid_bimt.delivery.send_in_background')
+    def test_not_started_after_failed_commit(self, send_in_background):
+        send_mailing(Mailing.by_id(_add_mailing()), self.request)
+        failing = mock.Mock(spec=[
+            'abort', 'tpc_begin', 'commit', 'tpc_vote', 'tpc_finish',
+            'tpc_abort', 'sortKey'])
+        failing.sortKey.return_value = 'z'
+        failing.tpc_vote.side_effect = ValueError
+        transaction.get().join(failing)
+        with self.assertRaises(ValueError):
+            transaction.commit()
+        self.assertFalse(send_in_background.called)
+
+
+class TestSendInBackground(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings=SETTINGS)
+        self.config.include('pyramid_mailer.testing')
+        self.config.include('pyramid_chameleon')
+        add_routes_user(self.config)
+        self.request = testing.DummyRequest()
+        self.request.registry = self.config.registry
+        self.tmpdir = tempfile.mkdtemp()
+        # the thread needs a shared database, not its own in-memory database
+        initTestingDB(
+            url='sqlite:///{}'.format(os.path.join(self.tmpdir, 'test.db')))
+        with transaction.manager:
+            self.mailing_id = _add_mailing()
+            Mailing.by_id(self.mailing_id).queue_deliveries()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_send(self):
+        thread = send_in_background(self.mailing_id, self.request, 2)
+        self.assertTrue(thread.daemon)
+        thread.join()
+        self.assertEqual(_statuses(self.mailing_id), ['sent'] * 3)
+        self.assertEqual(len(get_mailer(self.request).outbox), 3)
+
+    @mock.patch('pyramid_bimt.delivery.deliver_mailing')
+    def test_one_thread_per_mailing(self, deliver_mailing):
+        sending = Event()
+        deliver_mailing.side_effect = lambda *args: sending.wait(5)
+        first = send_in_background(self.mailing_id, self.request)
+        self.assertIsNone(send_in_background(self.mailing_id, self.request))
+        sending.set()
+        first.join()
+        second = send_in_background(self.mailing_id, self.request)
+        second.join()
+        self.assertEqual(deliver_mailing.call_count, 2)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Tests for background forwarding of IPN requests."""
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.forwarding import IPNForwarder
+from pyramid_bimt.forwarding import configure_forwarding
+from pyramid_bimt.forwarding import forward_ipn
+from pyramid_bimt.forwarding import get_forwarder
+from pyramid_bimt.models import IPNForward
+from pyramid_bimt.testing import initTestingDB
+from threading import Thread
+
+import mock
+import time
+import transaction
+import unittest
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Respond with the next status code of the server's ``responses``."""
+
+    def do_POST(self):
+        self.server.requests.append(self.path)
+        status = self.server.responses.pop(0) if self.server.responses else 200
+        if status is None:
+            time.sleep(0.5)
+            status = 200
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServerMixin(object):
+    """Run a local HTTP stub that IPNs are forwarded to."""
+
+    def start_stub(self, responses=None):
+        self.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.responses = list(responses or [])
+        self.url = 'http://127.0.0.1:{}/ipn'.format(self.server.server_port)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop_stub(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestIPNForwarderPost(StubServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.start_stub()
+        self.forwarder = IPNForwarder(workers=1, timeout=0.2, backoff=0)
+
+    def tearDown(self):
+        self.forwarder.close()
+        self.stop_stub()
+
+    def test_success(self):
+        self.assertIsNone(self.forwarder.post(self.url, [('foo', 'bar')]))
+        self.assertEqual(self.server.requests, ['/ipn?foo=bar'])
+
+    def test_retry(self):
+        self.server.responses = [500, 503]
+        self.assertIsNone(self.forwarder.post(self.url, [('foo', 'bar')]))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_give_up(self):
+        self.server.responses = [500, 500, 500, 500]
+        error = self.forwarder.post(self.url, [('foo', 'bar')])
+        self.assertIn('500', error)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_timeout(self):
+        self.forwarder.retries = 0
+        self.server.responses = [None]
+        error = self.forwarder.post(self.url, [('foo', 'bar')])
+        self.assertIn('timed out', error)
+
+    @mock.patch('pyramid_bimt.forwarding.time')
+    def test_backoff(self, mocked_time):
+        self.forwarder.backoff = 1.5
+        self.server.responses = [500, 500, 500]
+        self.forwarder.post(self.url, [])
+        self.assertEqual(
+            [c[0][0] for c in mocked_time.sleep.call_args_list],
+            [1.5, 3.0, 6.0],
+        )
+
+    def test_per_target_slots(self):
+        slots = self.forwarder._target_slots(self.url)
+        self.assertIs(slots, self.forwarder._target_slots(self.url + '?a=b'))
+        self.assertIsNot(
+            slots, self.forwarder._target_slots('http://example.com/'))
+
+        # all slots for the target are taken
+        for i in range(self.forwarder.per_target):
+            slots.acquire()
+        self.assertFalse(slots.acquire(False))
+        for i in range(self.forwarder.per_target):
+            slots.release()
+
+    def test_session_reused(self):
+        self.forwarder.post(self.url, [])
+        session = self.forwarder._session
+        self.forwarder.post(self.url, [])
+        self.assertIs(self.forwarder._session, session)
+
+
+class TestIPNForwarderWorkers(unittest.TestCase):
+
+    def test_submit(self):
+        forwarder = IPNForwarder(workers=2)
+        forwarder.deliver = mock.Mock(side_effect=[True, Exception('boom')])
+
+        forwarder.submit(1)
+        forwarder.submit(2)
+        forwarder.join()
+        self.assertEqual(
+            sorted(c[0][0] for c in forwarder.deliver.call_args_list),
+            [1, 2],
+        )
+
+        queue = forwarder._queue
+        forwarder.close()
+        queue.join()
+        self.assertIsNone(forwarder._pid)
+
+    def test_close_not_started(self):
+        forwarder = IPNForwarder()
+        forwarder.close()
+        self.assertIsNone(forwarder._queue)
+
+
+class TestDeliver(StubServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+        initTestingDB()
+        self.start_stub()
+        self.forwarder = IPNForwarder(workers=1, retries=1, backoff=0)
+        with transaction.manager:
+            Session.add(IPNForward(
+                id=1, url=self.url, params=u'[["foo", "bar"]]'))
+
+    def tearDown(self):
+        self.forwarder.close()
+        self.stop_stub()
+        Session.remove()
+        testing.tearDown()
+
+    def test_delivered(self):
+        self.assertTrue(self.forwarder.deliver(1))
+        self.assertEqual(self.server.requests, ['/ipn?foo=bar'])
+        self.assertIsNone(IPNForward.by_id(1))
+
+    def test_already_delivered(self):
+        self.assertTrue(self.forwarder.deliver(2))
+        self.assertEqual(self.server.requests, [])
+
+    def test_failed(self):
+        self.server.responses = [500, 500, 500, 500]
+        self.assertFalse(self.forwarder.deliver(1))
+        self.assertFalse(self.forwarder.deliver(1))
+
+        forward = IPNForward.by_id(1)
+        self.assertEqual(forward.attempts, 2)
+        self.assertIn('500', forward.last_error)
+
+
+class TestForwardIPN(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+        initTestingDB()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    @mock.patch('pyramid_bimt.forwarding._forwarder')
+    def test_submitted_after_commit(self, forwarder):
+        forward = forward_ipn('http://example.com', [('foo', 'bar')])
+        forward_id = forward.id
+        self.assertFalse(forwarder.submit.called)
+
+        transaction.commit()
+        forwarder.submit.assert_called_once_with(forward_id)
+        forward = IPNForward.by_id(forward_id)
+        self.assertEqual(forward.url, 'http://example.com')
+        self.assertEqual(forward.params, u'[["foo", "bar"]]')
+        self.assertEqual(forward.attempts, 0)
+
+    @mock.patch('pyramid_bimt.forwarding._forwarder')
+    def test_not_submitted_after_abort(self, forwarder):
+        forward_ipn('http://example.com', [('foo', 'bar')])
+        transaction.abort()
+        self.assertFalse(forwarder.submit.called)
+        self.assertEqual(IPNForward.query.count(), 0)
+
+    @mock.patch('pyramid_bimt.forwarding._forwarder')
+    def test_not_submitted_after_failed_commit(self, forwarder):
+        forward_ipn('http://example.com', [('foo', 'bar')])
+        failing = mock.Mock(spec=[
+            'abort', 'tpc_begin', 'commit', 'tpc_vote', 'tpc_finish',
+            'tpc_abort', 'sortKey'])
+        failing.sortKey.return_value = 'z'
+        failing.tpc_vote.side_effect = ValueError
+        transaction.get().join(failing)
+        with self.assertRaises(ValueError):
+            transaction.commit()
+        transaction.abort()
+        self.assertFalse(forwarder.submit.called)
+
+
+class TestConfigureForwarding(unittest.TestCase):
+
+    def tearDown(self):
+        configure_forwarding({})
+
+    def test_defaults(self):
+        forwarder = configure_forwarding({})
+        self.assertIs(get_forwarder(), forwarder)
+        self.assertEqual(forwarder.workers, 2)
+        self.assertEqual(forwarder.timeout, 10)
+        self.assertEqual(forwarder.retries, 3)
+        self.assertEqual(forwarder.backoff, 1)
+        self.assertEqual(forwarder.per_target, 2)
+
+    def test_settings(self):
+        forwarder = configure_forwarding({
+            'bimt.ipn_forward_workers': '4',
+            'bimt.ipn_forward_timeout': '2.5',
+            'bimt.ipn_forward_retries': '5',
+            'bimt.ipn_forward_backoff': '0.5',
+            'bimt.ipn_forward_per_target': '1',
+        })
+        self.assertEqual(forwarder.workers, 4)
+        self.assertEqual(forwarder.timeout, 2.5)
+        self.assertEqual(forwarder.retries, 5)
+        self.assertEqual(forwarder.backoff, 0.5)
+        self.assertEqual(forwarder.per_target, 1)
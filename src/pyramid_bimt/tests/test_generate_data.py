@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Tests for the generate_data script."""
+
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.models import AuditLogEntry
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import Portlet
+from pyramid_bimt.models import User
+from pyramid_bimt.models import UserProperty
+from pyramid_bimt.scripts.generate_data import generate_data
+from pyramid_bimt.testing import initTestingDB
+
+import datetime
+import mock
+import transaction
+import unittest
+
+VOLUMES = dict(
+    users=200,
+    groups=5,
+    properties=300,
+    audit_entries=500,
+    portlets=4,
+    mailings=3,
+)
+
+
+def _dump():
+    """Return generated rows as plain tuples, to compare datasets."""
+    with transaction.manager:
+        return (
+            [(u.id, u.email, u.fullname, u.valid_to, u.last_payment,
+              u.created, sorted(g.name for g in u.groups))
+             for u in User.query.order_by(User.id)],
+            [(p.user_id, p.key, p.value)
+             for p in UserProperty.query.order_by(UserProperty.id)],
+            [(e.user_id, e.event_type_id, e.timestamp, e.read)
+             for e in AuditLogEntry.query.order_by(AuditLogEntry.id)],
+            [(m.name, m.trigger, m.days, sorted(g.name for g in m.groups))
+             for m in Mailing.query.order_by(Mailing.id)],
+        )
+
+
+class TestGenerateData(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp(settings={
+            'bimt.encryption_aes_16b_key': 'abcdabcdabcdabcd'})
+        initTestingDB()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test_volumes(self):
+        counts = generate_data(chunk_size=100, **VOLUMES)
+        self.assertEqual(counts['users'], 200)
+        self.assertEqual(counts['groups'], 5)
+        self.assertEqual(counts['audit_log_entries'], 500)
+        self.assertEqual(counts['portlets'], 4)
+        self.assertEqual(counts['mailings'], 3)
+        self.assertAlmostEqual(counts['user_properties'], 300, delta=30)
+
+        with transaction.manager:
+            self.assertEqual(User.query.count(), 200)
+            # the default groups are added first
+            self.assertEqual(Group.query.count(), 6 + 5)
+            self.assertEqual(
+                UserProperty.query.count(), counts['user_properties'])
+            self.assertEqual(AuditLogEntry.query.count(), 500)
+
+    def test_distributions(self):
+        generate_data(**VOLUMES)
+        with transaction.manager:
+            enabled = len(Group.by_name('enabled').users)
+            self.assertTrue(120 < enabled < 200, enabled)
+            self.assertTrue(len(Group.by_name('trial').users) < enabled)
+
+            for user in User.query:
+                products = [
+                    g for g in user.groups if g.product_id and not g.addon]
+                self.assertLessEqual(len(products), 1)
+                self.assertLessEqual(user.created.date(), user.valid_to)
+                self.assertLessEqual(
+                    user.created.date(), datetime.date(2015, 1, 1))
+
+            newest = AuditLogEntry.query.order_by(
+                AuditLogEntry.timestamp.desc()).first().timestamp
+            self.assertLessEqual(newest, datetime.datetime(2015, 1, 1))
+
+    def test_api_keys(self):
+        generate_data(**VOLUMES)
+        with transaction.manager:
+            users = [
+                User.by_id(p.user_id)
+                for p in UserProperty.query.filter_by(key=u'api_key')
+            ]
+            self.assertTrue(users)
+            for user in users:
+                self.assertRegexpMatches(
+                    user.get_property(u'api_key', secure=True),
+                    '^[0-9a-f]{32}$',
+                )
+
+    def test_deterministic(self):
+        generate_data(seed=42, **VOLUMES)
+        first = _dump()
+
+        Session.remove()
+        initTestingDB()
+        generate_data(seed=42, **VOLUMES)
+        self.assertEqual(_dump(), first)
+
+        Session.remove()
+        initTestingDB()
+        generate_data(seed=43, **VOLUMES)
+        self.assertNotEqual(_dump(), first)
+
+    def test_existing_data(self):
+        Session.remove()
+        initTestingDB(
+            groups=True, users=True, auditlog_types=True, mailings=True,
+            portlets=True, auditlog_entries=True,
+        )
+        generate_data(**VOLUMES)
+        generate_data(**VOLUMES)
+        with transaction.manager:
+            self.assertEqual(User.query.count(), 3 + 2 * 200)
+            self.assertEqual(Portlet.query.count(), 1 + 2 * 4)
+            self.assertEqual(
+                User.by_email('one@bar.com').fullname, u'Öne Bar')
+
+    def test_until(self):
+        generate_data(users=20, until=datetime.date(2014, 6, 1))
+        with transaction.manager:
+            self.assertLessEqual(
+                Session.query(AuditLogEntry.timestamp).order_by(
+                    AuditLogEntry.timestamp.desc()).first()[0],
+                datetime.datetime(2014, 6, 1),
+            )
+
+    def test_no_groups(self):
+        counts = generate_data(
+            users=20, groups=0, portlets=10, mailings=10, seed=1)
+        self.assertEqual(counts['portlets'], 10)
+        self.assertEqual(counts['mailings'], 10)
+        with transaction.manager:
+            for portlet in Portlet.query:
+                self.assertTrue(
+                    set(g.name for g in portlet.groups) <= set([
+                        'enabled', 'trial']))
+
+    def test_no_users(self):
+        counts = generate_data(users=0, properties=0, audit_entries=10)
+        self.assertNotIn('users', counts)
+        self.assertNotIn('audit_log_entries', counts)
+        self.assertEqual(counts['mailings'], 10)
+
+    @mock.patch('pyramid_bimt.scripts.generate_data.Session.execute')
+    @mock.patch('pyramid_bimt.scripts.generate_data.Session.get_bind')
+    def test_postgresql_sequences(self, get_bind, execute):
+        get_bind.return_value.dialect.name = 'postgresql'
+        generate_data(users=0, groups=0, portlets=0, mailings=0)
+        statements = [str(c[0][0]) for c in execute.call_args_list]
+        self.assertIn(
+            "SELECT setval(pg_get_serial_sequence('users', 'id'), "
+            "(SELECT max(id) FROM users))",
+            statements,
+        )
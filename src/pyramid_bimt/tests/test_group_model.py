@@ -7,6 +7,7 @@ from pyramid.security import DENY_ALL
 from pyramid_basemodel import Session
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import GroupProperty
+from pyramid_bimt.models import User
 from pyramid_bimt.testing import initTestingDB
 from sqlalchemy.exc import IntegrityError
 
@@ -146,6 +147,34 @@ class TestGetAll(unittest.TestCase):
         self.assertEqual(len(groups), 1)
         self.assertEqual(groups[0].name, 'bar')
 
+    def test_with_member_count(self):
+        foo = _make_group(name='foo')
+        bar = _make_group(name='bar')
+        _make_group(name='baz')
+        Session.add(User(email='one@bar.com', groups=[foo, bar]))
+        Session.add(User(email='two@bar.com', groups=[foo]))
+        Session.flush()
+        Session.expunge_all()
+
+        groups = Group.get_all(with_member_count=True).all()
+        self.assertEqual(
+            [(group.name, count) for group, count in groups],
+            [('bar', 1), ('baz', 0), ('foo', 2)],
+        )
+        self.assertNotIn('users', groups[0][0].__dict__)
+
+    def test_with_member_count_filter_by_and_limit(self):
+        foo = _make_group(name='foo')
+        _make_group(name='bar')
+        Session.add(User(email='one@bar.com', groups=[foo]))
+        Session.flush()
+
+        groups = Group.get_all(
+            with_member_count=True, filter_by={'name': 'foo'}).all()
+        self.assertEqual(groups, [(foo, 1)])
+        groups = Group.get_all(with_member_count=True, limit=1).all()
+        self.assertEqual(groups[0].member_count, 0)
+
 
 class TestGroupProperties(unittest.TestCase):
 
@@ -6,13 +6,17 @@ from pyramid import testing
 from pyramid.httpexceptions import HTTPFound
 from pyramid_basemodel import Session
 from pyramid_bimt import add_routes_group
+from pyramid_bimt import configure
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import GroupProperty
 from pyramid_bimt.models import User
+from pyramid_bimt.testing import assert_query_count
 from pyramid_bimt.testing import initTestingDB
+from sqlalchemy import event
 
 import mock
 import unittest
+import webtest
 
 
 def _make_group(
@@ -77,14 +81,67 @@ class TestGroupList(unittest.TestCase):
     @mock.patch('pyramid_bimt.views.group.Group')
     def test_result(self, Group):
         group = _make_group()
-        Group.get_all.return_value.all.return_value = [group, ]
+        Group.get_all.return_value.all.return_value = [(group, 2), ]
         result = self.view.list()
 
+        Group.get_all.assert_called_with(with_member_count=True)
         self.assertEqual(result, {
-            'groups': [group, ],
+            'groups': [(group, 2), ],
         })
 
 
+class TestGroupListIntegration(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        initTestingDB(groups=True, users=True)
+        configure(self.config)
+        self.config.testing_securitypolicy(
+            userid='admin@bar.com', permissive=True)
+        self.testapp = webtest.TestApp(self.config.make_wsgi_app())
+
+        self.statements = []
+        event.listen(
+            Session.get_bind(), 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        event.remove(
+            Session.get_bind(), 'before_cursor_execute', self.record)
+        Session.remove()
+        testing.tearDown()
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_member_counts(self):
+        resp = self.testapp.get('/groups/')
+        self.assertIn('<h1>Groups (6)</h1>', resp.text)
+        rows = resp.html.find_all('tr')[1:]
+        counts = dict(
+            (row.find_all('td')[1].text, row.find_all('td')[6].text)
+            for row in rows
+        )
+        self.assertEqual(counts['admins'], '1')
+        self.assertEqual(counts['enabled'], str(
+            len(Group.by_name('enabled').users)))
+        self.assertEqual(counts['impersonators'], '0')
+
+    def test_users_not_loaded(self):
+        self.testapp.get('/groups/')
+        group_queries = [s for s in self.statements if 'groups' in s]
+        self.assertEqual(len(group_queries), 1)
+        self.assertIn('count(user_group.user_id)', group_queries[0])
+        # only the logged in user is loaded, not members of groups
+        self.assertFalse([
+            s for s in self.statements
+            if 'FROM users' in s and 'user_group' in s
+        ])
+
+    def test_query_count(self):
+        with assert_query_count(4):
+            self.testapp.get('/groups/')
+
+
 class TestGroupAdd(unittest.TestCase):
 
     APPSTRUCT = {
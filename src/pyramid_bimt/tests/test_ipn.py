@@ -4,20 +4,39 @@
 from datetime import date
 from datetime import timedelta
 from pyramid import testing
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid_basemodel import Session
 from pyramid_bimt import add_routes_auth
 from pyramid_bimt import configure
+from pyramid_bimt import register_utilities
+from pyramid_bimt.models import AuditLogEntry
 from pyramid_bimt.models import Group
+from pyramid_bimt.models import IPNTransaction
 from pyramid_bimt.models import User
+from pyramid_bimt.testing import assert_query_count
 from pyramid_bimt.testing import initTestingDB
 from pyramid_bimt.utils import AttrDict
+from pyramid_bimt.views.ipn import IIPNProvider
+from pyramid_bimt.views.ipn import IPNConflict
+from pyramid_bimt.views.ipn import IPNParams
+from pyramid_bimt.views.ipn import IPNProvider
 from pyramid_bimt.views.ipn import IPNView
+from pyramid_bimt.views.ipn import JVZooProvider
 from pyramid_mailer import get_mailer
+from sqlalchemy.exc import IntegrityError
+from threading import Thread
+from zope.interface import implementer
 from zope.testing.loggingsupport import InstalledHandler
 
+import hashlib
 import json
 import mock
+import os
+import shutil
+import tempfile
+import transaction
 import unittest
+import warnings
 import webtest
 
 handler = InstalledHandler('pyramid_bimt.views.ipn')
@@ -41,6 +60,7 @@ class TestJVZoo(unittest.TestCase):
             'bimt.jvzoo_secret_key': 'secret',
         }
         self.config = testing.setUp(settings=settings)
+        register_utilities(self.config)
 
     def test_no_POST(self):
         request = testing.DummyRequest()
@@ -82,6 +102,7 @@ class TestClickbank(unittest.TestCase):
             'bimt.app_title': 'BIMT',
         }
         self.config = testing.setUp(settings=settings)
+        register_utilities(self.config)
 
     def test_no_JSON(self):
         request = testing.DummyRequest()
@@ -101,6 +122,176 @@ class TestClickbank(unittest.TestCase):
             view.clickbank()
         self.assertIn('Decryption failed: ', cm.exception.message)
 
+    def test_deprecated(self):
+        from pyramid_bimt.views.ipn import ClickbankProvider
+        from pyramid_bimt.views.ipn import MAPPING_CLICKBANK
+        self.assertIs(MAPPING_CLICKBANK, ClickbankProvider.mapping)
+
+        view = IPNView(testing.DummyRequest())
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with self.assertRaises(ValueError) as cm:
+                view._parse_request_clickbank()
+        self.assertEqual(cm.exception.message, 'No JSON request.')
+        self.assertEqual(caught[0].category, DeprecationWarning)
+
+
+class TestIPNParams(unittest.TestCase):
+
+    def test_defaults(self):
+        params = IPNParams(email='foo@bar.com')
+        self.assertEqual(params.email, 'foo@bar.com')
+        self.assertIsNone(params.affiliate)
+        self.assertEqual(params.get('affiliate', ''), '')
+        self.assertEqual(params.get('email'), 'foo@bar.com')
+
+    def test_dict(self):
+        params = IPNParams({'email': 'foo@bar.com'}, foo='bar')
+        self.assertEqual(params['email'], 'foo@bar.com')
+        self.assertIsNone(params['trans_id'])
+        self.assertEqual(params.foo, 'bar')
+        params.bar = 'baz'
+        self.assertEqual(params['bar'], 'baz')
+        self.assertIsInstance(params, AttrDict)
+
+
+class TestIPNProviders(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'bimt.jvzoo_secret_key': 'secret',
+        })
+        register_utilities(self.config)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _sign(self, post):
+        values = [v for k, v in sorted(post.items())] + ['secret']
+        strparams = '|'.join(values)
+        if isinstance(strparams, unicode):
+            strparams = strparams.encode('utf-8')
+        post['cverify'] = hashlib.sha1(strparams).hexdigest()[:8].upper()
+        return post
+
+    def test_jvzoo_parse_bytes(self):
+        post = self._sign({
+            'ccustname': u'Föo Bar'.encode('utf-8'),
+            'ccustemail': 'Foo@Bar.com',
+        })
+        params = JVZooProvider().parse(testing.DummyRequest(post=post))
+        self.assertEqual(params.fullname, u'Föo Bar')
+        self.assertEqual(params.email, 'foo@bar.com')
+        self.assertIsNone(params.affiliate)
+
+    def test_jvzoo_parse(self):
+        post = {
+            'ccustname': u'Föo Bar',
+            'ccustemail': 'Foo@Bar.com',
+            'cproditem': '1',
+            'ctransaction': 'SALE',
+            'ctransreceipt': '123',
+            'ctransaffiliate': 'Aff@Bar.com',
+            'cfoo': 'bar',
+        }
+        self._sign(post)
+
+        params = JVZooProvider().parse(testing.DummyRequest(post=post))
+        self.assertEqual(params.fullname, u'Föo Bar')
+        self.assertEqual(params.email, 'foo@bar.com')
+        self.assertEqual(params.affiliate, 'aff@bar.com')
+        self.assertEqual(params.product_id, '1')
+        self.assertEqual(params.trans_type, 'SALE')
+        self.assertEqual(params.trans_id, '123')
+
+    def test_jvzoo_deprecated(self):
+        from pyramid_bimt.views.ipn import MAPPING_JVZOO
+        self.assertIs(MAPPING_JVZOO, JVZooProvider.mapping)
+
+        post = self._sign({'ccustemail': 'Foo@Bar.com', 'cproditem': '1'})
+        view = IPNView(testing.DummyRequest(post=post))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            view._parse_request_jvzoo()
+        self.assertEqual(caught[0].category, DeprecationWarning)
+        self.assertEqual(view.params.email, 'foo@bar.com')
+        self.assertEqual(view.params['product_id'], '1')
+
+    def test_unknown_provider(self):
+        request = testing.DummyRequest()
+        request.matchdict = {'provider': 'foo'}
+        with self.assertRaises(HTTPNotFound) as cm:
+            IPNView(request).ipn_provider()
+        self.assertEqual(cm.exception.message, 'Unknown IPN provider: foo')
+
+    @mock.patch('pyramid_bimt.views.ipn.IPNView.ipn')
+    def test_custom_provider(self, ipn):
+        @implementer(IIPNProvider)
+        class FooProvider(IPNProvider):
+            mapping = {'mail': 'email', 'product': 'product_id'}
+
+            def parse(self, request):
+                return self.params(request.GET.items())
+
+        self.config.registry.registerUtility(
+            FooProvider, IIPNProvider, name='foo')
+        request = testing.DummyRequest(
+            params={'mail': 'Foo@Bar.com', 'product': '1', 'bar': 'baz'})
+        request.matchdict = {'provider': 'foo'}
+        ipn.return_value = 'Done.'
+
+        view = IPNView(request)
+        self.assertEqual(view.ipn_provider(), 'Done.')
+        self.assertEqual(view.provider, 'foo')
+        self.assertEqual(view.params.email, 'foo@bar.com')
+        self.assertEqual(view.params.product_id, '1')
+        self.assertIsNone(view.params.fullname)
+
+    @mock.patch('pyramid_bimt.views.ipn.IPNView.ipn')
+    def test_retry_ipn(self, ipn):
+        ipn.side_effect = [IPNConflict('Conflict!'), 'Done.']
+        request = testing.DummyRequest()
+        view = IPNView(request)
+        view.params = IPNParams(email='foo@bar.com')
+        txn = transaction.begin()
+        self.assertEqual(view.retry_ipn(), 'Done.')
+        self.assertEqual(ipn.call_count, 2)
+        # the IPN is retried in the same transaction
+        self.assertIs(transaction.get(), txn)
+        transaction.abort()
+
+    @mock.patch('pyramid_bimt.views.ipn.IPNView.ipn')
+    def test_retry_ipn_attempts(self, ipn):
+        self.config.registry.settings['bimt.ipn_attempts'] = '2'
+        ipn.side_effect = IPNConflict('Conflict!')
+        view = IPNView(testing.DummyRequest())
+        view.params = IPNParams(email='foo@bar.com')
+        with self.assertRaises(IPNConflict):
+            view.retry_ipn()
+        self.assertEqual(ipn.call_count, 2)
+        transaction.abort()
+
+    @mock.patch('pyramid_bimt.views.ipn.IPNView.ipn')
+    def test_retry_ipn_no_savepoints(self, ipn):
+        ipn.side_effect = [IPNConflict('Conflict!'), 'Done.']
+        view = IPNView(testing.DummyRequest())
+        view.params = IPNParams(email='foo@bar.com')
+        transaction.begin()
+        transaction.get().join(mock.Mock(spec=['abort', 'sortKey']))
+        with self.assertRaises(IPNConflict):
+            view.retry_ipn()
+        self.assertEqual(ipn.call_count, 1)
+        transaction.abort()
+
+    @mock.patch('pyramid_bimt.views.ipn.IPNView.ipn')
+    def test_retry_ipn_other_errors(self, ipn):
+        ipn.side_effect = ValueError('Boom!')
+        view = IPNView(testing.DummyRequest())
+        view.params = IPNParams(email='foo@bar.com')
+        with self.assertRaises(ValueError):
+            view.retry_ipn()
+        self.assertEqual(ipn.call_count, 1)
+
 
 class TestIPNHandler(unittest.TestCase):
 
@@ -108,6 +299,7 @@ class TestIPNHandler(unittest.TestCase):
         self.config = testing.setUp()
 
     def tearDown(self):
+        Session.remove()
         testing.tearDown()
 
     def test_products_to_ignore(self):
@@ -121,12 +313,36 @@ class TestIPNHandler(unittest.TestCase):
 
         self.assertEqual(view.ipn(), 'Done.')
 
-    @mock.patch('pyramid_bimt.views.ipn.IPNView._parse_request_jvzoo')
+    @mock.patch('pyramid_bimt.views.ipn.lock')
+    @mock.patch('pyramid_bimt.views.ipn.IPNTransaction')
+    def test_missing_trans_id_or_type(self, IPNTransaction, lock):
+        request = testing.DummyRequest()
+        for missing in ('trans_id', 'trans_type'):
+            view = IPNView(request)
+            view.params = IPNParams(
+                email='foo@bar.com',
+                product_id='123',
+                trans_id='123',
+                trans_type='SALE',
+            )
+            setattr(view.params, missing, None)
+
+            with self.assertRaises(ValueError) as cm:
+                view.ipn()
+            self.assertEqual(
+                str(cm.exception),
+                'IPN for foo@bar.com is missing transaction id or type',
+            )
+        self.assertFalse(IPNTransaction.exists.called)
+        self.assertFalse(IPNTransaction.record.called)
+
+    @mock.patch('pyramid_bimt.views.ipn.lock')
+    @mock.patch('pyramid_bimt.views.ipn.IPNTransaction')
     @mock.patch('pyramid_bimt.views.ipn.User')
     @mock.patch('pyramid_bimt.views.ipn.Group')
-    def test_invalid_product_id(self, Group, User, parse_request):
-        parse_request.return_value = None
-        User.by_email = mock.Mock()
+    def test_invalid_product_id(self, Group, User, IPNTransaction, lock):
+        IPNTransaction.exists.return_value = False
+        User.by_any_email = mock.Mock()
         Group.by_product_id.return_value = None
         request = testing.DummyRequest(post={'foo': 'bar'})
 
@@ -134,6 +350,8 @@ class TestIPNHandler(unittest.TestCase):
         view.params = AttrDict({
             'email': 'foo@bar.com',
             'product_id': 123,
+            'trans_id': 123,
+            'trans_type': 'SALE',
         })
 
         with self.assertRaises(ValueError) as cm:
@@ -143,28 +361,30 @@ class TestIPNHandler(unittest.TestCase):
             'Cannot find group with product_id "123"',
         )
 
-    @mock.patch('pyramid_bimt.views.ipn.requests.post')
+    @mock.patch('pyramid_bimt.views.ipn.lock')
+    @mock.patch('pyramid_bimt.views.ipn.IPNTransaction')
+    @mock.patch('pyramid_bimt.views.ipn.forward_ipn')
     @mock.patch('pyramid_bimt.views.ipn.UserDisabled')
     @mock.patch('pyramid_bimt.views.ipn.IPNView.ipn_transaction')
-    @mock.patch('pyramid_bimt.views.ipn.IPNView._parse_request_jvzoo')
     @mock.patch('pyramid_bimt.views.ipn.User')
     @mock.patch('pyramid_bimt.views.ipn.Group')
     def test_forward_ipn_url(
         self,
         Group,
         User,
-        parse_request,
         ipn_transaction,
         UserDisabled,
-        request_post,
+        forward_ipn,
+        IPNTransaction,
+        lock,
     ):
-        parse_request.return_value = None
+        IPNTransaction.exists.return_value = False
         ipn_transaction.return_value = None
         group_mock = mock.Mock()
         group_mock.name = 'test'
         group_mock.forward_ipn_to_url = 'http://www.example.com'
         Group.by_product_id.return_value = group_mock
-        User.by_email.return_value = mock.Mock(groups=[group_mock, ])
+        User.by_any_email.return_value = mock.Mock(groups=[group_mock, ])
         request = testing.DummyRequest(post={'foo': 'bar'})
         request.registry = mock.Mock()
         request.registry.settings = {}
@@ -173,12 +393,14 @@ class TestIPNHandler(unittest.TestCase):
         view.params = AttrDict({
             'email': 'foo@bar.com',
             'product_id': 123,
+            'trans_id': 123,
+            'trans_type': 'SALE',
         })
 
         view.ipn()
-        request_post.assert_called_with(
+        forward_ipn.assert_called_with(
             'http://www.example.com',
-            params={'foo': 'bar'},
+            [('foo', 'bar')],
         )
 
 
@@ -277,6 +499,54 @@ class TestIpnTransaction(unittest.TestCase):
         )
 
 
+class TestIPNQueries(unittest.TestCase):
+    """Handling an IPN takes the same number of queries for every user."""
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        self.config.include('pyramid_mailer.testing')
+        add_routes_auth(self.config)
+        initTestingDB(auditlog_types=True, groups=True, mailings=True)
+        with transaction.manager:
+            user = User(
+                email='foo@bar.com',
+                password=u'secret',
+                groups=Group.query.all() + [_make_ipn_group()],
+            )
+            for i in range(10):
+                user.set_property(u'key{}'.format(i), u'value')
+            Session.add(user)
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def _ipn(self, trans_type):
+        view = IPNView(testing.DummyRequest())
+        view.provider = 'jvzoo'
+        view.params = AttrDict({
+            'email': 'foo@bar.com',
+            'fullname': u'Föo Bar',
+            'trans_type': trans_type,
+            'trans_id': 123,
+            'product_id': 1,
+        })
+        return view.ipn()
+
+    def test_sale(self):
+        with assert_query_count(9):
+            self.assertEqual(self._ipn('SALE'), 'Done.')
+
+    def test_bill(self):
+        with assert_query_count(11):
+            self.assertEqual(self._ipn('BILL'), 'Done.')
+
+    def test_refund(self):
+        with assert_query_count(9):
+            self.assertEqual(self._ipn('RFND'), 'Done.')
+
+
 class TestIPNViewIntegration(unittest.TestCase):
     def setUp(self):
         settings = {
@@ -600,6 +870,64 @@ class TestIPNViewIntegration(unittest.TestCase):
             u'regular until 2014-01-30',
         )
 
+    @mock.patch('pyramid_bimt.views.ipn.date')
+    def test_duplicate_transaction(self, mocked_date):
+        mocked_date.today.return_value = date(2013, 12, 30)
+        user = self._make_user(
+            email='foo@bar.com',
+            groups=[Group.by_name('enabled')],
+        )
+        params = {
+            'email': 'foo@bar.com',
+            'fullname': u'Föo Bar',
+            'trans_type': 'BILL',
+            'trans_id': 123,
+            'product_id': 1,
+        }
+
+        for i in range(3):
+            view = IPNView(testing.DummyRequest())
+            view.provider = 'jvzoo'
+            view.params = AttrDict(params)
+            self.assertEqual(view.ipn(), 'Done.')
+
+        self.assertEqual(user.valid_to, date(2014, 1, 30))
+        self.assertEqual(len(user.audit_log_entries), 1)
+        self.assertEqual(
+            handler.records[-1].message,
+            'Duplicate IPN, transaction id: 123, type: BILL',
+        )
+
+        # same receipt with a different transaction type is processed
+        view = IPNView(testing.DummyRequest())
+        view.provider = 'jvzoo'
+        view.params = AttrDict(params, trans_type='CANCEL-REBILL')
+        self.assertEqual(view.ipn(), 'Done.')
+        self.assertEqual(handler.records[-1].message, 'IPN done.')
+
+    def test_retry_ipn_rollback(self):
+        transaction.commit()
+        view = IPNView(testing.DummyRequest())
+        view.params = IPNParams(email='foo@bar.com')
+        calls = []
+
+        def ipn():
+            calls.append(transaction.get())
+            Session.add(Group(name='foo{}'.format(len(calls))))
+            Session.flush()
+            if len(calls) == 1:
+                raise IPNConflict('Conflict!')
+            return 'Done.'
+
+        view.ipn = ipn
+        self.assertEqual(view.retry_ipn(), 'Done.')
+        self.assertIs(calls[0], calls[1])
+        transaction.commit()
+
+        # changes of the conflicting attempt are rolled back
+        self.assertIsNone(Group.by_name('foo1'))
+        self.assertIsNotNone(Group.by_name('foo2'))
+
     def test_welcome_email_api_key_set(self):
         from pyramid_bimt.events import IUserCreated
 
@@ -766,3 +1094,93 @@ class TestClickBankViewFunctional(unittest.TestCase):
         self.assertIn(u'p: ', self.mailer.outbox[0].html)  # noqa
         self.assertIn(u'Best wishes', self.mailer.outbox[0].html)  # noqa
         self.assertIn(u'<a href="http://blog.bigimtoolbox.com/">visit our blog</a>', self.mailer.outbox[0].html)  # noqa
+
+
+class TestConcurrentIPNs(unittest.TestCase):
+    """Fire IPNs for the same customer from parallel threads."""
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        self.tmpdir = tempfile.mkdtemp()
+        # threads need a shared database, not one in-memory database each
+        initTestingDB(
+            auditlog_types=True,
+            groups=True,
+            url='sqlite:///{}'.format(os.path.join(self.tmpdir, 'test.db')),
+        )
+        with transaction.manager:
+            Session.add(Group(name='monthly', product_id='1', validity=31))
+        self.errors = []
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _ipn(self, email, trans_id):
+        self.config.begin()
+        try:
+            for attempt in transaction.manager.attempts(3):
+                with attempt:
+                    request = testing.DummyRequest()
+                    request.registry = self.config.registry
+                    view = IPNView(request)
+                    view.provider = 'jvzoo'
+                    view.params = IPNParams(
+                        email=email,
+                        fullname=u'John Smith',
+                        product_id='1',
+                        trans_id=trans_id,
+                        trans_type='SALE',
+                    )
+                    view.ipn()
+        except Exception as e:  # pragma: no cover
+            self.errors.append(e)
+        finally:
+            Session.remove()
+            self.config.end()
+
+    def test_parallel_ipns(self):
+        ipns = [('foo@bar.com', 'A{}'.format(i)) for i in range(8)]
+        ipns += [('foo@bar.com', 'A0'), ('foo@bar.com', 'A1')]  # retries
+        ipns += [('bar@bar.com', 'B{}'.format(i)) for i in range(4)]
+
+        threads = [Thread(target=self._ipn, args=ipn) for ipn in ipns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+
+        self.assertEqual(
+            sorted(u.email for u in User.query),
+            ['bar@bar.com', 'foo@bar.com'],
+        )
+        self.assertEqual(IPNTransaction.query.count(), 12)
+
+        user = User.by_email('foo@bar.com')
+        self.assertTrue(user.enabled)
+        self.assertEqual(
+            [g.name for g in user.groups].count(u'monthly'), 1)
+        self.assertEqual(
+            sorted(e.event_type.name for e in user.audit_log_entries),
+            [u'UserCreated'] + [u'UserEnabled'] * 8,
+        )
+        self.assertEqual(AuditLogEntry.query.count(), 14)
+
+    @mock.patch('pyramid_bimt.views.ipn.lock')
+    @mock.patch('pyramid_bimt.views.ipn.Session')
+    def test_conflict(self, Session, lock):
+        Session.flush.side_effect = IntegrityError('INSERT', {}, 'unique')
+        request = testing.DummyRequest()
+        view = IPNView(request)
+        view.params = AttrDict(
+            email='foo@bar.com', product_id='1', trans_id='1',
+            trans_type='SALE')
+        view.is_duplicate = view.record_transaction = mock.Mock(
+            return_value=False)
+        view.find_user = view.find_group = view.ipn_transaction = mock.Mock()
+
+        with self.assertRaises(IPNConflict) as cm:
+            view.ipn()
+        self.assertIn('Conflicting IPN for foo@bar.com', str(cm.exception))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Tests for the IPNTransaction model."""
+
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.models import IPNForward
+from pyramid_bimt.models import IPNTransaction
+from pyramid_bimt.testing import initTestingDB
+from sqlalchemy.exc import IntegrityError
+
+import unittest
+
+
+class TestIPNTransactionModel(unittest.TestCase):
+
+    def setUp(self):
+        initTestingDB()
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test__repr__(self):
+        self.assertEqual(
+            repr(IPNTransaction(
+                id=1, provider='jvzoo', trans_id=u'123', trans_type='SALE')),
+            '<IPNTransaction:1 (provider=\'jvzoo\', trans_id=u\'123\', '
+            'trans_type=\'SALE\')>',
+        )
+
+    def test_exists(self):
+        self.assertFalse(IPNTransaction.exists('jvzoo', 123, 'SALE'))
+        IPNTransaction.record('jvzoo', 123, 'SALE')
+        self.assertTrue(IPNTransaction.exists('jvzoo', 123, 'SALE'))
+        self.assertTrue(IPNTransaction.exists('jvzoo', '123', 'SALE'))
+        self.assertFalse(IPNTransaction.exists('jvzoo', 123, 'BILL'))
+        self.assertFalse(IPNTransaction.exists('clickbank', 123, 'SALE'))
+
+    def test_record_is_unique(self):
+        IPNTransaction.record('jvzoo', 123, 'SALE')
+        with self.assertRaises(IntegrityError):
+            IPNTransaction.record('jvzoo', 123, 'SALE')
+
+
+class TestIPNForwardModel(unittest.TestCase):
+
+    def test__repr__(self):
+        self.assertEqual(
+            repr(IPNForward(id=1, url='http://example.com', attempts=2)),
+            '<IPNForward:1 (url=\'http://example.com\', attempts=2)>',
+        )
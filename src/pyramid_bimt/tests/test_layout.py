@@ -2,13 +2,19 @@
 """Tests for the default layout."""
 
 from pyramid import testing
+from pyramid_basemodel import Session
 from pyramid_bimt.layout import above_content_portlets
 from pyramid_bimt.layout import above_footer_portlets
 from pyramid_bimt.layout import above_sidebar_portlets
 from pyramid_bimt.layout import below_sidebar_portlets
+from pyramid_bimt.models import Group
 from pyramid_bimt.models import Portlet
+from pyramid_bimt.models import User
+from pyramid_bimt.testing import assert_query_count
+from pyramid_bimt.testing import initTestingDB
 
 import mock
+import transaction
 import unittest
 
 
@@ -131,3 +137,37 @@ class TestFlashMessages(unittest.TestCase):
         messages = self.layout.flash_messages()
         self.assertEqual(len(messages), 1)
         self.assertEqual(messages[0], {'msg': 'foo', 'level': 'info'})
+
+
+class TestPortletsQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.include('pyramid_chameleon')
+        initTestingDB(groups=True, users=True, portlets=True)
+        with transaction.manager:
+            groups = Group.query.all()
+            for i in range(10):
+                Session.add(Portlet(
+                    name='portlet{}'.format(i),
+                    html=u'<p>Portlet {}</p>'.format(i),
+                    position='below_sidebar',
+                    groups=groups[i % 3:i % 3 + 2],
+                    exclude_groups=[Group.by_name('trial')],
+                ))
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def test_groups_not_loaded_per_portlet(self):
+        request = testing.DummyRequest(user=User.by_email('one@bar.com'))
+        with assert_query_count(7):
+            for panel in (
+                above_content_portlets,
+                below_sidebar_portlets,
+                above_sidebar_portlets,
+                above_footer_portlets,
+            ):
+                panel(mock.Mock(specs=()), request)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Tests for serialising concurrent transactions."""
+
+from pyramid_basemodel import Session
+from pyramid_bimt.locking import LockTimeout
+from pyramid_bimt.locking import STRIPES
+from pyramid_bimt.locking import _stripes
+from pyramid_bimt.locking import lock
+from pyramid_bimt.testing import initTestingDB
+from threading import Thread
+
+import mock
+import transaction
+import unittest
+import zlib
+
+
+def _stripe(key):
+    return _stripes[zlib.crc32(key) % STRIPES]
+
+
+class TestLock(unittest.TestCase):
+
+    def setUp(self):
+        transaction.abort()
+        initTestingDB()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+
+    def test_held_until_commit(self):
+        lock(u'foo')
+        self.assertTrue(_stripe('foo').locked())
+        transaction.commit()
+        self.assertFalse(_stripe('foo').locked())
+
+    def test_held_until_abort(self):
+        lock('foo')
+        self.assertTrue(_stripe('foo').locked())
+        transaction.abort()
+        self.assertFalse(_stripe('foo').locked())
+
+    def test_released_after_failed_commit(self):
+        lock('foo')
+        failing = mock.Mock(spec=[
+            'abort', 'tpc_begin', 'commit', 'tpc_vote', 'tpc_finish',
+            'tpc_abort', 'sortKey'])
+        failing.sortKey.return_value = 'z'
+        failing.tpc_vote.side_effect = ValueError
+        transaction.get().join(failing)
+        with self.assertRaises(ValueError):
+            transaction.commit()
+        transaction.abort()
+        self.assertFalse(_stripe('foo').locked())
+
+    def test_reentrant(self):
+        lock('foo')
+        lock('foo')
+        transaction.commit()
+        self.assertFalse(_stripe('foo').locked())
+
+    def test_savepoint_rollback(self):
+        savepoint = transaction.savepoint()
+        lock('foo')
+        savepoint.rollback()
+        self.assertFalse(_stripe('foo').locked())
+
+        # locked again, the lock joins the transaction again
+        lock('foo')
+        self.assertTrue(_stripe('foo').locked())
+        transaction.commit()
+        self.assertFalse(_stripe('foo').locked())
+
+    def test_other_transaction_waits(self):
+        order = []
+
+        def other():
+            lock('foo')
+            order.append('other')
+            transaction.commit()
+
+        lock('foo')
+        thread = Thread(target=other)
+        thread.start()
+        thread.join(0.1)
+        order.append('this')
+        transaction.commit()
+        thread.join()
+        self.assertEqual(order, ['this', 'other'])
+
+    def test_timeout(self):
+        errors = []
+
+        def other():
+            try:
+                lock('foo', timeout=0.01)
+            except LockTimeout as e:
+                errors.append(e)
+            finally:
+                transaction.abort()
+
+        lock('foo')
+        thread = Thread(target=other)
+        thread.start()
+        thread.join()
+        self.assertEqual(
+            [str(e) for e in errors], ['Lock not acquired in 0.01 seconds.'])
+
+    @mock.patch('pyramid_bimt.locking.Session')
+    def test_postgresql(self, Session):
+        session = Session.return_value
+        session.get_bind.return_value.dialect.name = 'postgresql'
+        lock(u'foo')
+        query = session.execute.call_args[0][0]
+        self.assertIn('pg_advisory_xact_lock', str(query))
+        self.assertEqual(
+            query.compile().params.values(), [zlib.crc32('foo')])
+        self.assertFalse(_stripe('foo').locked())
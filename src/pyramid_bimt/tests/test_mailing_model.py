@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 """Tests for pyramid_bimt mailing views."""
 
+from chameleon import PageTemplate
 from pyramid import testing
+from pyramid.renderers import render
 from pyramid_basemodel import Session
 from pyramid_bimt import add_routes_auth
+from pyramid_bimt import add_routes_user
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import MailingDelivery
+from pyramid_bimt.models import MailingRenderer
 from pyramid_bimt.models import MailingTriggers
 from pyramid_bimt.models import User
 from pyramid_bimt.scripts.send_mailings import send_mailings
 from pyramid_bimt.testing import initTestingDB
 from pyramid_mailer import get_mailer
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
 
 import datetime
 import mock
@@ -62,6 +68,269 @@ class TestMailingModel(unittest.TestCase):
         self.assertTrue(issubclass(Mailing, GetByNameMixin))
 
 
+class TestMailingGetAll(unittest.TestCase):
+
+    def setUp(self):
+        initTestingDB()
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test_ordered_by_name(self):
+        _make_mailing(name='foo')
+        _make_mailing(name='bar')
+        self.assertEqual(
+            [m.name for m in Mailing.get_all()], ['bar', 'foo'])
+
+    def test_filter_by_and_limit(self):
+        _make_mailing(name='foo', days=1)
+        _make_mailing(name='bar', days=1)
+        _make_mailing(name='baz', days=2)
+        self.assertEqual(
+            [m.name for m in Mailing.get_all(filter_by={'days': 1})],
+            ['bar', 'foo'],
+        )
+        self.assertEqual(len(Mailing.get_all(limit=2)), 2)
+
+    def test_options(self):
+        _make_mailing(name='foo', groups=[Group(name='foo')])
+        Session.flush()
+        Session.expunge_all()
+        mailings = Mailing.get_all(options=[subqueryload('groups')])
+        self.assertEqual([g.name for g in mailings[0].__dict__['groups']],
+                         ['foo'])
+        self.assertNotIn('exclude_groups', mailings[0].__dict__)
+
+
+class TestRecipients(unittest.TestCase):
+
+    def setUp(self):
+        initTestingDB()
+        self.config = testing.setUp()
+        self.foo = Group(name='foo')
+        self.bar = Group(name='bar')
+        self.users = [
+            User(email='one@bar.com', groups=[self.foo]),
+            User(email='two@bar.com', groups=[self.foo, self.bar]),
+            User(email='three@bar.com', groups=[self.bar]),
+            User(email='four@bar.com', groups=[]),
+        ]
+        Session.add_all(self.users)
+        Session.flush()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def test_no_groups(self):
+        mailing = _make_mailing()
+        self.assertEqual(mailing.recipients_query().all(), [])
+        self.assertEqual(mailing.recipients_query().count(), 0)
+
+    def test_include(self):
+        mailing = _make_mailing(groups=[self.foo, self.bar])
+        self.assertItemsEqual(
+            mailing.recipients_query().all(), self.users[:3])
+        self.assertEqual(mailing.recipients_query().count(), 3)
+
+    def test_exclude(self):
+        mailing = _make_mailing(groups=[self.foo], exclude_groups=[self.bar])
+        self.assertEqual(mailing.recipients_query().all(), self.users[:1])
+        self.assertEqual(mailing.recipients_query().count(), 1)
+
+    def test_other_mailing_groups_ignored(self):
+        _make_mailing(name='other', groups=[self.bar], exclude_groups=[])
+        mailing = _make_mailing(groups=[self.foo])
+        self.assertItemsEqual(
+            mailing.recipients_query().all(), self.users[:2])
+
+    def test_iter_recipients(self):
+        mailing = _make_mailing(groups=[self.foo, self.bar])
+        with mock.patch.object(
+                Mailing, 'recipients_query',
+                wraps=mailing.recipients_query) as recipients_query:
+            recipients = list(mailing.iter_recipients(batch_size=2))
+        self.assertEqual(recipients, self.users[:3])
+        self.assertEqual(recipients_query.call_count, 2)
+
+    def test_iter_recipients_full_last_batch(self):
+        mailing = _make_mailing(groups=[self.foo])
+        self.assertEqual(
+            list(mailing.iter_recipients(batch_size=2)), self.users[:2])
+
+
+class TestQueueDeliveries(unittest.TestCase):
+
+    def setUp(self):
+        initTestingDB()
+        self.config = testing.setUp()
+        self.group = Group(name='foo')
+        self.users = [
+            User(email='one@bar.com', groups=[self.group]),
+            User(email='two@bar.com', groups=[self.group]),
+        ]
+        self.mailing = _make_mailing(groups=[self.group])
+        Session.add_all(self.users)
+        Session.flush()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def _deliveries(self):
+        return MailingDelivery.query.filter_by(
+            mailing_id=self.mailing.id).order_by(MailingDelivery.user_id)
+
+    def test_queue(self):
+        self.assertEqual(self.mailing.queue_deliveries(), 2)
+        deliveries = self._deliveries().all()
+        self.assertEqual([d.user for d in deliveries], self.users)
+        self.assertEqual(deliveries[0].status, 'pending')
+        self.assertIsNotNone(deliveries[0].created)
+        self.assertEqual(
+            self.mailing.delivery_progress(), {'pending': 2})
+
+    def test_never_sent(self):
+        self.assertEqual(self.mailing.delivery_progress(), {})
+
+    def test_keep_pending(self):
+        self.mailing.queue_deliveries()
+        self._deliveries().first().status = 'sent'
+        self.users.append(User(email='three@bar.com', groups=[self.group]))
+
+        self.assertEqual(self.mailing.queue_deliveries(), 1)
+        self.assertEqual(
+            self.mailing.delivery_progress(), {'pending': 1, 'sent': 1})
+
+    def test_queue_again(self):
+        self.mailing.queue_deliveries()
+        for delivery in self._deliveries():
+            delivery.status = 'sent'
+        self.users.append(User(email='three@bar.com', groups=[self.group]))
+
+        self.assertEqual(self.mailing.queue_deliveries(), 3)
+        self.assertEqual(
+            self.mailing.delivery_progress(), {'pending': 3})
+
+    def test__repr__(self):
+        self.mailing.queue_deliveries()
+        self.assertEqual(
+            repr(self._deliveries().first()),
+            "<MailingDelivery:1 (mailing_id=1, user_id={}, "
+            "status=u'pending')>".format(self.users[0].id),
+        )
+
+
+class TestMailingRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.request = testing.DummyRequest()
+        self.config = testing.setUp(
+            request=self.request, settings={'bimt.app_title': 'BIMT'})
+        self.config.include('pyramid_chameleon')
+        add_routes_user(self.config)
+        initTestingDB()
+        self.user = User(email='one@bar.com', fullname=u'Öne <&> Bar')
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def _render_once(self, mailing, recipient, password=None):
+        """Render an email in one pass, the way Mailing.send used to."""
+        params = {
+            'request': self.request,
+            'user': recipient,
+            'settings': self.request.registry.settings,
+            'password': password,
+            'unsubscribe_url': None if mailing.allow_unsubscribed else
+            self.request.route_url('user_unsubscribe'),
+        }
+        params['body'] = PageTemplate(mailing.body)(**params)
+        return render('pyramid_bimt:templates/email.pt', params)
+
+    def test_same_as_single_pass(self):
+        mailing = _make_mailing(
+            body=u'<p tal:condition="password">Pass: ${password}</p>'
+                 u'<p>${user.email}, ${user.fullname}</p>',
+            exclude_groups=[Group(name='unsubscribed')],
+        )
+        renderer = MailingRenderer(mailing, self.request)
+        other = User(email='two@bar.com')
+        for recipient, password in ((self.user, u'sécret'), (other, None)):
+            self.assertEqual(
+                renderer(recipient, password=password)[1],
+                self._render_once(mailing, recipient, password),
+            )
+
+        html = renderer(self.user)[1]
+        self.assertIn(u'Hello Öne &lt;&amp;&gt; Bar,', html)
+        self.assertIn(u'<p>one@bar.com, Öne &lt;&amp;&gt; Bar</p>', html)
+        self.assertIn(u'http://example.com/unsubscribe/', html)
+        self.assertIn(u'Hello ,', renderer(other)[1])
+
+    def test_subject(self):
+        mailing = _make_mailing(subject=u'Hi {user.email}!')
+        self.assertEqual(
+            MailingRenderer(mailing, self.request)(self.user)[0],
+            u'Hi one@bar.com!',
+        )
+
+        mailing = _make_mailing(body=u'Foo', subject=u'Hi {body}!')
+        self.assertEqual(
+            MailingRenderer(mailing, self.request)(self.user)[0],
+            u'Hi Foo!',
+        )
+
+    def test_renderer_globals(self):
+        from pyramid.events import BeforeRender
+
+        def add_globals(event):
+            event['app'] = event['request'].registry.settings['bimt.app_title']
+            event['renderer'] = event['renderer_name']
+
+        self.config.add_subscriber(add_globals, BeforeRender)
+        self.request.context = mock.Mock(title=u'Foo')
+        mailing = _make_mailing(
+            body=u'${app} ${renderer} ${context.title} ${req.url}')
+        html = MailingRenderer(mailing, self.request)(self.user)[1]
+        self.assertIn(u'BIMT mailing.pt Foo http://example.com', html)
+
+    @mock.patch('pyramid_bimt.models.mailing.render')
+    @mock.patch('pyramid_bimt.models.mailing.PageTemplate')
+    def test_prepared_once(self, PageTemplate, render):
+        render.return_value = u'\ue000user.email\ue001: \ue000body\ue001'
+        PageTemplate.return_value.return_value = u'Body'
+        renderer = MailingRenderer(_make_mailing(), self.request)
+        self.assertEqual(renderer(self.user)[1], u'one@bar.com: Body')
+        self.assertEqual(renderer(self.user)[1], u'one@bar.com: Body')
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(PageTemplate.call_count, 1)
+        self.assertEqual(PageTemplate.return_value.call_count, 2)
+
+    def test_body_not_unicode(self):
+        with self.assertRaises(AssertionError) as cm:
+            MailingRenderer(_make_mailing(body='Body'), self.request)
+        self.assertEqual(
+            str(cm.exception),
+            'Mail body type must be unicode, not <type \'str\'>!',
+        )
+
+    @mock.patch('pyramid_bimt.models.mailing.get_current_request')
+    def test_send_with_renderer(self, get_current_request):
+        get_current_request.return_value = self.request
+        self.config.include('pyramid_mailer.testing')
+        renderer = mock.Mock(return_value=(u'Subject', u'Body'))
+        _make_mailing().send(self.user, renderer=renderer)
+        renderer.assert_called_once_with(self.user, password=None)
+        self.assertEqual(get_mailer(self.request).outbox[0].html, u'Body')
+
+
 class TestSendMailingsScript(unittest.TestCase):
 
     def setUp(self):
@@ -191,6 +460,104 @@ class TestSendMailingsScript(unittest.TestCase):
         self.assertEqual(self.mailer.outbox[0].subject, 'foo')
 
 
+class TestSendMailingsCatchUp(unittest.TestCase):
+
+    def setUp(self):
+        self.request = testing.DummyRequest()
+        self.config = testing.setUp(
+            request=self.request, settings={'bimt.app_title': 'BIMT'})
+        self.config.include('pyramid_mailer.testing')
+        self.config.include('pyramid_chameleon')
+        self.mailer = get_mailer(self.request)
+        initTestingDB()
+
+        # after_created, 3 days: users created on Dec 30th - Jan 2nd are
+        # sent to on Jan 2nd - Jan 5th
+        for created in (
+            datetime.datetime(2013, 12, 30),
+            datetime.datetime(2013, 12, 31),
+            datetime.datetime(2014, 1, 1),
+            datetime.datetime(2014, 1, 2),
+        ):
+            Session.add(User(
+                email='{}@bar.com'.format(created.strftime('%b%d').lower()),
+                created=created,
+            ))
+        _make_mailing(
+            subject=u'foo',
+            trigger=MailingTriggers.after_created.name,
+            days=3,
+        )
+        transaction.commit()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def _sent(self):
+        return [m.recipients[0] for m in self.mailer.outbox]
+
+    def _mailing(self):
+        with transaction.manager:
+            mailing = Mailing.query.one()
+            return mailing.processed_until, mailing.processed_user_id
+
+    @mock.patch('pyramid_bimt.scripts.send_mailings.date')
+    def test_first_run(self, date):
+        date.today.return_value = datetime.date(2014, 1, 4)
+        send_mailings()
+        self.assertEqual(self._sent(), ['jan01@bar.com'])
+        self.assertEqual(self._mailing(), (datetime.date(2014, 1, 4), None))
+
+    @mock.patch('pyramid_bimt.scripts.send_mailings.date')
+    def test_catch_up(self, date):
+        Mailing.query.one().processed_until = datetime.date(2014, 1, 2)
+        transaction.commit()
+
+        date.today.return_value = datetime.date(2014, 1, 5)
+        send_mailings()
+        self.assertEqual(
+            self._sent(), ['dec31@bar.com', 'jan01@bar.com', 'jan02@bar.com'])
+        self.assertEqual(self._mailing(), (datetime.date(2014, 1, 5), None))
+
+        send_mailings()
+        self.assertEqual(len(self.mailer.outbox), 3)
+
+    @mock.patch('pyramid_bimt.scripts.send_mailings.date')
+    def test_resume_interrupted(self, date):
+        for user in User.query.all():
+            user.created = datetime.datetime(2014, 1, 1)
+        Mailing.query.one().processed_until = datetime.date(2014, 1, 3)
+        transaction.commit()
+        date.today.return_value = datetime.date(2014, 1, 4)
+
+        with mock.patch.object(
+            Mailing, 'send', side_effect=[None, None, ValueError],
+        ):
+            with self.assertRaises(ValueError):
+                send_mailings(batch_size=2)
+        # first batch was committed, the failed one was not
+        self.assertEqual(self._mailing(), (datetime.date(2014, 1, 3), 2))
+
+        send_mailings(batch_size=2)
+        self.assertEqual(self._sent(), ['jan01@bar.com', 'jan02@bar.com'])
+        self.assertEqual(self._mailing(), (datetime.date(2014, 1, 4), None))
+
+    def test_days_to_process(self):
+        from pyramid_bimt.scripts.send_mailings import days_to_process
+        mailing = Mailing(processed_until=datetime.date(2014, 1, 2))
+        self.assertEqual(
+            days_to_process(mailing, datetime.date(2014, 1, 4)),
+            [datetime.date(2014, 1, 3), datetime.date(2014, 1, 4)],
+        )
+        self.assertEqual(
+            days_to_process(mailing, datetime.date(2014, 1, 2)), [])
+        self.assertEqual(
+            days_to_process(Mailing(), datetime.date(2014, 1, 2)),
+            [datetime.date(2014, 1, 2)],
+        )
+
+
 class TestMailingEvents(unittest.TestCase):
 
     def setUp(self):
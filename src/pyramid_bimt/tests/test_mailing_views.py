@@ -6,6 +6,7 @@ from pyramid.httpexceptions import HTTPFound
 from pyramid_basemodel import Session
 from pyramid_bimt import add_routes_mailing
 from pyramid_bimt import add_routes_user
+from pyramid_bimt import configure
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import Mailing
 from pyramid_bimt.models import MailingTriggers
@@ -16,11 +17,14 @@ from pyramid_bimt.scripts.populate import add_users
 from pyramid_bimt.testing import initTestingDB
 from pyramid_bimt.tests.test_user_views import _make_user
 from pyramid_mailer import get_mailer
+from sqlalchemy import event
 
 import colander
 import deform
 import mock
+import transaction
 import unittest
+import webtest
 
 
 def _make_group(
@@ -80,7 +84,7 @@ class TestMailingList(unittest.TestCase):
     @mock.patch('pyramid_bimt.views.mailing.app_assets')
     @mock.patch('pyramid_bimt.views.mailing.table_assets')
     def test_view_setup(self, table_assets, app_assets, Mailing):
-        Mailing.query.order_by.return_value.all.return_value = []
+        Mailing.get_all.return_value = []
         self.view.__init__(self.context, self.request)
         self.view.list()
 
@@ -91,7 +95,7 @@ class TestMailingList(unittest.TestCase):
     @mock.patch('pyramid_bimt.views.mailing.Mailing')
     def test_result(self, Mailing):
         mailing = _make_mailing()
-        Mailing.query.order_by.return_value.all.return_value = [mailing, ]
+        Mailing.get_all.return_value = [mailing, ]
         result = self.view.list()
 
         self.assertEqual(result, {
@@ -100,6 +104,62 @@ class TestMailingList(unittest.TestCase):
         })
 
 
+class TestMailingListIntegration(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        initTestingDB(groups=True, users=True)
+        configure(self.config)
+        self.config.testing_securitypolicy(
+            userid='admin@bar.com', permissive=True)
+        self.testapp = webtest.TestApp(self.config.make_wsgi_app())
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def _add_mailings(self, count):
+        groups = Group.query.all()
+        for i in range(count):
+            Session.add(Mailing(
+                name='mailing{}'.format(Mailing.query.count() + i),
+                groups=groups[:2],
+                exclude_groups=groups[2:3],
+                trigger=MailingTriggers.never.name,
+                days=0,
+                subject=u'',
+                body=u'',
+            ))
+        transaction.commit()
+
+    def _list(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Session.get_bind(), 'before_cursor_execute', record)
+        try:
+            resp = self.testapp.get('/mailings/')
+        finally:
+            event.remove(Session.get_bind(), 'before_cursor_execute', record)
+        return resp, statements
+
+    def test_groups(self):
+        self._add_mailings(2)
+        resp, statements = self._list()
+        self.assertIn('<td>admins, staff</td>', resp.text)
+        self.assertEqual(
+            len([s for s in statements if 'mailing_group' in s]), 1)
+
+    def test_fixed_query_count(self):
+        self._add_mailings(1)
+        _, one = self._list()
+        self._add_mailings(5)
+        _, six = self._list()
+        self.assertEqual(len(one), len(six))
+
+
 class TestMailingAdd(unittest.TestCase):
 
     APPSTRUCT = {
@@ -269,9 +329,8 @@ class TestMailingEdit(unittest.TestCase):
             'Mail body type must be unicode, not <type \'str\'>!'
         )
 
-    @mock.patch('pyramid_bimt.models.mailing.get_current_request')
-    def test_send_immediately_success(self, get_current_request):
-        get_current_request.return_value = self.request
+    @mock.patch('pyramid_bimt.delivery.send_in_background')
+    def test_send_immediately_success(self, send_in_background):
         add_users()
         self.request.context = Mailing.by_name('welcome_email')
 
@@ -281,41 +340,36 @@ class TestMailingEdit(unittest.TestCase):
 
         self.assertEqual(
             self.request.session.pop_flash(),
-            [u'Mailing "welcome_email" sent to 1 recipients.'],
+            [u'Mailing "welcome_email" is being sent to 1 recipients.'],
         )
+        self.assertEqual(
+            self.request.context.delivery_progress(), {'pending': 1})
+        self.assertEqual(len(get_mailer(self.request).outbox), 0)
 
-        mailer = get_mailer(self.request)
-        self.assertEqual(len(mailer.outbox), 1)
-        self.assertEqual(mailer.outbox[0].recipients, ['one@bar.com', ])
-        self.assertEqual(mailer.outbox[0].subject, u'Über Welcome!')
+        # sending starts once the queued deliveries are committed
+        self.assertFalse(send_in_background.called)
+        transaction.commit()
+        send_in_background.assert_called_once_with(4, self.request, 100)
 
-        self.assertIn(
-            u'Hello Öne Bar', mailer.outbox[0].html,)
-        self.assertIn(
-            u'Welcome to this über amazing BIMT app!', mailer.outbox[0].html)
-        self.assertIn('Best wishes,', mailer.outbox[0].html)
-        self.assertIn('BIMT Team', mailer.outbox[0].html)
+    def test_description_never_sent(self):
+        self.request.context = Mailing.by_name('welcome_email')
+        self.assertIsNone(self.view.description)
 
-    @mock.patch('pyramid_bimt.models.mailing.get_current_request')
-    def test_send_immediately_success_non_unicode(self, get_current_request):
-        get_current_request.return_value = self.request
-        add_users()
-        self.request.context = _make_mailing(
-            id=1,
-            name='foo',
-            groups=None,
-            exclude_groups=None,
-            trigger=MailingTriggers.never.name,
-            days=0,
-            subject='Subject',
-            body='Body',
+    def test_description_progress(self):
+        self.request.context = mock.Mock()
+        self.request.context.delivery_progress.return_value = {
+            'pending': 5, 'sent': 3, 'failed': 2}
+        self.assertEqual(
+            self.view.description,
+            u'Sending: sent to 3 of 10 recipients, 2 failed.',
         )
 
-        with self.assertRaises(AssertionError) as cm:
-            self.view.send_immediately_success(self.APPSTRUCT)
+    def test_description_done(self):
+        self.request.context = mock.Mock()
+        self.request.context.delivery_progress.return_value = {'sent': 3}
         self.assertEqual(
-            cm.exception.message,
-            'Mail body type must be unicode, not <type \'str\'>!'
+            self.view.description,
+            u'Last sent: sent to 3 of 3 recipients, 0 failed.',
         )
 
 
@@ -449,20 +503,17 @@ class TestRecipients(unittest.TestCase):
         mailing = _make_mailing(name='foo', groups=[])
         self.request.context = mailing
 
-        self.assertEqual(
-            self.view.recipients,
-            set([]),
-        )
+        self.assertEqual(self.view.recipients.all(), [])
+        self.assertEqual(self.view.recipients_count, 0)
 
     def test_no_groups_members(self):
         group = _make_group(name='foo', users=[])
         mailing = _make_mailing(name='foo', groups=[group, ])
+        Session.add(mailing)
         self.request.context = mailing
 
-        self.assertEqual(
-            self.view.recipients,
-            set([]),
-        )
+        self.assertEqual(self.view.recipients.all(), [])
+        self.assertEqual(self.view.recipients_count, 0)
 
     def test_union(self):
         add_groups()
@@ -474,7 +525,7 @@ class TestRecipients(unittest.TestCase):
         self.request.context = mailing
 
         self.assertItemsEqual(
-            self.view.recipients,
+            self.view.recipients.all(),
             [User.by_email('admin@bar.com'), User.by_email('staff@bar.com')],
         )
 
@@ -489,6 +540,33 @@ class TestRecipients(unittest.TestCase):
         self.request.context = mailing
 
         self.assertItemsEqual(
-            self.view.recipients,
+            self.view.recipients.all(),
             [User.by_email('one@bar.com')],
         )
+
+    def test_member_of_several_groups(self):
+        add_groups()
+        add_users()
+        mailing = _make_mailing(
+            name='foo',
+            groups=[Group.by_name('admins'), Group.by_name('enabled')],
+        )
+        self.request.context = mailing
+
+        self.assertItemsEqual(
+            self.view.recipients.all(),
+            Group.by_name('enabled').users,
+        )
+        self.assertEqual(
+            self.view.recipients_count, len(Group.by_name('enabled').users))
+
+    def test_count_memoized(self):
+        self.request.context = mock.Mock()
+        self.request.context.recipients_query.return_value.count.return_value = 3  # noqa
+
+        self.assertEqual(self.view.recipients_count, 3)
+        self.assertEqual(self.view.recipients_count, 3)
+        self.assertEqual(
+            self.request.context.recipients_query.return_value.count.call_count,  # noqa
+            1,
+        )
@@ -4,7 +4,12 @@
 from pyramid import testing
 from pyramid_bimt.const import Modes
 
+import inspect
 import mock
+import pkgutil
+import pyramid_bimt
+import subprocess
+import sys
 import unittest
 
 
@@ -118,38 +123,6 @@ class TestCheckSettings(unittest.TestCase):
         self.assertIn('bimt.jvzoo_secret_key', cm.exception.message)
 
 
-class TestAutoKillConnections(unittest.TestCase):
-
-    def setUp(self):
-        from pyramid_bimt import kill_connections
-        self.kill_connections = kill_connections
-        testing.setUp()
-
-    def tearDown(self):
-        testing.tearDown()
-
-    def test_no_exception(self):
-        try:
-            # empty arguments could throw exception
-            self.kill_connections(username=None, password=None, apiurl=None)
-        except:  # noqa
-            self.fail('kill_connections function should not raise exception')
-
-    @mock.patch('pyramid_bimt.requests')
-    def test_kill_connections(self, requests):
-        requests.get.return_value.status_code = 200
-        requests.get.return_value.json.return_value = [{'name': 'foo bar'}]
-
-        self.kill_connections(
-            username='foo', password='bar', apiurl='http://foo.bar')
-
-        requests.delete.assert_called_with(
-            'http://foo.bar/api/connections/foo%20bar',
-            headers={'X-Reason': 'Auto-kill on app start'},
-            auth=('foo', 'bar')
-        )
-
-
 class RoutesTrailingSlashTest(unittest.TestCase):
 
     def setUp(self):
@@ -162,3 +135,44 @@ class RoutesTrailingSlashTest(unittest.TestCase):
         for route in routes:
             if route.name != '__deform_static/':
                 self.assertEqual(route.path[-1], '/')
+
+
+class TestScan(unittest.TestCase):
+
+    def test_scan_modules(self):
+        """All modules with venusian decorators are in SCAN_MODULES."""
+        from pyramid_bimt import SCAN_MODULES
+        decorated = set()
+        for _, name, _ in pkgutil.walk_packages(
+                pyramid_bimt.__path__, 'pyramid_bimt.'):
+            if name.startswith(('pyramid_bimt.tests', 'pyramid_bimt.testing')):
+                continue
+            module = __import__(name, fromlist=['__name__'])
+            for obj in vars(module).values():
+                # subclasses inherit, but are not scanned for, callbacks
+                if (
+                    inspect.isclass(obj) or inspect.isfunction(obj)
+                ) and obj.__module__ == name and (
+                        '__venusian_callbacks__' in vars(obj)):
+                    decorated.add(name)
+        self.assertTrue(decorated)
+        for name in decorated:
+            self.assertTrue(
+                any(name == m or name.startswith(m + '.')
+                    for m in SCAN_MODULES),
+                '{} is not in SCAN_MODULES'.format(name),
+            )
+
+    def test_startup_imports(self):
+        """Heavy optional modules are not imported on app start."""
+        code = (
+            'import sys; from pyramid import testing; '
+            'from pyramid_bimt import configure; '
+            'configure(testing.setUp(settings={})); '
+            'print " ".join(sorted(m for m in sys.modules if m.split(".")[0] '
+            'in ("celery", "raven", "ua_parser") or m.startswith('
+            '("pyramid_bimt.task", "pyramid_bimt.scripts", '
+            '"pyramid_bimt.testing"))))'
+        )
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), '')
@@ -9,6 +9,7 @@ from pyramid_bimt.testing import initTestingDB
 from pyramid_bimt.tests.test_group_model import _make_group
 from pyramid_bimt.tests.test_user_model import _make_user
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
 
 import unittest
 
@@ -189,6 +190,20 @@ class TestPortletGetAll(unittest.TestCase):
         self.assertEqual(portlets[1].name, 'bar')
         self.assertEqual(portlets[2].name, 'foo')
 
+    def test_ordered_by_weight_within_position(self):
+        _make_portlet(name='foo', position='above_content', weight=1)
+        _make_portlet(name='bar', position='above_content', weight=3)
+        portlets = Portlet.get_all()
+        self.assertEqual([p.name for p in portlets], ['bar', 'foo'])
+
+    def test_options(self):
+        _make_portlet(name='foo')
+        Session.flush()
+        Session.expunge_all()
+        portlets = Portlet.get_all(options=[subqueryload('groups')])
+        self.assertIn('groups', portlets[0].__dict__)
+        self.assertNotIn('exclude_groups', portlets[0].__dict__)
+
     def test_filter_by(self):
         _make_portlet(name='foo', position='above_content')
         _make_portlet(name='bar', position='above_footer')
@@ -5,13 +5,17 @@ from pyramid import testing
 from pyramid.httpexceptions import HTTPFound
 from pyramid_basemodel import Session
 from pyramid_bimt import add_routes_portlet
+from pyramid_bimt import configure
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import Portlet
 from pyramid_bimt.models import PortletPositions
 from pyramid_bimt.testing import initTestingDB
+from sqlalchemy import event
 
 import mock
+import transaction
 import unittest
+import webtest
 
 
 def _make_group(
@@ -65,7 +69,7 @@ class TestPortletList(unittest.TestCase):
     @mock.patch('pyramid_bimt.views.portlet.app_assets')
     @mock.patch('pyramid_bimt.views.portlet.table_assets')
     def test_view_setup(self, table_assets, app_assets, Portlet):
-        Portlet.query.order_by.return_value.all.return_value = []
+        Portlet.get_all.return_value = []
         self.view.__init__(self.context, self.request)
         self.view.list()
 
@@ -76,7 +80,7 @@ class TestPortletList(unittest.TestCase):
     @mock.patch('pyramid_bimt.views.portlet.Portlet')
     def test_result(self, Portlet):
         portlet = _make_portlet()
-        Portlet.query.order_by.return_value.all.return_value = [portlet, ]
+        Portlet.get_all.return_value = [portlet, ]
         result = self.view.list()
 
         self.assertEqual(result, {
@@ -85,6 +89,59 @@ class TestPortletList(unittest.TestCase):
         })
 
 
+class TestPortletListIntegration(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        initTestingDB(groups=True, users=True)
+        configure(self.config)
+        self.config.testing_securitypolicy(
+            userid='admin@bar.com', permissive=True)
+        self.testapp = webtest.TestApp(self.config.make_wsgi_app())
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def _add_portlets(self, count):
+        groups = Group.query.all()
+        for i in range(count):
+            Session.add(Portlet(
+                name='portlet{}'.format(Portlet.query.count() + i),
+                groups=groups[:2],
+                position=PortletPositions.above_footer.name,
+            ))
+        transaction.commit()
+
+    def _list(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Session.get_bind(), 'before_cursor_execute', record)
+        try:
+            resp = self.testapp.get('/portlets/')
+        finally:
+            event.remove(Session.get_bind(), 'before_cursor_execute', record)
+        return resp, statements
+
+    def test_groups(self):
+        self._add_portlets(2)
+        resp, statements = self._list()
+        self.assertIn('<td>admins, staff</td>', resp.text)
+        # groups of listed and of displayed portlets are not lazy loaded
+        self.assertFalse(
+            [s for s in statements if '? = portlet_group.portlet_id' in s])
+
+    def test_fixed_query_count(self):
+        self._add_portlets(1)
+        _, one = self._list()
+        self._add_portlets(5)
+        _, six = self._list()
+        self.assertEqual(len(one), len(six))
+
+
 class TestPortletAdd(unittest.TestCase):
 
     APPSTRUCT = {
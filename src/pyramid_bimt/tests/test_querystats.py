@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Tests for counting SQL queries per request."""
+
+from pyramid import testing
+from pyramid.response import Response
+from pyramid_basemodel import Session
+from pyramid_bimt import configure
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import User
+from pyramid_bimt.querystats import collect_query_stats
+from pyramid_bimt.querystats import query_stats_tween_factory
+from pyramid_bimt.testing import assert_query_count
+from pyramid_bimt.testing import initTestingDB
+
+import mock
+import transaction
+import unittest
+import webtest
+
+
+class TestCollectQueryStats(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+        initTestingDB(groups=True, users=True)
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def test_count(self):
+        User.by_id(1)  # not counted
+        with collect_query_stats() as stats:
+            for user in User.query.order_by(User.id):
+                user.groups
+        self.assertEqual(stats.count, 4)
+        self.assertGreater(stats.duration, 0)
+
+        User.by_id(2)
+        self.assertEqual(stats.count, 4)
+
+    def test_repeated(self):
+        with collect_query_stats() as stats:
+            for user in User.query.order_by(User.id):
+                user.groups
+            Group.by_id(1)
+
+        repeated = stats.repeated()
+        self.assertEqual(len(repeated), 1)
+        self.assertIn('user_group', repeated[0][0])
+        self.assertEqual(repeated[0][1], 3)
+        self.assertEqual(stats.repeated(4), [])
+
+    def test_nested(self):
+        with collect_query_stats() as outer:
+            User.by_id(1)
+            with collect_query_stats() as inner:
+                User.by_id(2)
+            User.by_id(3)
+        self.assertEqual(outer.count, 2)
+        self.assertEqual(inner.count, 1)
+
+
+class TestAssertQueryCount(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+        initTestingDB(groups=True, users=True)
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def _load(self):
+        for user in User.query.order_by(User.id):
+            user.groups
+
+    def test_count(self):
+        with assert_query_count(4) as stats:
+            self._load()
+        self.assertEqual(stats.count, 4)
+
+    def test_count_failed(self):
+        with self.assertRaises(AssertionError) as cm:
+            with assert_query_count(2):
+                self._load()
+        message = str(cm.exception)
+        self.assertTrue(message.startswith(
+            'Expected 2 SQL statements, 4 were executed:\n3 x SELECT '))
+        self.assertIn('\n1 x SELECT users.', message)
+
+    def test_maximum(self):
+        with assert_query_count(maximum=5):
+            self._load()
+        with self.assertRaises(AssertionError) as cm:
+            with assert_query_count(maximum=3):
+                self._load()
+        self.assertTrue(str(cm.exception).startswith(
+            'Expected at most 3 SQL statements, 4 were executed:'))
+
+    def test_error_in_block(self):
+        with self.assertRaises(ValueError):
+            with assert_query_count(0):
+                self._load()
+                raise ValueError
+
+
+class TestQueryStatsTween(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'bimt.query_stats_sample_rate': '1',
+            'bimt.query_stats_repeated': '3',
+        })
+        initTestingDB(groups=True, users=True)
+        self.request = testing.DummyRequest(path='/users/')
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def _handler(self, request):
+        for user in User.query.order_by(User.id):
+            user.groups
+        return Response('ok')
+
+    def test_disabled_by_default(self):
+        self.config.registry.settings = {}
+        handler = mock.Mock()
+        self.assertIs(
+            query_stats_tween_factory(handler, self.config.registry),
+            handler,
+        )
+
+    @mock.patch('pyramid_bimt.querystats.logger')
+    def test_headers_and_logs(self, logger):
+        tween = query_stats_tween_factory(self._handler, self.config.registry)
+        response = tween(self.request)
+
+        self.assertEqual(response.headers['X-DB-Queries'], '4')
+        self.assertEqual(response.headers['X-DB-Repeated'], '1')
+        self.assertGreater(float(response.headers['X-DB-Time']), 0)
+
+        message = logger.info.call_args[0][0]
+        self.assertTrue(message.startswith(
+            'GET /users/ db_queries=4 db_time_ms='))
+        self.assertTrue(message.endswith(' db_repeated=1'))
+        extra = logger.info.call_args[1]['extra']
+        self.assertEqual(extra['db_queries'], 4)
+        self.assertEqual(extra['db_repeated'], 1)
+
+        self.assertEqual(logger.warning.call_count, 1)
+        warning = logger.warning.call_args[0][0]
+        self.assertTrue(warning.startswith('GET /users/ executed 3 times: '))
+        self.assertIn('user_group', warning)
+
+    @mock.patch('pyramid_bimt.querystats.logger')
+    def test_no_repeated(self, logger):
+        self.config.registry.settings['bimt.query_stats_repeated'] = '4'
+        tween = query_stats_tween_factory(self._handler, self.config.registry)
+        response = tween(self.request)
+        self.assertEqual(response.headers['X-DB-Repeated'], '0')
+        self.assertFalse(logger.warning.called)
+
+    @mock.patch('pyramid_bimt.querystats.random')
+    def test_sampled(self, random):
+        self.config.registry.settings['bimt.query_stats_sample_rate'] = '0.1'
+        tween = query_stats_tween_factory(self._handler, self.config.registry)
+
+        random.random.return_value = 0.1
+        self.assertNotIn('X-DB-Queries', tween(self.request).headers)
+
+        random.random.return_value = 0.09
+        self.assertIn('X-DB-Queries', tween(self.request).headers)
+
+    def test_error(self):
+        def handler(request):
+            User.by_id(1)
+            raise ValueError('Boom!')
+
+        tween = query_stats_tween_factory(handler, self.config.registry)
+        with collect_query_stats() as stats:
+            with self.assertRaises(ValueError):
+                tween(self.request)
+            User.by_id(2)
+        # statements after the failed request are counted by outer stats
+        self.assertEqual(stats.count, 1)
+
+
+class TestQueryStatsTweenIntegration(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'bimt.app_title': 'BIMT',
+            'bimt.query_stats_sample_rate': '1',
+        })
+        initTestingDB(groups=True, users=True, auditlog_types=True)
+        configure(self.config)
+        self.config.include('pyramid_tm')
+        self.testapp = webtest.TestApp(self.config.make_wsgi_app())
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test_login_page(self):
+        response = self.testapp.get('/login/', status=200)
+        self.assertIn('X-DB-Queries', response.headers)
+        self.assertIn('X-DB-Time', response.headers)
+
+    def test_over_pyramid_tm(self):
+        from pyramid.interfaces import ITweens
+        names = [name for name, factory in self.config.registry.getUtility(
+            ITweens).implicit()]
+        # from the outermost tween in
+        self.assertEqual(names, [
+            'pyramid.tweens.excview_tween_factory',
+            'pyramid_bimt.querystats.query_stats_tween_factory',
+            'pyramid_tm.tm_tween_factory',
+        ])
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Tests for the replay_ipns script."""
+
+from datetime import date
+from datetime import timedelta
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt import register_utilities
+from pyramid_bimt.models import Group
+from pyramid_bimt.models import IPNTransaction
+from pyramid_bimt.models import User
+from pyramid_bimt.scripts.replay_ipns import read_ipns
+from pyramid_bimt.scripts.replay_ipns import replay_ipns
+from pyramid_bimt.testing import initTestingDB
+
+import json
+import mock
+import transaction
+import unittest
+
+
+def _jvzoo(email, trans_id, trans_type='SALE', product_id='1'):
+    return json.dumps({
+        'provider': 'jvzoo',
+        'ccustname': 'John Smith',
+        'ccustemail': email,
+        'cproditem': product_id,
+        'ctransaction': trans_type,
+        'ctransreceipt': trans_id,
+        'ctransaffiliate': 'Aff@bar.com',
+    })
+
+
+def _clickbank(email, trans_id, trans_type='BILL', product_id='1'):
+    return json.dumps({
+        'provider': 'clickbank',
+        'receipt': trans_id,
+        'transactionType': trans_type,
+        'lineItems': [{'itemNo': product_id}],
+        'customer': {'billing': {'fullName': 'Jane Doe', 'email': email}},
+    })
+
+
+class TestReadIPNs(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        register_utilities(self.config)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_read(self):
+        lines = [
+            _jvzoo('Foo@bar.com', 'A1'),
+            '\n',
+            _clickbank('bar@bar.com', 'B1'),
+        ]
+        items = list(read_ipns(lines, self.config.registry))
+        self.assertEqual([i[0] for i in items], [1, 3])
+        self.assertEqual([i[1] for i in items], ['jvzoo', 'clickbank'])
+
+        params = items[0][2]
+        self.assertEqual(params.email, 'foo@bar.com')
+        self.assertEqual(params.affiliate, 'aff@bar.com')
+        self.assertEqual(params.trans_id, 'A1')
+
+        params = items[1][2]
+        self.assertEqual(params.email, 'bar@bar.com')
+        self.assertEqual(params.fullname, u'Jane Doe')
+        self.assertEqual(params.product_id, '1')
+        self.assertEqual(params.trans_type, 'BILL')
+
+    @mock.patch('pyramid_bimt.scripts.replay_ipns.logger')
+    def test_malformed(self, logger):
+        lines = [
+            '{"provider": "foo"}',
+            '{"ccustemail": "foo@bar.com"',
+            '{"ccustemail": "foo@bar.com"}',
+            _jvzoo('foo@bar.com', 'A1'),
+        ]
+        stats = {'failed': 0}
+        items = list(read_ipns(lines, self.config.registry, stats))
+        self.assertEqual([i[0] for i in items], [4])
+        self.assertEqual(stats, {'failed': 3})
+        self.assertEqual(
+            logger.warning.call_args_list[0][0][0],
+            'Skipping malformed IPN on line 1: Unknown IPN provider: foo',
+        )
+        self.assertTrue(logger.warning.call_args_list[1][0][0].startswith(
+            'Skipping malformed IPN on line 2: '))
+
+        # counting skipped lines is optional
+        self.assertEqual(list(read_ipns(lines[:3], self.config.registry)), [])
+
+
+class TestReplayIPNs(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        self.config.include('pyramid_mailer.testing')
+        register_utilities(self.config)
+        self.request = testing.DummyRequest()
+        initTestingDB(auditlog_types=True, groups=True, mailings=True)
+        with transaction.manager:
+            Session.add(Group(
+                name='monthly',
+                product_id='1',
+                validity=31,
+                forward_ipn_to_url='http://example.com',
+            ))
+            Session.add(User(
+                email='existing@bar.com',
+                billing_email='billing@bar.com',
+                password=u'secret',
+            ))
+            Session.add(IPNTransaction(
+                provider='jvzoo', trans_id=u'OLD', trans_type='SALE'))
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test_replay(self):
+        lines = [
+            _jvzoo('new@bar.com', 'A1'),
+            _clickbank('billing@bar.com', 'B1'),
+            _jvzoo('new@bar.com', 'A1'),  # retried by provider
+            _jvzoo('new@bar.com', 'OLD'),  # processed before the outage
+            _jvzoo('new@bar.com', 'A2', trans_type='BILL'),
+        ]
+        stats = replay_ipns(self.request, lines, batch_size=2)
+        self.assertEqual(
+            stats, {'replayed': 3, 'duplicate': 2, 'skipped': 0, 'failed': 0})
+
+        new = User.by_email('new@bar.com')
+        self.assertTrue(new.enabled)
+        self.assertEqual(new.valid_to, date.today() + timedelta(days=31))
+        self.assertEqual(
+            [e.event_type.name for e in new.audit_log_entries],
+            [u'UserCreated', u'UserEnabled', u'UserEnabled'],
+        )
+
+        existing = User.by_email('existing@bar.com')
+        self.assertTrue(existing.enabled)
+        self.assertEqual(
+            existing.audit_log_entries[0].comment,
+            u'Enabled by clickbank, transaction id: B1, type: BILL, note: '
+            u'regular until {}'.format(date.today() + timedelta(days=31)),
+        )
+        self.assertEqual(IPNTransaction.query.count(), 4)
+
+        # replaying again is a no-op
+        stats = replay_ipns(self.request, lines)
+        self.assertEqual(
+            stats, {'replayed': 0, 'duplicate': 5, 'skipped': 0, 'failed': 0})
+        new = User.by_email('new@bar.com')
+        self.assertEqual(len(new.audit_log_entries), 3)
+
+    def test_no_billing_email(self):
+        with transaction.manager:
+            Session.add(User(email='plain@bar.com', password=u'secret'))
+        stats = replay_ipns(
+            self.request, [_jvzoo('plain@bar.com', 'A1')], batch_size=1)
+        self.assertEqual(
+            stats, {'replayed': 1, 'duplicate': 0, 'skipped': 0, 'failed': 0})
+        self.assertTrue(User.by_email('plain@bar.com').enabled)
+        self.assertIsNone(User.by_billing_email('plain@bar.com'))
+
+    def test_failed_ipn(self):
+        lines = [
+            _jvzoo('new@bar.com', 'A1'),
+            _jvzoo('other@bar.com', 'A2', product_id='2'),
+            _jvzoo('new@bar.com', 'A3', trans_type='FOO'),
+            _jvzoo('third@bar.com', 'A4'),
+        ]
+        stats = replay_ipns(self.request, lines)
+        self.assertEqual(
+            stats, {'replayed': 2, 'duplicate': 0, 'skipped': 0, 'failed': 2})
+
+        self.assertTrue(User.by_email('new@bar.com').enabled)
+        self.assertTrue(User.by_email('third@bar.com').enabled)
+        self.assertIsNone(User.by_email('other@bar.com'))
+        self.assertEqual(
+            sorted(t.trans_id for t in IPNTransaction.query), [
+                u'A1', u'A4', u'OLD'])
+
+    def test_malformed_line(self):
+        lines = [
+            _jvzoo('new@bar.com', 'A1'),
+            '{"provider": "jvzoo", ',
+            _jvzoo('third@bar.com', 'A2'),
+        ]
+        stats = replay_ipns(self.request, lines)
+        self.assertEqual(
+            stats, {'replayed': 2, 'duplicate': 0, 'skipped': 0, 'failed': 1})
+        self.assertTrue(User.by_email('third@bar.com').enabled)
+
+    def test_ignored_products(self):
+        self.config.registry.settings['bimt.products_to_ignore'] = '2,3'
+        lines = [
+            _jvzoo('new@bar.com', 'A1'),
+            _jvzoo('other@bar.com', 'A2', product_id='2'),
+            _jvzoo('third@bar.com', 'A3', product_id='3'),
+        ]
+        stats = replay_ipns(self.request, lines)
+        self.assertEqual(
+            stats, {'replayed': 1, 'duplicate': 0, 'skipped': 2, 'failed': 0})
+
+        stats = replay_ipns(self.request, lines[1:])
+        self.assertEqual(
+            stats, {'replayed': 0, 'duplicate': 0, 'skipped': 2, 'failed': 0})
+        self.assertIsNone(User.by_email('other@bar.com'))
+
+    @mock.patch('pyramid_bimt.scripts.replay_ipns.forward_ipn')
+    def test_forward(self, forward_ipn):
+        replay_ipns(self.request, [_jvzoo('new@bar.com', 'A1')])
+        self.assertFalse(forward_ipn.called)
+
+        replay_ipns(
+            self.request, [_jvzoo('new@bar.com', 'A2')], forward=True)
+        forward_ipn.assert_called_once_with('http://example.com', [
+            (u'ccustemail', u'new@bar.com'),
+            (u'ccustname', u'John Smith'),
+            (u'cproditem', u'1'),
+            (u'ctransaction', u'SALE'),
+            (u'ctransaffiliate', u'Aff@bar.com'),
+            (u'ctransreceipt', u'A2'),
+        ])
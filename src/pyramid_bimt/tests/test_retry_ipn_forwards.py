@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Tests for the retry_ipn_forwards script."""
+
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.models import IPNForward
+from pyramid_bimt.scripts.retry_ipn_forwards import claim
+from pyramid_bimt.scripts.retry_ipn_forwards import retry_ipn_forwards
+from pyramid_bimt.testing import initTestingDB
+
+import datetime
+import mock
+import transaction
+import unittest
+
+
+class TestRetryIPNForwards(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+        initTestingDB()
+        old = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        with transaction.manager:
+            Session.add(IPNForward(
+                id=1, url='http://a', params=u'[]', modified=old))
+            Session.add(IPNForward(
+                id=2, url='http://b', params=u'[]', attempts=5, modified=old))
+            Session.add(IPNForward(
+                id=3, url='http://c', params=u'[]', modified=old))
+            # may still be delivered by a worker thread
+            Session.add(IPNForward(id=4, url='http://d', params=u'[]'))
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    @mock.patch('pyramid_bimt.scripts.retry_ipn_forwards.get_forwarder')
+    def test_retry_all(self, get_forwarder):
+        get_forwarder.return_value.deliver.side_effect = [True, False, True]
+        self.assertEqual(retry_ipn_forwards(), (2, 1))
+        self.assertEqual(
+            [c[0][0] for c in get_forwarder().deliver.call_args_list],
+            [1, 2, 3],
+        )
+
+    @mock.patch('pyramid_bimt.scripts.retry_ipn_forwards.get_forwarder')
+    def test_max_attempts(self, get_forwarder):
+        get_forwarder.return_value.deliver.return_value = True
+        self.assertEqual(retry_ipn_forwards(max_attempts=5), (2, 0))
+        self.assertEqual(
+            [c[0][0] for c in get_forwarder().deliver.call_args_list],
+            [1, 3],
+        )
+
+    @mock.patch('pyramid_bimt.scripts.retry_ipn_forwards.get_forwarder')
+    def test_min_age(self, get_forwarder):
+        get_forwarder.return_value.deliver.return_value = True
+        self.assertEqual(retry_ipn_forwards(min_age=0), (4, 0))
+
+    @mock.patch('pyramid_bimt.scripts.retry_ipn_forwards.get_forwarder')
+    def test_claimed(self, get_forwarder):
+        get_forwarder.return_value.deliver.return_value = False
+        self.assertEqual(retry_ipn_forwards(), (0, 3))
+
+        # failed forwards are left alone until they are old enough again
+        self.assertEqual(retry_ipn_forwards(), (0, 0))
+
+    @mock.patch('pyramid_bimt.scripts.retry_ipn_forwards.claim')
+    @mock.patch('pyramid_bimt.scripts.retry_ipn_forwards.get_forwarder')
+    def test_claimed_by_other_run(self, get_forwarder, claim):
+        claim.side_effect = [True, False, True]
+        get_forwarder.return_value.deliver.return_value = True
+        self.assertEqual(retry_ipn_forwards(), (2, 0))
+        self.assertEqual(
+            [c[0][0] for c in get_forwarder().deliver.call_args_list],
+            [1, 3],
+        )
+
+    def test_claim(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(minutes=10)
+        self.assertTrue(claim(1, cutoff))
+        self.assertFalse(claim(1, cutoff))
+        self.assertFalse(claim(4, cutoff))
+        self.assertFalse(claim(5, cutoff))
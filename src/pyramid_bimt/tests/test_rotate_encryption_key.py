@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Tests for the rotate_encryption_key script."""
+
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.models import User
+from pyramid_bimt.models import UserProperty
+from pyramid_bimt.scripts.rotate_encryption_key import DecryptionError
+from pyramid_bimt.scripts.rotate_encryption_key import key_fingerprint
+from pyramid_bimt.scripts.rotate_encryption_key import read_checkpoint
+from pyramid_bimt.scripts.rotate_encryption_key import rotate_encryption_key
+from pyramid_bimt.security import get_symmetric_encryption
+from pyramid_bimt.testing import initTestingDB
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+OLD_KEY = 'abcdabcdabcdabcd'
+NEW_KEY = 'dcbadcbadcbadcba'
+FINGERPRINT = key_fingerprint(OLD_KEY, NEW_KEY)
+
+
+class TestRotateEncryptionKey(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+        initTestingDB()
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmpdir, 'state')
+
+        enc = get_symmetric_encryption(OLD_KEY)
+        with transaction.manager:
+            for i in range(5):
+                Session.add(User(
+                    email='foo{}@bar.com'.format(i),
+                    properties=[
+                        UserProperty(
+                            key='api_key',
+                            value=unicode(enc.encrypt('key{}'.format(i))),
+                        ),
+                        UserProperty(key='bimt', value=u'on'),
+                    ],
+                ))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        Session.remove()
+        testing.tearDown()
+
+    def _api_keys(self, key):
+        enc = get_symmetric_encryption(key)
+        return [
+            enc.decrypt(prop.value) for prop in UserProperty.query.filter_by(
+                key='api_key').order_by(UserProperty.id)
+        ]
+
+    def test_rotate(self):
+        total = rotate_encryption_key(
+            OLD_KEY, NEW_KEY, batch_size=2, state_file=self.state_file)
+        self.assertEqual(total, 5)
+        self.assertEqual(
+            self._api_keys(NEW_KEY), ['key0', 'key1', 'key2', 'key3', 'key4'])
+
+        # non-secure properties are left alone
+        self.assertEqual(
+            [p.value for p in UserProperty.query.filter_by(key='bimt')],
+            [u'on'] * 5,
+        )
+
+        # a finished rotation leaves no state behind
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_already_rotated(self):
+        rotate_encryption_key(OLD_KEY, NEW_KEY, state_file=self.state_file)
+
+        # running it again, e.g. before the ini has the new key, must not
+        # decrypt new values with the old key and write garbage back
+        for processes in (0, 2):
+            with self.assertRaises(DecryptionError):
+                rotate_encryption_key(
+                    OLD_KEY, NEW_KEY, processes=processes,
+                    state_file=self.state_file)
+        self.assertEqual(
+            self._api_keys(NEW_KEY), ['key0', 'key1', 'key2', 'key3', 'key4'])
+
+    def test_not_encrypted(self):
+        with transaction.manager:
+            UserProperty.query.filter_by(key='api_key').first().value = u'foo'
+        with self.assertRaises(DecryptionError):
+            rotate_encryption_key(OLD_KEY, NEW_KEY)
+
+    def test_rotate_worker_processes(self):
+        total = rotate_encryption_key(
+            OLD_KEY, NEW_KEY, batch_size=2, processes=2)
+        self.assertEqual(total, 5)
+        self.assertEqual(
+            self._api_keys(NEW_KEY), ['key0', 'key1', 'key2', 'key3', 'key4'])
+
+    def _interrupt(self, committed, last_id=None, pending=None):
+        """Pretend a previous run re-encrypted ``committed`` properties.
+
+        :param last_id: index of the last property in the checkpoint
+        :param pending: index of the last property of the batch that was
+            being committed when the run was interrupted
+        """
+        enc = get_symmetric_encryption(NEW_KEY)
+        with transaction.manager:
+            props = UserProperty.query.filter_by(
+                key='api_key').order_by(UserProperty.id).all()
+            for prop in props[:committed]:
+                prop.value = unicode(enc.encrypt(
+                    get_symmetric_encryption(OLD_KEY).decrypt(prop.value)))
+            state = {
+                'keys': FINGERPRINT,
+                'last_id': props[last_id or committed - 1].id,
+                'pending': None,
+            }
+            if pending is not None:
+                prop = props[pending]
+                if pending < committed:
+                    state['pending'] = [prop.id, prop.value]
+                else:
+                    state['pending'] = [prop.id, unicode(enc.encrypt('foo'))]
+        with open(self.state_file, 'w') as f:
+            json.dump(state, f)
+
+    def test_resume(self):
+        self._interrupt(committed=2)
+        total = rotate_encryption_key(
+            OLD_KEY, NEW_KEY, state_file=self.state_file)
+        self.assertEqual(total, 3)
+        self.assertEqual(
+            self._api_keys(NEW_KEY), ['key0', 'key1', 'key2', 'key3', 'key4'])
+
+    def test_resume_batch_committed(self):
+        # the run died after committing the third and fourth property,
+        # before it updated the checkpoint
+        self._interrupt(committed=4, last_id=1, pending=3)
+        total = rotate_encryption_key(
+            OLD_KEY, NEW_KEY, state_file=self.state_file)
+        self.assertEqual(total, 1)
+        self.assertEqual(
+            self._api_keys(NEW_KEY), ['key0', 'key1', 'key2', 'key3', 'key4'])
+
+    def test_resume_batch_not_committed(self):
+        # the run died before committing the third and fourth property
+        self._interrupt(committed=2, pending=3)
+        total = rotate_encryption_key(
+            OLD_KEY, NEW_KEY, state_file=self.state_file)
+        self.assertEqual(total, 3)
+        self.assertEqual(
+            self._api_keys(NEW_KEY), ['key0', 'key1', 'key2', 'key3', 'key4'])
+
+    def test_other_keys(self):
+        self._interrupt(committed=2)
+        with self.assertRaises(ValueError):
+            rotate_encryption_key(
+                OLD_KEY, 'ffffffffffffffff', state_file=self.state_file)
+
+        # state files without a fingerprint are refused as well
+        for content in ['3', 'foo']:
+            with open(self.state_file, 'w') as f:
+                f.write(content)
+            with self.assertRaises(ValueError):
+                rotate_encryption_key(
+                    OLD_KEY, NEW_KEY, state_file=self.state_file)
+
+    @mock.patch('pyramid_bimt.scripts.rotate_encryption_key.write_batch')
+    def test_pending_before_commit(self, write_batch):
+        write_batch.side_effect = RuntimeError('Boom!')
+        with self.assertRaises(RuntimeError):
+            rotate_encryption_key(
+                OLD_KEY, NEW_KEY, batch_size=2, state_file=self.state_file)
+
+        with open(self.state_file) as f:
+            state = json.load(f)
+        self.assertEqual(state['keys'], FINGERPRINT)
+        self.assertEqual(state['last_id'], 0)
+        self.assertEqual(
+            state['pending'][0], write_batch.call_args[0][0][-1][0])
+
+    def test_no_checkpoint(self):
+        self.assertEqual(read_checkpoint(None, FINGERPRINT), 0)
+        self.assertEqual(read_checkpoint(self.state_file, FINGERPRINT), 0)
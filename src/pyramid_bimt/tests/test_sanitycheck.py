@@ -114,39 +114,50 @@ class TestCheckDefaultGroups(unittest.TestCase):
 class TestCheckUsersProductGroup(unittest.TestCase):
     def setUp(self):
         testing.setUp()
+        initTestingDB()
 
     def tearDown(self):
+        Session.remove()
         testing.tearDown()
 
-    @mock.patch('pyramid_bimt.sanitycheck.User')
-    def test_no_product_group(self, User):
-        from sqlalchemy.orm.exc import NoResultFound
-        user = mock.Mock()
-        p = mock.PropertyMock(side_effect=NoResultFound('Boom!'))
-        type(user).product_group = p
-        User.get_all.return_value = [user, ]
+    def test_no_product_group(self):
+        from pyramid_bimt.tests.test_group_model import _make_group
+        from pyramid_bimt.tests.test_user_model import _make_user
+        _make_user(groups=[_make_group(name='foo')])
+        Session.flush()
 
         from pyramid_bimt.sanitycheck import CheckUsersProductGroup
         self.assertEqual(CheckUsersProductGroup()(), [])
 
-    @mock.patch('pyramid_bimt.sanitycheck.User')
-    def test_single_product_group(self, User):
-        user = mock.Mock()
-        user.product_group = 'foo'
-        User.get_all.return_value = [user, ]
+    def test_single_product_group(self):
+        from pyramid_bimt.tests.test_group_model import _make_group
+        from pyramid_bimt.tests.test_user_model import _make_user
+        _make_user(groups=[_make_group(name='foo', product_id='1')])
+        Session.flush()
 
         from pyramid_bimt.sanitycheck import CheckUsersProductGroup
         self.assertEqual(CheckUsersProductGroup()(), [])
 
-    @mock.patch('pyramid_bimt.sanitycheck.User')
-    def test_multiple_product_groups(self, User):
-        from sqlalchemy.orm.exc import MultipleResultsFound
-        user = mock.Mock()
-        user.id = 1
-        user.email = 'foo@bar.com'
-        p = mock.PropertyMock(side_effect=MultipleResultsFound('Boom!'))
-        type(user).product_group = p
-        User.get_all.return_value = [user, ]
+    def test_addon_groups_ignored(self):
+        from pyramid_bimt.tests.test_group_model import _make_group
+        from pyramid_bimt.tests.test_user_model import _make_user
+        _make_user(groups=[
+            _make_group(name='foo', product_id='1'),
+            _make_group(name='bar', product_id='2', addon=True),
+        ])
+        Session.flush()
+
+        from pyramid_bimt.sanitycheck import CheckUsersProductGroup
+        self.assertEqual(CheckUsersProductGroup()(), [])
+
+    def test_multiple_product_groups(self):
+        from pyramid_bimt.tests.test_group_model import _make_group
+        from pyramid_bimt.tests.test_user_model import _make_user
+        foo = _make_group(name='foo', product_id='1')
+        bar = _make_group(name='bar', product_id='2')
+        _make_user(email='foo@bar.com', groups=[foo, bar])
+        _make_user(email='bar@bar.com', groups=[foo])
+        Session.flush()
 
         from pyramid_bimt.sanitycheck import CheckUsersProductGroup
         self.assertEqual(
@@ -158,17 +169,19 @@ class TestCheckUsersProductGroup(unittest.TestCase):
 class TestCheckUsersProperties(unittest.TestCase):
     def setUp(self):
         testing.setUp()
+        initTestingDB()
 
     def tearDown(self):
+        Session.remove()
         testing.tearDown()
 
-    @mock.patch('pyramid_bimt.sanitycheck.User')
-    def test_fullname_is_None(self, User):
-        user = mock.Mock()
-        user.id = 2
-        user.email = 'foo@bar.com'
-        user.fullname = None
-        User.get_all.return_value = [user, ]
+    def _make_user(self, fullname):
+        from pyramid_bimt.tests.test_user_model import _make_user
+        _make_user(id=2, email='foo@bar.com', fullname=fullname)
+        Session.flush()
+
+    def test_fullname_is_None(self):
+        self._make_user(fullname=None)
 
         from pyramid_bimt.sanitycheck import CheckUsersProperties
         self.assertEqual(
@@ -176,13 +189,8 @@ class TestCheckUsersProperties(unittest.TestCase):
             ['User foo@bar.com (2) has an empty fullname.', ]
         )
 
-    @mock.patch('pyramid_bimt.sanitycheck.User')
-    def test_fullname_is_empty_string(self, User):
-        user = mock.Mock()
-        user.id = 2
-        user.email = 'foo@bar.com'
-        user.fullname = ''
-        User.get_all.return_value = [user, ]
+    def test_fullname_is_empty_string(self):
+        self._make_user(fullname=u'')
 
         from pyramid_bimt.sanitycheck import CheckUsersProperties
         self.assertEqual(
@@ -190,13 +198,8 @@ class TestCheckUsersProperties(unittest.TestCase):
             ['User foo@bar.com (2) has an empty fullname.', ]
         )
 
-    @mock.patch('pyramid_bimt.sanitycheck.User')
-    def test_fullname_is_spaces(self, User):
-        user = mock.Mock()
-        user.id = 2
-        user.email = 'foo@bar.com'
-        user.fullname = '  '
-        User.get_all.return_value = [user, ]
+    def test_fullname_is_spaces(self):
+        self._make_user(fullname=u'  ')
 
         from pyramid_bimt.sanitycheck import CheckUsersProperties
         self.assertEqual(
@@ -204,13 +207,8 @@ class TestCheckUsersProperties(unittest.TestCase):
             ['User foo@bar.com (2) has an empty fullname.', ]
         )
 
-    @mock.patch('pyramid_bimt.sanitycheck.User')
-    def test_no_warnings(self, User):
-        user = mock.Mock()
-        user.id = 2
-        user.email = 'foo@bar.com'
-        user.fullname = 'Foo'
-        User.get_all.return_value = [user, ]
+    def test_no_warnings(self):
+        self._make_user(fullname=u'Foo')
 
         from pyramid_bimt.sanitycheck import CheckUsersProperties
         self.assertEqual(
@@ -465,7 +463,144 @@ class TestRunAllChecks(unittest.TestCase):
         )
 
 
-class TestSanityCheckView(unittest.TestCase):
+class TestRunChecks(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.registry = self.config.registry
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _register(self, *checks):
+        self.registry.getAllUtilitiesRegisteredFor = lambda iface: checks
+
+    def test_serial(self):
+        import threading
+        self.registry.settings['bimt.sanitycheck_workers'] = '0'
+        threads = []
+
+        class CheckFoo(object):
+            def __call__(self):
+                threads.append(threading.current_thread())
+                return ['foo warning']
+
+        self._register(CheckFoo)
+
+        from pyramid_bimt.sanitycheck import get_last_report
+        from pyramid_bimt.sanitycheck import run_checks
+        self.assertIsNone(get_last_report(self.registry))
+
+        report = run_checks(self.registry)
+        self.assertEqual(report.warnings, ['foo warning'])
+        self.assertEqual(report.durations.keys(), ['CheckFoo'])
+        self.assertIs(get_last_report(self.registry), report)
+        self.assertEqual(threads, [threading.current_thread()])
+
+    @mock.patch('pyramid_bimt.sanitycheck.Session')
+    def test_thread_pool(self, Session):
+        import threading
+        threads = []
+
+        class CheckFoo(object):
+            def __call__(self):
+                threads.append(threading.current_thread())
+                return ['foo warning']
+
+        class CheckBar(object):
+            def __call__(self):
+                return ['bar warning']
+
+        self._register(CheckFoo, CheckBar)
+
+        from pyramid_bimt.sanitycheck import run_checks
+        report = run_checks(self.registry)
+        self.assertEqual(report.warnings, ['foo warning', 'bar warning'])
+        self.assertEqual(
+            sorted(report.durations.keys()), ['CheckBar', 'CheckFoo'])
+
+        # checks run in a thread pool by default and clean up their own
+        # thread-local sessions
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertTrue(Session.remove.called)
+
+    @mock.patch('pyramid_bimt.sanitycheck.Session')
+    def test_timeout(self, Session):
+        import threading
+        self.registry.settings['bimt.sanitycheck_workers'] = '2'
+        self.registry.settings['bimt.sanitycheck_timeout'] = '0.01'
+        done = threading.Event()
+
+        class CheckSlow(object):
+            def __call__(self):
+                done.wait(5)
+                return []
+
+        self._register(CheckSlow)
+
+        from pyramid_bimt.sanitycheck import run_checks
+        report = run_checks(self.registry)
+        done.set()
+        self.assertEqual(
+            report.warnings,
+            ['Sanity check CheckSlow timed out after 0.01 seconds.'],
+        )
+        self.assertEqual(report.durations, {'CheckSlow': None})
+
+    @mock.patch('pyramid_bimt.sanitycheck.Session')
+    def test_timeout_per_check(self, Session):
+        import time
+        self.registry.settings['bimt.sanitycheck_workers'] = '1'
+        self.registry.settings['bimt.sanitycheck_timeout'] = '1'
+
+        def slowish_check(name):
+            class CheckSlowish(object):
+                def __call__(self):
+                    time.sleep(0.6)
+                    return [name]
+            CheckSlowish.__name__ = name
+            return CheckSlowish
+
+        # together they take longer than the timeout, each one does not
+        self._register(slowish_check('CheckFoo'), slowish_check('CheckBar'))
+
+        from pyramid_bimt.sanitycheck import run_checks
+        report = run_checks(self.registry)
+        self.assertEqual(report.warnings, ['CheckFoo', 'CheckBar'])
+
+    @mock.patch('pyramid_bimt.sanitycheck.Session')
+    def test_timeout_no_thread(self, Session):
+        import threading
+        import time
+        self.registry.settings['bimt.sanitycheck_workers'] = '1'
+        self.registry.settings['bimt.sanitycheck_timeout'] = '0.1'
+        done = threading.Event()
+        called = []
+
+        def slow_check(name):
+            class CheckSlow(object):
+                def __call__(self):
+                    called.append(name)
+                    done.wait(5)
+                    return []
+            CheckSlow.__name__ = name
+            return CheckSlow
+
+        # the only thread is busy with the first check, the second one never
+        # gets a thread and is not started at all
+        self._register(slow_check('CheckFoo'), slow_check('CheckBar'))
+
+        from pyramid_bimt.sanitycheck import run_checks
+        report = run_checks(self.registry)
+        done.set()
+
+        self.assertEqual(
+            report.durations, {'CheckFoo': None, 'CheckBar': None})
+        self.assertEqual(len(report.warnings), 2)
+        time.sleep(0.05)
+        self.assertEqual(called, ['CheckFoo'])
+
+
+class TestRefreshInBackground(unittest.TestCase):
     def setUp(self):
         testing.setUp()
         self.request = testing.DummyRequest()
@@ -473,10 +608,50 @@ class TestSanityCheckView(unittest.TestCase):
     def tearDown(self):
         testing.tearDown()
 
+    @mock.patch('pyramid_bimt.sanitycheck.Session')
+    @mock.patch('pyramid_bimt.sanitycheck.run_all_checks')
+    def test_refresh(self, run_all_checks, Session):
+        from pyramid_bimt.sanitycheck import refresh_in_background
+        refresh_in_background(self.request).join()
+        Session.remove.assert_called_with()
+
+        # checks run with a new request, the given one is finished by then
+        request = run_all_checks.call_args[0][0]
+        self.assertIsNot(request, self.request)
+        self.assertIs(request.registry, self.request.registry)
+        self.assertEqual(request.application_url, 'http://example.com')
+
+    @mock.patch('pyramid_bimt.sanitycheck.logger')
+    @mock.patch('pyramid_bimt.sanitycheck.Session')
+    @mock.patch('pyramid_bimt.sanitycheck.run_all_checks')
+    def test_refresh_error(self, run_all_checks, Session, logger):
+        run_all_checks.side_effect = ValueError('Boom!')
+
+        from pyramid_bimt.sanitycheck import refresh_in_background
+        refresh_in_background(self.request).join()
+        self.assertEqual(logger.exception.call_count, 1)
+        Session.remove.assert_called_with()
+
+
+class TestSanityCheckView(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.add_route('sanitycheck', '/sanity-check/')
+        self.request = testing.DummyRequest()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _set_report(self, warnings):
+        from datetime import datetime
+        from pyramid_bimt.sanitycheck import SanityCheckReport
+        self.request.registry.sanitycheck_report = SanityCheckReport(
+            warnings, {'CheckFoo': 0.1}, datetime(2015, 7, 1))
+
     @mock.patch('pyramid_bimt.sanitycheck.run_all_checks')
     @mock.patch('pyramid_bimt.sanitycheck.app_assets')
     def test_assets(self, app_assets, run_all_checks):
-        run_all_checks.return_value = []
+        self._set_report([])
 
         from pyramid_bimt.sanitycheck import sanitycheck_view
         sanitycheck_view(self.request)
@@ -484,11 +659,38 @@ class TestSanityCheckView(unittest.TestCase):
 
     @mock.patch('pyramid_bimt.sanitycheck.run_all_checks')
     def test_view_result(self, run_all_checks):
-        run_all_checks.return_value = ['warning1', 'warning2']
+        run_all_checks.side_effect = lambda request: self._set_report(
+            ['warning1', 'warning2'])
+
+        from pyramid_bimt.sanitycheck import sanitycheck_view
+        result = sanitycheck_view(self.request)
+        run_all_checks.assert_called_with(self.request)
+        self.assertEqual(result['warnings'], ['warning1', 'warning2'])
+        self.assertEqual(result['durations'], [('CheckFoo', 0.1)])
+
+    @mock.patch('pyramid_bimt.sanitycheck.run_all_checks')
+    def test_view_cached(self, run_all_checks):
+        self._set_report(['warning1'])
+
+        from pyramid_bimt.sanitycheck import sanitycheck_view
+        result = sanitycheck_view(self.request)
+        self.assertFalse(run_all_checks.called)
+        self.assertEqual(result['warnings'], ['warning1'])
+
+    @mock.patch('pyramid_bimt.sanitycheck.refresh_in_background')
+    def test_view_refresh(self, refresh_in_background):
+        self._set_report(['warning1'])
+        self.request.GET['refresh'] = '1'
 
         from pyramid_bimt.sanitycheck import sanitycheck_view
         result = sanitycheck_view(self.request)
-        self.assertEqual(result, {'warnings': ['warning1', 'warning2']})
+        refresh_in_background.assert_called_with(self.request)
+        self.assertEqual(result.location, '/sanity-check/')
+        self.assertEqual(
+            self.request.session.pop_flash(),
+            [u'Sanity check started, reload the page in a while to see '
+             'the new report.'],
+        )
 
 
 class TestSanityCheckEmail(unittest.TestCase):
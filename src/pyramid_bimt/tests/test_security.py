@@ -4,6 +4,7 @@
 from pyramid import testing
 from pyramid_bimt.security import SymmetricEncryption
 
+import base64
 import mock
 import unittest
 
@@ -60,6 +61,92 @@ class TestVerify(unittest.TestCase):
         self.assertFalse(verify(object(), encrypted_pass))
 
 
+class TestVerifyAndUpdate(unittest.TestCase):
+
+    def test_current_cost(self):
+        from pyramid_bimt.security import encrypt
+        from pyramid_bimt.security import verify_and_update
+        self.assertEqual(
+            verify_and_update('secret', encrypt('secret')), (True, None))
+
+    def test_outdated_cost(self):
+        from passlib.hash import sha512_crypt
+        from pyramid_bimt.security import verify_and_update
+        old_hash = sha512_crypt.encrypt('secret', rounds=60000)
+
+        valid, new_hash = verify_and_update('secret', old_hash)
+        self.assertTrue(valid)
+        self.assertTrue(new_hash.startswith('$6$rounds=90000$'))
+        self.assertIsInstance(new_hash, unicode)
+
+    def test_wrong_password(self):
+        from passlib.hash import sha512_crypt
+        from pyramid_bimt.security import verify_and_update
+        old_hash = sha512_crypt.encrypt('secret', rounds=60000)
+        self.assertEqual(verify_and_update('foo', old_hash), (False, None))
+
+
+class TestHashingService(unittest.TestCase):
+
+    def tearDown(self):
+        from pyramid_bimt.security import configure_hashing
+        configure_hashing({})
+
+    def test_configure_defaults(self):
+        from pyramid_bimt.security import configure_hashing
+        service = configure_hashing({})
+        self.assertEqual(service.rounds, 90000)
+        self.assertEqual(service.processes, 0)
+
+    def test_configure(self):
+        from pyramid_bimt.security import configure_hashing
+        service = configure_hashing({
+            'bimt.password_rounds': '100000',
+            'bimt.password_hashing_processes': '2',
+            'bimt.password_hashing_max_pending': '3',
+        })
+        self.assertEqual(service.rounds, 100000)
+        self.assertEqual(service.processes, 2)
+        self.assertEqual(service.max_pending, 3)
+
+    def test_process_pool(self):
+        from pyramid_bimt.security import configure_hashing
+        from pyramid_bimt.security import encrypt
+        from pyramid_bimt.security import verify
+        service = configure_hashing({
+            'bimt.password_rounds': '60000',
+            'bimt.password_hashing_processes': '1',
+        })
+        cyphertext = encrypt(' secret ')
+        self.assertTrue(cyphertext.startswith('$6$rounds=60000$'))
+        self.assertTrue(verify('secret', cyphertext))
+        self.assertFalse(verify('foo', cyphertext))
+
+        # pool is re-used for subsequent calls
+        pool = service._pool
+        encrypt('secret')
+        self.assertIs(service._pool, pool)
+
+        service.close()
+        self.assertIsNone(service._pool)
+
+    def test_encrypt_many(self):
+        from pyramid_bimt.security import configure_hashing
+        from pyramid_bimt.security import encrypt_many
+        from pyramid_bimt.security import verify
+        for processes in ('0', '2'):
+            service = configure_hashing({
+                'bimt.password_rounds': '60000',
+                'bimt.password_hashing_processes': processes,
+            })
+            hashes = encrypt_many([' foo ', 'bar'])
+            self.assertEqual(len(hashes), 2)
+            self.assertIsInstance(hashes[0], unicode)
+            self.assertTrue(verify('foo', hashes[0]))
+            self.assertTrue(verify('bar', hashes[1]))
+            service.close()
+
+
 @mock.patch('pyramid_bimt.security.get_current_registry')
 class TestSymmetricEncryption(unittest.TestCase):
 
@@ -98,3 +185,60 @@ class TestSymmetricEncryption(unittest.TestCase):
         encrypted = SymmetricEncryption().encrypt(secret)
 
         self.assertEqual(SymmetricEncryption().decrypt(encrypted), secret)
+
+    def test_explicit_key(self, get_current_registry):
+        encrypted = SymmetricEncryption('abcdabcdabcdabcd').encrypt('foo')
+        self.assertEqual(
+            SymmetricEncryption('abcdabcdabcdabcd').decrypt(encrypted), 'foo')
+        self.assertFalse(get_current_registry.called)
+
+    def test_encrypt_decrypt_many(self, get_current_registry):
+        enc = SymmetricEncryption('abcdabcdabcdabcd')
+        encrypted = enc.encrypt_many(['foo', 'bar'])
+        self.assertEqual(len(encrypted), 2)
+        self.assertNotEqual(encrypted[0], encrypted[1])
+        self.assertEqual(enc.decrypt_many(encrypted), ['foo', 'bar'])
+        self.assertEqual(
+            enc.decrypt_many(encrypted, strict=True), ['foo', 'bar'])
+
+    def test_decrypt_strict(self, get_current_registry):
+        enc = SymmetricEncryption('abcdabcdabcdabcd')
+        other = SymmetricEncryption('dcbadcbadcbadcba')
+        # about 1 in 256 values decrypts with a valid padding by chance
+        values = [other.encrypt('foo{}'.format(i)) for i in range(20)]
+        with self.assertRaises(ValueError):
+            enc.decrypt_many(values, strict=True)
+        with self.assertRaises(ValueError):
+            enc.decrypt(base64.b64encode('x' * 16), strict=True)
+        self.assertEqual(len(enc.decrypt_many(values)), 20)
+
+    def test_get_symmetric_encryption(self, get_current_registry):
+        from pyramid_bimt.security import get_symmetric_encryption
+        get_current_registry.return_value.settings = {
+            'bimt.encryption_aes_16b_key': 'abcdabcdabcdabcd',
+        }
+        enc = get_symmetric_encryption()
+        self.assertEqual(enc.key, 'abcdabcdabcdabcd')
+        self.assertIs(get_symmetric_encryption(), enc)
+        self.assertIs(get_symmetric_encryption('abcdabcdabcdabcd'), enc)
+
+        other = get_symmetric_encryption('dcbadcbadcbadcba')
+        self.assertIsNot(other, enc)
+        self.assertEqual(other.key, 'dcbadcbadcbadcba')
+
+    def test_configure_encryption(self, get_current_registry):
+        from pyramid_bimt.security import configure_encryption
+        from pyramid_bimt.security import get_symmetric_encryption
+        enc = configure_encryption({
+            'bimt.encryption_aes_16b_key': 'abcdabcdabcdabcd'})
+        try:
+            self.assertEqual(enc.key, 'abcdabcdabcdabcd')
+            self.assertIs(get_symmetric_encryption(), enc)
+            self.assertFalse(get_current_registry.called)
+        finally:
+            self.assertIsNone(configure_encryption({}))
+
+        get_current_registry.return_value.settings = {
+            'bimt.encryption_aes_16b_key': 'dcbadcbadcbadcba',
+        }
+        self.assertEqual(get_symmetric_encryption().key, 'dcbadcbadcbadcba')
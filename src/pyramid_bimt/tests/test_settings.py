@@ -383,45 +383,66 @@ class TestUpgradeDowngradeSubscription(unittest.TestCase):
         self.assertEqual(entry.user.id, self.request.user.id)
 
 
-@mock.patch('pyramid_bimt.views.settings.ClickbankAPI')
+@mock.patch('pyramid_bimt.views.settings.get_clickbank_api')
 class TestChangeSubscription(unittest.TestCase):
 
     def setUp(self):
         self.request = mock.Mock()
-        self.request.registry.settings = {
-            'bimt.clickbank_dev_key': 'secret',
-            'bimt.clickbank_api_key': 'secret'
-        }
         self.view = SettingsForm(self.request)
+        patcher = mock.patch('pyramid_bimt.views.settings.ClickbankReceipt')
+        self.ClickbankReceipt = patcher.start()
+        self.ClickbankReceipt.latest.return_value = None
+        self.addCleanup(patcher.stop)
 
-    def test_success(self, ClickbankAPI):
-        ClickbankAPI.return_value.change_user_subscription.return_value = '111'
+    def test_success(self, get_clickbank_api):
+        get_clickbank_api.return_value.change_user_subscription.return_value = '111'  # noqa
         self.assertEqual(
             self.view._change_clickbank_subscription(mock.Mock(product_id=1)),
             '111',
         )
 
-    def test_exception(self, ClickbankAPI):
+    def test_exception(self, get_clickbank_api):
         from pyramid_bimt.clickbank import ClickbankException
-        ClickbankAPI.return_value.change_user_subscription.side_effect = ClickbankException()  # noqa
+        get_clickbank_api.return_value.change_user_subscription.side_effect = ClickbankException()  # noqa
         with self.assertRaises(ClickbankException):
             self.view._change_clickbank_subscription(mock.Mock(product_id=1))
 
-    def test_use_billing_email(self, ClickbankAPI):
-        self.request.registry.settings['bimt.clickbank_dev_key'] = 'dev'
-        self.request.registry.settings['bimt.clickbank_api_key'] = 'key'
+    def test_use_billing_email(self, get_clickbank_api):
         self.request.user.product_group.product_id = 'foo'
 
         self.request.user.email = 'foo@bar.com'
         self.request.user.billing_email = None
         self.view._change_clickbank_subscription(
             Group(id=1, name='bar', product_id='baz'))
-        ClickbankAPI.return_value.change_user_subscription.assert_called_with(
-            'foo@bar.com', 'foo', 'baz')
+        get_clickbank_api.return_value.change_user_subscription.assert_called_with(  # noqa
+            'foo@bar.com', 'foo', 'baz', receipt=None)
 
         self.request.user.email = 'foo@bar.com'
         self.request.user.billing_email = 'billing@bar.com'
         self.view._change_clickbank_subscription(
             Group(id=1, name='bar', product_id='baz'))
-        ClickbankAPI.return_value.change_user_subscription.assert_called_with(
-            'billing@bar.com', 'foo', 'baz')
+        get_clickbank_api.return_value.change_user_subscription.assert_called_with(  # noqa
+            'billing@bar.com', 'foo', 'baz', receipt=None)
+
+    def test_synced_receipt(self, get_clickbank_api):
+        self.ClickbankReceipt.latest.return_value = 'LPJ9VE42'
+        self.request.user.product_group.product_id = 'foo'
+        self.request.user.billing_email = 'billing@bar.com'
+        self.view._change_clickbank_subscription(
+            Group(id=1, name='bar', product_id='baz'))
+        self.ClickbankReceipt.latest.assert_called_with(
+            'billing@bar.com', 'foo',
+            since=self.request.user.last_payment)
+        get_clickbank_api.return_value.change_user_subscription.assert_called_with(  # noqa
+            'billing@bar.com', 'foo', 'baz', receipt='LPJ9VE42')
+
+    def test_no_last_payment(self, get_clickbank_api):
+        self.ClickbankReceipt.latest.return_value = 'LPJ9VE42'
+        self.request.user.product_group.product_id = 'foo'
+        self.request.user.billing_email = 'billing@bar.com'
+        self.request.user.last_payment = None
+        self.view._change_clickbank_subscription(
+            Group(id=1, name='bar', product_id='baz'))
+        self.assertFalse(self.ClickbankReceipt.latest.called)
+        get_clickbank_api.return_value.change_user_subscription.assert_called_with(  # noqa
+            'billing@bar.com', 'foo', 'baz', receipt=None)
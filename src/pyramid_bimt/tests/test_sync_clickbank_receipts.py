@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Tests for the sync_clickbank_receipts script."""
+
+from datetime import date
+from pyramid import testing
+from pyramid_basemodel import Session
+from pyramid_bimt.clickbank import ClickbankException
+from pyramid_bimt.models import ClickbankReceipt
+from pyramid_bimt.scripts.sync_clickbank_receipts import sync_clickbank_receipts  # noqa
+from pyramid_bimt.testing import initTestingDB
+from pyramid_bimt.tests.test_clickbank_model import _order
+
+import mock
+import unittest
+
+
+class TestSyncClickbankReceipts(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUp()
+        initTestingDB()
+        self.api = mock.Mock()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test_first_sync(self):
+        self.api.list_orders.return_value = iter([
+            [_order('A', '2014-12-18T01:53:59-08:00'),
+             _order('B', '2014-12-19T01:53:59-08:00')],
+            [_order('C', '2014-12-20T01:53:59-08:00')],
+        ])
+        self.assertEqual(sync_clickbank_receipts(api=self.api), (3, 3))
+        self.api.list_orders.assert_called_once_with()
+        self.assertEqual(ClickbankReceipt.query.count(), 3)
+
+    def test_since_watermark(self):
+        self.api.list_orders.return_value = iter([
+            [_order('A', '2014-12-20T01:53:59-08:00')],
+        ])
+        sync_clickbank_receipts(api=self.api)
+
+        self.api.list_orders.return_value = iter([
+            [_order('A', '2014-12-20T01:53:59-08:00'),
+             _order('B', '2014-12-21T01:53:59-08:00')],
+        ])
+        self.assertEqual(sync_clickbank_receipts(api=self.api), (2, 1))
+        self.api.list_orders.assert_called_with(startDate='2014-12-19')
+
+    def test_start_date(self):
+        self.api.list_orders.return_value = iter([])
+        self.assertEqual(
+            sync_clickbank_receipts(
+                api=self.api, start_date=date(2014, 1, 1)),
+            (0, 0),
+        )
+        self.api.list_orders.assert_called_with(startDate='2014-01-01')
+
+    def test_interrupted(self):
+        def pages(**params):
+            yield [_order('A', '2014-12-20T01:53:59-08:00')]
+            raise ClickbankException('Clickbank error: 503')
+
+        self.api.list_orders.side_effect = pages
+        with self.assertRaises(ClickbankException):
+            sync_clickbank_receipts(api=self.api)
+
+        # the first page is committed
+        self.assertEqual(ClickbankReceipt.latest('foo@bar.com', '1'), 'A')
+
+    @mock.patch.object(ClickbankReceipt, 'ingest')
+    def test_ingest_failed(self, ingest):
+        ingest.side_effect = ValueError
+        self.api.list_orders.return_value = iter([
+            [_order('A', '2014-12-20T01:53:59-08:00')],
+        ])
+        with self.assertRaises(ValueError):
+            sync_clickbank_receipts(api=self.api)
+        self.assertEqual(ClickbankReceipt.query.count(), 0)
+
+    @mock.patch(
+        'pyramid_bimt.scripts.sync_clickbank_receipts.get_clickbank_api')
+    def test_default_api(self, get_clickbank_api):
+        get_clickbank_api.return_value.list_orders.return_value = iter([])
+        self.assertEqual(sync_clickbank_receipts(), (0, 0))
@@ -101,6 +101,49 @@ class TestUserByEmail(unittest.TestCase):
         user = User.by_email(email='foo@bar.com')
         self.assertEqual(user.email, 'foo@bar.com')
 
+    def test_billing_email(self):
+        _make_user(email='foo@bar.com', billing_email='bar@bar.com')
+        self.assertEqual(
+            User.by_billing_email('bar@bar.com').email, 'foo@bar.com')
+        self.assertEqual(User.by_billing_email('foo@bar.com'), None)
+
+
+class TestUserByAnyEmail(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        initTestingDB()
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+
+    def test_invalid_email(self):
+        self.assertEqual(User.by_any_email(1), None)
+        self.assertEqual(User.by_any_email('foo@bar.com'), None)
+        self.assertEqual(User.by_any_email(None), None)
+
+    def test_email(self):
+        _make_user(email='foo@bar.com')
+        self.assertEqual(User.by_any_email('foo@bar.com').email, 'foo@bar.com')
+        self.assertEqual(User.by_any_email('Foo@Bar.com').email, 'foo@bar.com')
+
+    def test_billing_email(self):
+        _make_user(email='foo@bar.com', billing_email='Billing@bar.com')
+        self.assertEqual(
+            User.by_any_email('billing@bar.com').email, 'foo@bar.com')
+
+    def test_email_takes_precedence(self):
+        _make_user(email='foo@bar.com', billing_email='bar@bar.com')
+        _make_user(email='bar@bar.com')
+        self.assertEqual(User.by_any_email('bar@bar.com').email, 'bar@bar.com')
+
+    def test_for_update(self):
+        _make_user(email='foo@bar.com')
+        with mock.patch.object(User, 'query') as query:
+            User.by_any_email('foo@bar.com', for_update=True)
+        query.filter.return_value.with_for_update.assert_called_once_with()
+
 
 class TestUserGetAll(unittest.TestCase):
 
@@ -7,12 +7,14 @@ from datetime import datetime
 from pyramid import testing
 from pyramid.httpexceptions import HTTPFound
 from pyramid_basemodel import Session
+from pyramid_bimt import add_routes_group
 from pyramid_bimt import add_routes_user
 from pyramid_bimt.models import AuditLogEntry
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import User
 from pyramid_bimt.models import UserProperty
 from pyramid_bimt.security import verify
+from pyramid_bimt.testing import assert_query_count
 from pyramid_bimt.testing import initTestingDB
 from pyramid_bimt.views.user import UserAdd
 
@@ -526,6 +528,23 @@ class TestUserEmailValidators(unittest.TestCase):
 
         self.assertFalse(validator(schema.get('email'), 'billing@bar.com'))
 
+    def test_context_email_in_use_by_other_billing_email(self):
+        from pyramid_bimt.views.user import deferred_user_billing_email_validator  # noqa
+        from colander import Invalid
+
+        User.by_email('one@bar.com').billing_email = 'admin@bar.com'
+        self.request.context = User.by_email('admin@bar.com')
+        self.request.POST['billing_email'] = 'admin@bar.com'
+
+        validator = deferred_user_billing_email_validator(
+            None, {'request': self.request})
+        with self.assertRaises(Invalid) as cm:
+            validator(None, 'Admin@bar.com')
+        self.assertEqual(
+            cm.exception.msg,
+            u'Email Admin@bar.com is already in use.'
+        )
+
 
 class TestUserAdd(unittest.TestCase):
 
@@ -777,3 +796,33 @@ class TestUserUnsubscribe(unittest.TestCase):
             self.request.session.pop_flash(),
             [u'You are already unsubscribed from newsletter.']
         )
+
+
+class TestUserListAJAXQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        add_routes_user(self.config)
+        add_routes_group(self.config)
+        self.config.testing_securitypolicy(
+            userid='admin@bar.com', permissive=True)
+        initTestingDB(groups=True, users=True)
+        with transaction.manager:
+            groups = Group.query.all()
+            for i in range(20):
+                Session.add(User(
+                    email='user{}@bar.com'.format(i),
+                    groups=groups[i % 3:i % 3 + 2],
+                ))
+        self.request = testing.DummyRequest(params={'iDisplayLength': '50'})
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    def test_groups_not_loaded_per_user(self):
+        from pyramid_bimt.views.user import UserListAJAX
+        with assert_query_count(4):
+            result = UserListAJAX(self.request)()
+        self.assertEqual(len(result['aaData']), 23)
@@ -8,12 +8,14 @@ from pyramid_basemodel import Session
 from pyramid_bimt import add_home_view
 from pyramid_bimt import configure
 from pyramid_bimt.acl import AuditLogFactory
+from pyramid_bimt.testing import assert_query_count
 from pyramid_bimt.testing import initTestingDB
 from pyramid_bimt.views.auth import LoginForm
 from pyramid_mailer import get_mailer
 
 import colander
 import mock
+import transaction
 import unittest
 import webtest
 
@@ -54,6 +56,35 @@ class TestLoginViewsFunctional(unittest.TestCase):
         resp = resp.follow()
         self.assertIn('A sample BIMT page', resp.text)
 
+    @mock.patch.object(LoginForm, 'user_agent_info')
+    def test_login_billing_email(self, user_agent_info):
+        user_agent_info.return_value = u'test_comment'
+        resp = self.testapp.get('/login/', status=200)
+        resp.form['email'] = 'billing@bar.com'
+        resp.form['password'] = 'secret'
+        resp = resp.form.submit('login')
+        self.assertIn('302 Found', resp.text)
+        resp = resp.follow()
+        self.assertIn('A sample BIMT page', resp.text)
+
+    @mock.patch.object(LoginForm, 'user_agent_info')
+    def test_login_upgrades_hash(self, user_agent_info):
+        from pyramid_bimt.models import User
+        from pyramid_bimt.security import configure_hashing
+        user_agent_info.return_value = u'test_comment'
+        configure_hashing({'bimt.password_rounds': '95000'})
+        try:
+            resp = self.testapp.get('/login/', status=200)
+            resp.form['email'] = 'one@bar.com'
+            resp.form['password'] = 'secret'
+            resp = resp.form.submit('login')
+            self.assertIn('302 Found', resp.text)
+        finally:
+            configure_hashing({})
+        self.assertTrue(
+            User.by_email('one@bar.com').password.startswith(
+                '$6$rounds=95000$'))
+
     def test_login_wrong_password(self):
         resp = self.testapp.get('/login/', status=200)
         self.assertIn('<h1>Login</h1>', resp.text)
@@ -92,6 +123,30 @@ class TestLoginViewsFunctional(unittest.TestCase):
                       'entered your email address.', resp.text)
 
 
+class TestLoginSuccessQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'bimt.app_title': 'BIMT'})
+        initTestingDB(auditlog_types=True, groups=True, users=True)
+        configure(self.config)
+        self.config.testing_securitypolicy()
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+
+    @mock.patch.object(LoginForm, 'user_agent_info')
+    def test_login_success(self, user_agent_info):
+        user_agent_info.return_value = u'test_comment'
+        view = LoginForm(testing.DummyRequest())
+        with assert_query_count(3):
+            response = view.login_success(
+                {'email': 'one@bar.com', 'password': 'secret'})
+            Session.flush()
+        self.assertEqual(response.status_code, 302)
+
+
 class TestUserAgentInfo(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
@@ -398,6 +453,15 @@ class TestDatatablesAJAXView(unittest.TestCase):
             request=None,
         )
 
+    def test_options(self):
+        self.view.options = ['foo', 'bar']
+        items = self.view.model.get_all.return_value
+        items.options.return_value.all.return_value = []
+        self.view()
+        items.options.assert_called_once_with('foo', 'bar')
+        self.assertTrue(items.options.return_value.all.called)
+        self.assertFalse(items.all.called)
+
 
 class TestDatatablesAJAXViewImplementation(unittest.TestCase):
     def setUp(self):
@@ -79,6 +79,11 @@ class DatatablesDataView(object):
     #: in your derived class.
     model = None
 
+    #: Loader options of the queried items, for example
+    #: ``[subqueryload('groups')]`` for relationships that
+    #: ``populate_columns`` uses, so they are not lazy loaded for every row.
+    options = None
+
     def __init__(self, request):
         self.request = request
         self.columns = copy.copy(self.columns)
@@ -114,16 +119,20 @@ class DatatablesDataView(object):
         else:
             filter_by = None
 
+        items = self.model.get_all(
+            request=request,
+            filter_by=filter_by,
+            search=search,
+            order_by=order_by,
+            order_direction=order_direction,
+            offset=(start, end),
+            security=security,
+        )
+        if self.options:
+            items = items.options(*self.options)
+
         data = []
-        for item in self.model.get_all(
-                request=request,
-                filter_by=filter_by,
-                search=search,
-                order_by=order_by,
-                order_direction=order_direction,
-                offset=(start, end),
-                security=security,
-        ).all():
+        for item in items.all():
             for key in self.columns.keys():  # reset columns
                 self.columns[key] = None
 
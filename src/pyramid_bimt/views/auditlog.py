@@ -15,6 +15,7 @@ from pyramid_bimt.static import table_assets
 from pyramid_bimt.views import DatatablesDataView
 from pyramid_bimt.views import SQLAlchemySchemaNode
 from pyramid_deform import FormView
+from sqlalchemy.orm import joinedload
 
 import logging
 
@@ -53,6 +54,7 @@ def audit_log(request):
 class AuditLogAJAX(DatatablesDataView):
     """Ajax view used to populate AuditLog datatables with JSON data."""
     model = AuditLogEntry
+    options = [joinedload('event_type'), joinedload('user')]
 
     columns = OrderedDict()
     columns['timestamp'] = None
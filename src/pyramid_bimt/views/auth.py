@@ -18,11 +18,10 @@ from pyramid_bimt.events import UserLoggedOut
 from pyramid_bimt.models import User
 from pyramid_bimt.security import encrypt
 from pyramid_bimt.security import generate
-from pyramid_bimt.security import verify
+from pyramid_bimt.security import verify_and_update
 from pyramid_bimt.views import FormView
 from pyramid_bimt.views import SQLAlchemySchemaNode
 from pyramid_deform import CSRFSchema
-from ua_parser import user_agent_parser
 
 import colander
 
@@ -41,6 +40,9 @@ class LoginForm(FormView):
     hide_sidebar = True
 
     def user_agent_info(self):
+        # ua_parser compiles all its regexes on import, so only import it
+        # when someone logs in, not on every app start
+        from ua_parser import user_agent_parser
         ua = user_agent_parser.Parse(self.request.user_agent)
 
         device = ua['device']['family']
@@ -64,12 +66,15 @@ class LoginForm(FormView):
             'came_from', self.request.application_url)
         email = appstruct.get('email', '').lower()
         password = appstruct.get('password')
-        user = User.by_email(email)
-        if (
-            password is not None and
-            user is not None and
-            verify(password, user.password)
-        ):
+        user = User.by_any_email(email)
+        if password is not None and user is not None:
+            valid, new_hash = verify_and_update(password, user.password)
+        else:
+            valid, new_hash = False, None
+        if valid:
+            # re-hash passwords that were hashed with an outdated cost
+            if new_hash:
+                user.password = new_hash
             headers = remember(self.request, user.email)
             self.request.registry.notify(
                 UserLoggedIn(self.request, user, comment=self.user_agent_info())  # noqa
@@ -80,7 +85,7 @@ class LoginForm(FormView):
 
     def reset_password_success(self, appstruct):
         email = appstruct['email'].lower()
-        user = User.by_email(email)
+        user = User.by_any_email(email)
         if user is not None:
 
             # change user's password and fire event
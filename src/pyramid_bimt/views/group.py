@@ -36,7 +36,7 @@ class GroupView(object):
         self.request.layout_manager.layout.hide_sidebar = True
         self.request.layout_manager.layout.title = u'Groups'
         return {
-            'groups': Group.get_all().all(),
+            'groups': Group.get_all(with_member_count=True).all(),
         }
 
 
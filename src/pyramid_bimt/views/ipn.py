@@ -6,45 +6,221 @@ from copy import deepcopy
 from datetime import date
 from datetime import timedelta
 from flufl.enum import Enum
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 from pyramid.view import view_config
 from pyramid_bimt.events import UserCreated
 from pyramid_bimt.events import UserDisabled
 from pyramid_bimt.events import UserEnabled
+from pyramid_bimt.forwarding import forward_ipn
+from pyramid_bimt.locking import lock
 from pyramid_bimt.models import Group
+from pyramid_bimt.models import IPNTransaction
 from pyramid_bimt.models import Session
 from pyramid_bimt.models import User
 from pyramid_bimt.security import encrypt
 from pyramid_bimt.security import generate
 from pyramid_bimt.utils import AttrDict
 from pyramid_bimt.utils import flatten
+from sqlalchemy.exc import IntegrityError
+from transaction.interfaces import TransientError
+from zope.interface import Interface
+from zope.interface import implementer
 
+import base64
 import hashlib
 import json
 import logging
-import requests
 import string
+import transaction
+import warnings
 
 logger = logging.getLogger(__name__)
 
 COMMENT = u'{} by {}, transaction id: {}, type: {}, note: {}'
 
-MAPPING_JVZOO = {
-    'ccustname': 'fullname',
-    'ccustemail': 'email',
-    'cproditem': 'product_id',
-    'ctransaction': 'trans_type',
-    'ctransreceipt': 'trans_id',
-    'ctransaffiliate': 'affiliate',
-}
-MAPPING_CLICKBANK = {
-    'customer.billing.fullName': 'fullname',
-    'customer.billing.email': 'email',
-    'lineItems.0.itemNo': 'product_id',
-    'transactionType': 'trans_type',
-    'receipt': 'trans_id',
-    'affiliate': 'affiliate',
-}
+#: characters removed from decrypted Clickbank notifications
+_NON_PRINTABLE = ''.join(
+    c for c in map(chr, range(256)) if c not in string.printable)
+#: padding characters stripped from decrypted Clickbank notifications
+_PADDING = ' \x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f'
+
+_clickbank_keys = {}
+
+
+class IPNParams(AttrDict):
+    """Values of an IPN request, common to all providers.
+
+    A dict with attribute access. Params in ``names`` that the request does
+    not provide are None, providers and apps can add other params.
+    """
+
+    #: params that every IPN request has
+    names = (
+        'fullname',
+        'email',
+        'product_id',
+        'trans_type',
+        'trans_id',
+        'affiliate',
+    )
+
+    def __init__(self, *args, **kwargs):
+        super(IPNParams, self).__init__(*args, **kwargs)
+        for name in self.names:
+            self.setdefault(name, None)
+
+    def get(self, name, default=None):
+        """Return value of the given param, default if it is not set."""
+        value = super(IPNParams, self).get(name)
+        return default if value is None else value
+
+
+class IIPNProvider(Interface):
+    """Definition class for all IPN providers.
+
+    Register providers as named utilities, the name of the utility is the
+    name of the provider used in IPN URLs and audit log comments.
+    """
+
+    def parse(self, request):  # pragma: no cover
+        """Verify an IPN request and parse its values.
+
+        :raises ValueError: if the request is not a valid IPN request
+        :returns: values of the IPN request
+        :rtype: IPNParams
+        """
+        pass
+
+
+class IPNProvider(object):
+    """A base class for IPN providers.
+
+    Subclasses set ``mapping`` and implement ``parse()``.
+    """
+
+    #: mapping of the provider's field names to IPNParams attributes
+    mapping = {}
+
+    #: IPNParams attributes that are converted to lowercase
+    lowercase = ('email', )
+
+    def params(self, items):
+        """Map (key, value) items of a request to IPNParams in common form."""
+        mapping = self.mapping
+        params = IPNParams()
+        for key, value in items:
+            name = mapping.get(key)
+            if name is not None:
+                params[name] = value
+
+        if isinstance(params.fullname, str):
+            params.fullname = params.fullname.decode('utf-8')
+        for name in self.lowercase:
+            value = params[name]
+            if value is not None:
+                params[name] = value.lower()
+        return params
+
+
+@implementer(IIPNProvider)
+class JVZooProvider(IPNProvider):
+    """JVZoo sends IPN values as POST params, signed with a checksum."""
+
+    mapping = {
+        'ccustname': 'fullname',
+        'ccustemail': 'email',
+        'cproditem': 'product_id',
+        'ctransaction': 'trans_type',
+        'ctransreceipt': 'trans_id',
+        'ctransaffiliate': 'affiliate',
+    }
+    lowercase = ('email', 'affiliate')
+
+    def parse(self, request):
+        post = request.POST
+
+        # check that we have some content to work with
+        if not post:
+            raise ValueError('No POST request.')
+
+        # checksum is a SHA digest of POST values, ordered by key and
+        # joined with '|', with the secret key as the last value
+        values = [
+            value for key, value in sorted(post.items()) if key != 'cverify']
+        values.append(request.registry.settings['bimt.jvzoo_secret_key'])
+        strparams = '|'.join(values)
+        if isinstance(strparams, unicode):
+            strparams = strparams.encode('utf-8')
+        sha = hashlib.sha1(strparams).hexdigest()
+        if not post['cverify'] == sha[:8].upper():
+            raise ValueError('Checksum verification failed')
+
+        return self.params(post.items())
+
+
+@implementer(IIPNProvider)
+class ClickbankProvider(IPNProvider):
+    """Clickbank sends IPN values as AES encrypted JSON."""
+
+    mapping = {
+        'customer.billing.fullName': 'fullname',
+        'customer.billing.email': 'email',
+        'lineItems.0.itemNo': 'product_id',
+        'transactionType': 'trans_type',
+        'receipt': 'trans_id',
+        'affiliate': 'affiliate',
+    }
+
+    def _key(self, secret):
+        if secret not in _clickbank_keys:
+            _clickbank_keys[secret] = hashlib.sha1(secret).hexdigest()[:32]
+        return _clickbank_keys[secret]
+
+    def parse(self, request):
+        # check that we have some content to work with
+        try:
+            body = request.json_body
+        except Exception:
+            raise ValueError('No JSON request.')
+
+        # decrypt values
+        cipher = AES.new(
+            self._key(request.registry.settings['bimt.clickbank_secret_key']),
+            AES.MODE_CBC,
+            base64.b64decode(body['iv']),
+        )
+        decrypted_str = cipher.decrypt(base64.b64decode(body['notification']))
+        decrypted_str = decrypted_str.translate(None, _NON_PRINTABLE).strip(
+            _PADDING)
+
+        try:
+            request.decrypted = flatten(json.loads(decrypted_str))
+        except ValueError as e:
+            logger.exception(e)
+            raise ValueError('Decryption failed: {}'.format(decrypted_str))
+
+        return self.params(request.decrypted.iteritems())
+
+
+#: deprecated, use ``JVZooProvider.mapping``
+MAPPING_JVZOO = JVZooProvider.mapping
+
+#: deprecated, use ``ClickbankProvider.mapping``
+MAPPING_CLICKBANK = ClickbankProvider.mapping
+
+
+class IPNConflict(TransientError):
+    """A concurrent transaction changed the same user, retry the IPN."""
+
+
+def _rollback(savepoint):
+    """Roll back to the savepoint, return False if that is not supported."""
+    try:
+        savepoint.rollback()
+    except TypeError:
+        return False
+    return True
 
 
 class UserActions(Enum):
@@ -56,7 +232,7 @@ class UserActions(Enum):
 class IPNView(object):
     """Handle IPN POST requests to BIMT app."""
 
-    provider = None  # 'jvzoo' or 'clickbank'
+    provider = None  # name of the IIPNProvider utility, e.g. 'jvzoo'
 
     def __init__(self, request):
         self.request = request
@@ -67,15 +243,8 @@ class IPNView(object):
         renderer='string',
     )
     def jvzoo(self):
-        """Set provider to 'jvzoo' and call IPN handler."""
-        self.provider = 'jvzoo'
-
-        # check that we have some content to work with
-        if not self.request.POST:
-            raise ValueError('No POST request.')
-
-        self._parse_request_jvzoo()
-        return self.ipn()
+        """Handle an IPN request sent by JVZoo."""
+        return self.handle('jvzoo')
 
     @view_config(
         route_name='clickbank',
@@ -83,16 +252,53 @@ class IPNView(object):
         renderer='string',
     )
     def clickbank(self):
-        """Set provider to 'clickbank' and call IPN handler."""
-        self.provider = 'clickbank'
-        # check that we have some content to work with
-        try:
-            self.request.json_body
-        except Exception:
-            raise ValueError('No JSON request.')
+        """Handle an IPN request sent by Clickbank."""
+        return self.handle('clickbank')
 
-        self._parse_request_clickbank()
-        return self.ipn()
+    @view_config(
+        route_name='ipn_provider',
+        permission=NO_PERMISSION_REQUIRED,
+        renderer='string',
+    )
+    def ipn_provider(self):
+        """Handle an IPN request sent by any registered provider."""
+        return self.handle(self.request.matchdict['provider'])
+
+    def handle(self, provider):
+        """Parse the request with the given provider and call IPN handler."""
+        factory = self.request.registry.queryUtility(
+            IIPNProvider, name=provider)
+        if factory is None:
+            raise HTTPNotFound('Unknown IPN provider: {}'.format(provider))
+
+        self.provider = provider
+        self.params = factory().parse(self.request)
+        return self.retry_ipn()
+
+    def retry_ipn(self):
+        """Call the IPN handler, retrying it after transient errors.
+
+        The IPN is handled in a savepoint of the request's transaction, which
+        is committed or aborted by ``pyramid_tm``. A lock timeout or a
+        conflicting write (a ``TransientError``) rolls back to the savepoint
+        and the IPN is handled again, up to ``bimt.ipn_attempts`` times (3 by
+        default). If the savepoint cannot be rolled back, for example because
+        the database does not support savepoints, the error is raised and
+        the request is retried only if the app sets ``tm.attempts``.
+        """
+        attempts = int(
+            self.request.registry.settings.get('bimt.ipn_attempts', 3))
+        attempt = 1
+        while True:
+            savepoint = transaction.savepoint(optimistic=True)
+            try:
+                return self.ipn()
+            except TransientError as e:
+                if attempt >= attempts or not _rollback(savepoint):
+                    raise
+                logger.warning('Retrying IPN for {}: {}'.format(
+                    self.params.email, e))
+            attempt += 1
 
     def ipn(self):
         """The main IPN handler, called by the IPN service."""
@@ -104,56 +310,145 @@ class IPNView(object):
                     self.params.product_id))
             return 'Done.'
 
-        # try to find an existing user with given email
-        user = User.by_email(self.params.email)
-        if not user:
-            user = User.by_billing_email(self.params.email)
+        # without them a retried notification cannot be told apart from a
+        # new one, see is_duplicate()
+        if self.params.trans_id is None or self.params.trans_type is None:
+            raise ValueError(
+                'IPN for {} is missing transaction id or type'.format(
+                    self.params.email))
+
+        # providers send several notifications for the same customer at
+        # once, e.g. SALE and SUBSCRIPTION-CHG, process them one by one
+        self.lock()
+
+        # skip over transactions that were already processed, providers
+        # retry notifications until they get a response
+        if self.is_duplicate():
+            logger.info(
+                'Duplicate IPN, transaction id: {}, type: {}'.format(
+                    self.params.trans_id, self.params.trans_type))
+            return 'Done.'
+        self.record_transaction()
 
-        # create a new user if no existing user found
+        # try to find an existing user with given email, create a new user
+        # if no existing user found
+        user = self.find_user()
         if not user:
-            password = generate()
-            user = User(
-                email=self.params.email,
-                billing_email=self.params.email,
-                password=encrypt(password),
-                fullname=u'{}'.format(self.params.fullname),
-                affiliate=u'{}'.format(self.params.get('affiliate', '')),
-            )
-            Session.add(user)
-
-            comment = COMMENT.format(
-                u'Created',
-                self.provider,
-                self.params.trans_id,
-                self.params.trans_type,
-                '',
-            )
-            logger.info(comment)
-            self.request.registry.notify(
-                UserCreated(self.request, user, password, comment))
+            user = self.create_user()
 
         # find a group that is used for given product
-        group = Group.by_product_id(self.params.product_id)
+        group = self.find_group()
         if not group:
             raise ValueError(
                 'Cannot find group with product_id "{}"'.format(
                     self.params.product_id))
 
-        # perform IPN transaction actions
+        # perform IPN transaction actions, a conflicting write by a
+        # concurrent transaction fails the flush and the IPN is retried
         self.ipn_transaction(user, group)
+        try:
+            Session.flush()
+        except IntegrityError as e:
+            raise IPNConflict(
+                'Conflicting IPN for {}: {}'.format(self.params.email, e))
 
         # send request with same parameters to the URL specified on group
+        # once the transaction is committed
         if group.forward_ipn_to_url:
-            requests.post(
-                group.forward_ipn_to_url,
-                params=self.request.POST,
-            )
-            logger.info(
-                'IPN re-posted to {}.'.format(group.forward_ipn_to_url))
+            self.forward(group)
 
         logger.info('IPN done.')
         return 'Done.'
 
+    def _parse_request_jvzoo(self):
+        """Deprecated, use ``JVZooProvider().parse(request)``."""
+        warnings.warn(
+            '_parse_request_jvzoo() is deprecated, use JVZooProvider',
+            DeprecationWarning,
+        )
+        self.params = JVZooProvider().parse(self.request)
+
+    def _parse_request_clickbank(self):
+        """Deprecated, use ``ClickbankProvider().parse(request)``."""
+        warnings.warn(
+            '_parse_request_clickbank() is deprecated, use ClickbankProvider',
+            DeprecationWarning,
+        )
+        self.params = ClickbankProvider().parse(self.request)
+
+    def lock(self):
+        """Lock the IPN's customer until the transaction ends.
+
+        Concurrent IPNs for the same email wait for each other, instead of
+        overwriting each other's changes or creating the user twice.
+        """
+        lock(
+            u'ipn:{}'.format(self.params.email),
+            timeout=float(self.request.registry.settings.get(
+                'bimt.ipn_lock_timeout', 10)),
+        )
+
+    def is_duplicate(self):
+        """Check if this IPN transaction was already processed."""
+        return IPNTransaction.exists(
+            self.provider, self.params.trans_id, self.params.trans_type)
+
+    def record_transaction(self):
+        """Record this IPN transaction as processed."""
+        IPNTransaction.record(
+            self.provider, self.params.trans_id, self.params.trans_type)
+
+    def find_user(self):
+        """Find the user by email or billing email, None if not found.
+
+        The user's row is locked until the transaction ends, so that other
+        IPNs that find the same user wait for this one.
+        """
+        return User.by_any_email(self.params.email, for_update=True)
+
+    def create_user(self):
+        """Create a new user for this IPN and notify ``UserCreated``."""
+        password, password_hash = self.generate_password()
+        user = User(
+            email=self.params.email,
+            billing_email=self.params.email,
+            password=password_hash,
+            fullname=u'{}'.format(self.params.fullname),
+            affiliate=u'{}'.format(self.params.get('affiliate', '')),
+        )
+        Session.add(user)
+
+        comment = COMMENT.format(
+            u'Created',
+            self.provider,
+            self.params.trans_id,
+            self.params.trans_type,
+            '',
+        )
+        logger.info(comment)
+        self.request.registry.notify(
+            UserCreated(self.request, user, password, comment))
+        return user
+
+    def generate_password(self):
+        """Generate a password for a new user.
+
+        :return: tuple of (password, password hash)
+        :rtype: tuple
+        """
+        password = generate()
+        return password, encrypt(password)
+
+    def find_group(self):
+        """Find the group used for the IPN product, None if not found."""
+        return Group.by_product_id(self.params.product_id)
+
+    def forward(self, group):
+        """Queue the IPN request for re-post to ``forward_ipn_to_url``."""
+        forward_ipn(group.forward_ipn_to_url, self.request.POST.items())
+        logger.info(
+            'IPN queued for re-post to {}.'.format(group.forward_ipn_to_url))
+
     def ipn_transaction(self, user, group):
         """Select correct IPN transaction type and call its method.
 
@@ -307,73 +602,3 @@ class IPNView(object):
         )
         self.request.registry.notify(
             UserDisabled(self.request, user, comment))
-
-    def _parse_request_jvzoo(self):
-        """Verify if received POST is a valid JVZoo POST request.
-
-        Save parsed values to self.params.
-        """
-        # concatenate POST parameters into a string
-        strparams = u''
-        for key, value in sorted(self.request.POST.items()):
-            if key != 'cverify':
-                strparams += str(value) + '|'
-
-        # secretkey must be last
-        strparams += self.request.registry.settings['bimt.jvzoo_secret_key']
-
-        # calculate SHA digest and compare to ``cverify`` value
-        sha = hashlib.sha1(strparams.encode('utf-8')).hexdigest().upper()
-        if not self.request.POST['cverify'] == sha[:8]:
-            raise ValueError('Checksum verification failed')
-
-        # re-map values from POST to fit common naming conventions
-        self.params = AttrDict()
-        for key, value in self.request.POST.items():
-            if key in MAPPING_JVZOO:
-                self.params[MAPPING_JVZOO[key]] = value
-
-        # convert to common form
-        for key, value in self.params.items():
-            if key in ['fullname', ]:
-                self.params[key] = value.decode('utf-8')
-            if key in ['email', 'affiliate']:
-                self.params[key] = value.lower()
-
-    def _parse_request_clickbank(self):
-        """Decrypt JSON received from a Clickbank JSON request and save
-        values to self.params.
-        """
-        # decrypt values
-        iv = self.request.json_body['iv']
-        encrypted_str = self.request.json_body['notification']
-        sha1 = hashlib.sha1()
-        sha1.update(
-            self.request.registry.settings['bimt.clickbank_secret_key'])
-        cipher = AES.new(
-            sha1.hexdigest()[:32], AES.MODE_CBC, iv.decode('base64'))
-
-        decrypted_str = cipher.decrypt(encrypted_str.decode('base64')).strip(
-            '')
-        decrypted_str = filter(lambda x: x in string.printable, decrypted_str)  # noqa
-        decrypted_str = decrypted_str.strip(
-            ' \x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f')
-
-        try:
-            self.request.decrypted = flatten(json.loads(decrypted_str))
-        except ValueError as e:
-            logger.exception(e)
-            raise ValueError('Decryption failed: {}'.format(decrypted_str))
-
-        # re-map values from POST to fit common naming conventions
-        self.params = AttrDict()
-        for key, value in self.request.decrypted.iteritems():
-            if key in MAPPING_CLICKBANK:
-                self.params[MAPPING_CLICKBANK[key]] = value
-
-        # convert to common form
-        for key, value in self.params.items():
-            if key in ['fullname', ]:
-                self.params[key] = value.decode('utf-8')
-            if key in ['email', ]:
-                self.params[key] = value.lower()
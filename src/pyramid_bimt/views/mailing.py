@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 """Manage mailings."""
 
+from pyramid.decorator import reify
 from pyramid.httpexceptions import HTTPFound
 from pyramid.renderers import render
 from pyramid.view import view_config
 from pyramid_basemodel import Session
 from pyramid_bimt.const import BimtPermissions
+from pyramid_bimt.delivery import send_mailing
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import Mailing
+from pyramid_bimt.models import MailingDeliveryStatuses
 from pyramid_bimt.models import MailingTriggers
+from pyramid_bimt.models import User
 from pyramid_bimt.static import app_assets
 from pyramid_bimt.static import chosen_assets
 from pyramid_bimt.static import table_assets
@@ -16,6 +20,7 @@ from pyramid_bimt.views import FormView
 from pyramid_bimt.views import SQLAlchemySchemaNode
 from pyramid_mailer import get_mailer
 from pyramid_mailer.message import Message
+from sqlalchemy.orm import subqueryload
 
 import colander
 import deform
@@ -41,7 +46,8 @@ class MailingView(object):
 
         return {
             'triggers': MailingTriggers,
-            'mailings': Mailing.query.order_by(Mailing.name).all(),
+            'mailings': Mailing.get_all(
+                options=[subqueryload('groups')]),
         }
 
 
@@ -146,21 +152,31 @@ class MailingEdit(MailingAdd):
             if button.name == 'send_immediately':
                 button.value = 'Immediately send mailing "{}" to all {} ' \
                     'recipients without date constraints?'.format(
-                        mailing.name, len(self.recipients))
+                        mailing.name, self.recipients_count)
+
+    @reify
+    def description(self):
+        """Progress of the last send immediately, shown above the form."""
+        progress = self.request.context.delivery_progress()
+        if not progress:
+            return None
+        return u'{}: sent to {} of {} recipients, {} failed.'.format(
+            'Sending' if progress.get(MailingDeliveryStatuses.pending.name)
+            else 'Last sent',
+            progress.get(MailingDeliveryStatuses.sent.name, 0),
+            sum(progress.values()),
+            progress.get(MailingDeliveryStatuses.failed.name, 0),
+        )
 
-    @property
+    @reify
     def recipients(self):
-        """Return a list of recipients for this mailing."""
-        mailing = self.request.context
-
-        recipients = set()
-        for group in mailing.groups:
-            recipients = recipients.union(group.users)
-
-        for group in mailing.exclude_groups:
-            recipients = recipients.difference(group.users)
+        """Return a query of recipients for this mailing."""
+        return self.request.context.recipients_query()
 
-        return recipients
+    @reify
+    def recipients_count(self):
+        """Return the number of recipients, counted once per request."""
+        return self.recipients.count()
 
     def save_success(self, appstruct):
         mailing = self.request.context
@@ -200,7 +216,8 @@ class MailingEdit(MailingAdd):
         This mailing would be sent to: <br />
         {} <br />
         ------------------ <br /><br />
-        """.format('<br />'.join([r.email for r in self.recipients]))
+        """.format('<br />'.join(
+            email for email, in self.recipients.with_entities(User.email)))
         params['body'] = prefix + body
 
         mailer = get_mailer(self.request)
@@ -219,12 +236,11 @@ class MailingEdit(MailingAdd):
     def send_immediately_success(self, appstruct):
         mailing = self.request.context
 
-        for recipient in self.recipients:
-            mailing.send(recipient)
+        pending = send_mailing(mailing, self.request)
 
         self.request.session.flash(
-            u'Mailing "{}" sent to {} recipients.'.format(
-                mailing.name, len(self.recipients)))
+            u'Mailing "{}" is being sent to {} recipients.'.format(
+                mailing.name, pending))
         return HTTPFound(
             location=self.request.route_path(
                 'mailing_edit', mailing_id=mailing.id))
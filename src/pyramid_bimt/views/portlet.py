@@ -14,6 +14,7 @@ from pyramid_bimt.static import chosen_assets
 from pyramid_bimt.static import table_assets
 from pyramid_bimt.views import FormView
 from pyramid_bimt.views import SQLAlchemySchemaNode
+from sqlalchemy.orm import subqueryload
 
 import colander
 import deform
@@ -38,8 +39,8 @@ class PortletView(object):
 
         return {
             'positions': PortletPositions,
-            'portlets': Portlet.query.order_by(
-                Portlet.position, Portlet.weight.desc()).all(),
+            'portlets': Portlet.get_all(
+                options=[subqueryload('groups')]),
         }
 
 
@@ -4,11 +4,12 @@ from deform.form import Button
 from pyramid.events import subscriber
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import remember
-from pyramid_bimt.clickbank import ClickbankAPI
 from pyramid_bimt.clickbank import ClickbankException
+from pyramid_bimt.clickbank import get_clickbank_api
 from pyramid_bimt.events import IUserCreated
 from pyramid_bimt.events import UserSubscriptionChangeFailed
 from pyramid_bimt.events import UserSubscriptionChanged
+from pyramid_bimt.models import ClickbankReceipt
 from pyramid_bimt.models import Group
 from pyramid_bimt.models import User
 from pyramid_bimt.security import generate
@@ -31,7 +32,8 @@ def deferred_settings_email_validator(node, kw):
 
     def validator(node, cstruct):
         colander.Email()(node, cstruct)
-        if request.user.email != cstruct and User.by_email(cstruct):
+        user = User.by_any_email(cstruct)
+        if user and user != request.user:
             raise colander.Invalid(
                 node,
                 u'Email {} is already in use by another user.'.format(cstruct)
@@ -243,15 +245,23 @@ class SettingsForm(FormView):
         }
 
     def _change_clickbank_subscription(self, new_group):
-        clickbank_client = ClickbankAPI(
-            self.request.registry.settings['bimt.clickbank_dev_key'],
-            self.request.registry.settings['bimt.clickbank_api_key'],
-        )
-        email = self.request.user.billing_email or self.request.user.email
+        clickbank_client = get_clickbank_api()
+        user = self.request.user
+        email = user.billing_email or user.email
+        product_id = user.product_group.product_id
+
+        # the synced receipt is used only if the sync already has the user's
+        # last payment, otherwise it is looked up with the Clickbank API
+        receipt = None
+        if user.last_payment:
+            receipt = ClickbankReceipt.latest(
+                email, product_id, since=user.last_payment)
+
         return clickbank_client.change_user_subscription(
             email,
-            self.request.user.product_group.product_id,
-            new_group.product_id
+            product_id,
+            new_group.product_id,
+            receipt=receipt,
         )
 
 
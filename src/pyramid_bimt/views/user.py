@@ -19,6 +19,9 @@ from pyramid_bimt.static import table_assets
 from pyramid_bimt.views import DatatablesDataView
 from pyramid_bimt.views import FormView
 from pyramid_bimt.views import SQLAlchemySchemaNode
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.orm import subqueryload
 
 import colander
 import copy
@@ -39,15 +42,20 @@ def deferred_groups_validator(node, kw):
 
 def validate_email_field(node, kw, field_name):
 
-    email_fields = ['email', 'billing_email']
-
     def validator(node, cstruct):
         colander.Email()(node, cstruct)
-        for email_field in email_fields:
-            query = User.query.filter_by(**{email_field: cstruct})
-            if query.count() and query.one() != kw['request'].context:
-                raise colander.Invalid(
-                    node, u'Email {} is already in use.'.format(cstruct))
+        # any other user with this email in either column, the context's own
+        # email must not hide another user's billing email
+        query = User.query.filter(or_(
+            func.lower(User.email) == cstruct.lower(),
+            func.lower(User.billing_email) == cstruct.lower(),
+        ))
+        context = kw['request'].context
+        if isinstance(context, User):
+            query = query.filter(User.id != context.id)
+        if query.count():
+            raise colander.Invalid(
+                node, u'Email {} is already in use.'.format(cstruct))
 
     # skip validation if context already has email set and this email is resent
     if (  # pragma: no branch
@@ -161,6 +169,7 @@ class UserView(object):
 class UserListAJAX(DatatablesDataView):
     """Ajax view used to populate AuditLog datatables with JSON data."""
     model = User
+    options = [subqueryload('groups')]
 
     columns = OrderedDict()
     columns['id'] = None